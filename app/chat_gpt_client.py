@@ -1,10 +1,25 @@
-from typing import List
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Iterator, List, Tuple
 
+import clients
 import constants
+import context_window
+import log
+import model_router
 import openai
+import rate_limiter
+import resilience
+import response_cache
+import thread_history
+import tracing
+import usage_ledger
 import utils
-from dynamo_db_client import DynamoDBClient
-from errors import OpenAIError
+from dynamo_db_client import UserConfigItem
+from errors import (CircuitOpenError, DeadlineExceededError, OpenAIError,
+                    QuotaExceededError, RateLimitExceededError)
+from openai import error as openai_error
 from openai.error import RateLimitError, ServiceUnavailableError
 
 logger = utils.setup_logger(__name__)
@@ -12,39 +27,417 @@ logger = utils.setup_logger(__name__)
 
 openai.api_key = constants.OPEN_AI_API_KEY
 
+# 次のモデルにフォールバックするエラー
+FALLBACK_ERRORS = (
+    OpenAIError,
+    CircuitOpenError,
+    DeadlineExceededError,
+    RateLimitExceededError,
+    QuotaExceededError,
+    openai_error.OpenAIError,
+)
 
-def create_chat_gpt_completion(replies: List[str], user_id: str) -> str:
-    messages = []
-    if constants.CHAT_GPT_SYSTEM_ROLE_CONTENT != "":
-        messages.append(
-            {
-                "role": "system",
-                "content": constants.CHAT_GPT_SYSTEM_ROLE_CONTENT,
-            }
-        )
 
-    db_client = DynamoDBClient()
-    user_config = db_client.get_item_from_user_config(user_id)
-    if user_config:
-        messages.append(
-            {
-                "role": "system",
-                "content": user_config.system_role_content,
-            }
+@dataclass(frozen=True)
+class CompiledPrompt:
+    # ユーザ設定から作る、すべてのリクエストで共通の先頭のsystemメッセージと生成のパラメータ
+    system_messages: Tuple[dict, ...]
+    max_tokens: int
+    temperature: float = None
+
+
+def create_chat_gpt_completion(
+        replies: List[dict],
+        user_id: str,
+        user_config: UserConfigItem,
+        thread_key: str = None,
+        model_override: str = None,
+        deadline: resilience.Deadline = None) -> str:
+    route = model_router.route(replies, user_config, model_override)
+    prompt = compile_prompt(user_config)
+    system_messages, replies = _prepare_messages(replies, prompt, thread_key, user_id)
+
+    started_at = time.monotonic()
+    cache_lookup = _lookup_response_cache(route, prompt, system_messages, replies, user_config)
+    if cache_lookup and cache_lookup.content is not None:
+        return cache_lookup.content
+
+    model, _, completion, lease = _create_completion_with_fallbacks(
+        route, prompt, system_messages, replies, False, user_id, thread_key, deadline
+    )
+
+    usage = completion.get("usage") or {}
+    rate_limiter.settle(lease, usage.get("total_tokens", lease.tokens if lease else 0))
+    usage_ledger.record(
+        user_id,
+        thread_history.channel_of(thread_key),
+        model,
+        usage.get("prompt_tokens", 0),
+        usage.get("completion_tokens", 0)
+    )
+    model_router.log_result(
+        model,
+        route.reason,
+        time.monotonic() - started_at,
+        usage.get("prompt_tokens", 0),
+        usage.get("completion_tokens", 0)
+    )
+    content = completion.get("choices")[0].get("message").get("content")
+    if cache_lookup and model == cache_lookup.model:
+        response_cache.store(cache_lookup, content)
+    return content
+
+
+def create_chat_gpt_completion_stream(
+        replies: List[dict],
+        user_id: str,
+        user_config: UserConfigItem,
+        thread_key: str = None,
+        model_override: str = None,
+        deadline: resilience.Deadline = None) -> Iterator[str]:
+    route = model_router.route(replies, user_config, model_override)
+    prompt = compile_prompt(user_config)
+    system_messages, replies = _prepare_messages(replies, prompt, thread_key, user_id)
+
+    started_at = time.monotonic()
+    cache_lookup = _lookup_response_cache(route, prompt, system_messages, replies, user_config)
+    if cache_lookup and cache_lookup.content is not None:
+        yield cache_lookup.content
+        return
+
+    model, messages, completion, lease = _create_completion_with_fallbacks(
+        route, prompt, system_messages, replies, True, user_id, thread_key, deadline
+    )
+
+    # 生成されたトークンを届いた順に返す。生成が始まった後はリトライ・フォールバックしない
+    contents = []
+    try:
+        for chunk in completion:
+            content = chunk.get("choices")[0].get("delta").get("content")
+            if content:
+                if not contents:
+                    tracing.record_span("openai.first_token", time.monotonic() - started_at)
+                contents.append(content)
+                yield content
+    except resilience.RETRYABLE_ERRORS as e:
+        raise _to_openai_error(e)
+    except GeneratorExit:
+        # 新しいメッセージで生成が取り消されたときは、ストリームを閉じて生成済みの分だけ精算する
+        _close_completion((model, messages, completion, lease))
+        prompt_tokens = context_window.count_messages_tokens(messages, model)
+        completion_tokens = context_window.count_text_tokens("".join(contents), model)
+        rate_limiter.settle(lease, prompt_tokens + completion_tokens)
+        usage_ledger.record(user_id, thread_history.channel_of(thread_key), model, prompt_tokens, completion_tokens)
+        raise
+
+    # ストリーミングではusageが返らないため、トークン数を数える
+    prompt_tokens = context_window.count_messages_tokens(messages, model)
+    completion_tokens = context_window.count_text_tokens("".join(contents), model)
+    rate_limiter.settle(lease, prompt_tokens + completion_tokens)
+    usage_ledger.record(user_id, thread_history.channel_of(thread_key), model, prompt_tokens, completion_tokens)
+    model_router.log_result(
+        model,
+        route.reason,
+        time.monotonic() - started_at,
+        prompt_tokens,
+        completion_tokens
+    )
+    if cache_lookup and model == cache_lookup.model:
+        response_cache.store(cache_lookup, "".join(contents))
+
+
+def compile_prompt(user_config: UserConfigItem) -> CompiledPrompt:
+    if not user_config:
+        return _compile_prompt(None, None, None)
+    return _compile_prompt(
+        user_config.system_role_content, user_config.max_tokens, user_config.temperature
+    )
+
+
+@lru_cache(maxsize=constants.USER_CONFIG_CACHE_SIZE)
+def _compile_prompt(system_role_content: str, max_tokens: int, temperature: float) -> CompiledPrompt:
+    # 同じ設定のユーザ・リクエストでは作ったものを使い回す。空のsystemメッセージはトークンを消費するだけのため送らない
+    contents = [constants.CHAT_GPT_SYSTEM_ROLE_CONTENT, system_role_content]
+    return CompiledPrompt(
+        system_messages=tuple(
+            {"role": "system", "content": content}
+            for content in contents if content and content.strip()
+        ),
+        max_tokens=max_tokens or constants.DEFAULT_CHAT_GPT_MAX_TOKENS,
+        temperature=temperature
+    )
+
+
+def _lookup_response_cache(
+        route: model_router.ModelRoute,
+        prompt: CompiledPrompt,
+        system_messages: List[dict],
+        replies: List[dict],
+        user_config: UserConfigItem) -> response_cache.CacheLookup:
+    # 最初に試すモデルに送るメッセージをキーにして、同じ質問への応答を使い回す
+    if not response_cache.is_enabled(user_config):
+        return None
+    # 生成のパラメータを変えているユーザには、既定のパラメータで生成した応答を返さない
+    if prompt.max_tokens != constants.DEFAULT_CHAT_GPT_MAX_TOKENS or prompt.temperature is not None:
+        return None
+    model = route.models[0]
+    messages = context_window.build_context(
+        system_messages, replies, model, prompt.max_tokens
+    )
+    return response_cache.lookup(model, messages)
+
+
+def _create_completion_with_fallbacks(
+        route: model_router.ModelRoute,
+        prompt: CompiledPrompt,
+        system_messages: List[dict],
+        replies: List[dict],
+        stream: bool,
+        user_id: str = None,
+        thread_key: str = None,
+        deadline: resilience.Deadline = None) -> Tuple[str, List[dict], Any, rate_limiter.RateLimitLease]:
+    clients.setup_openai()
+    deadline = deadline or resilience.Deadline(constants.CHAT_GPT_DEFAULT_DEADLINE_SECONDS)
+    channel = thread_history.channel_of(thread_key)
+
+    def request(model: str) -> Tuple[str, List[dict], Any, rate_limiter.RateLimitLease]:
+        # 1日の利用上限に達したモデルは使わず、次のモデルにフォールバックする
+        usage_ledger.check_quota(user_id, model)
+        messages = _build_messages(system_messages, replies, model, prompt.max_tokens)
+        # OpenAIのレートリミットに達する前に、見積もったトークン数で送ってよいかを確認する
+        lease = rate_limiter.acquire(
+            model, _estimate_tokens(messages, model, prompt.max_tokens), user_id, channel, deadline
         )
+        try:
+            with tracing.span("openai.completion"):
+                completion = resilience.call_with_retry(
+                    model,
+                    lambda timeout: _create_completion(model, messages, stream, timeout, prompt),
+                    deadline
+                )
+        except Exception:
+            rate_limiter.release(lease)
+            raise
+        return model, messages, completion, lease
+
+    def discard(result: Tuple[str, List[dict], Any, rate_limiter.RateLimitLease]):
+        # ヘッジで使われなかった方も、OpenAIが処理した分のトークンを精算して使用量に数える
+        model, messages, completion, lease = result
+        _close_completion(result)
+        if stream:
+            # 閉じるまでに生成された分は分からないため、プロンプトだけを数える
+            prompt_tokens, completion_tokens = context_window.count_messages_tokens(messages, model), 0
+        else:
+            usage = completion.get("usage") or {}
+            prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        rate_limiter.settle(lease, prompt_tokens + completion_tokens)
+        usage_ledger.record(user_id, channel, model, prompt_tokens, completion_tokens)
+
+    for i, model in enumerate(route.models):
+        is_last = i == len(route.models) - 1
+        try:
+            # 応答が遅いときは、次のモデルにも同時にリクエストする
+            if constants.CHAT_GPT_HEDGE_ENABLED and not is_last:
+                return resilience.hedge(
+                    request, model, route.models[i + 1], discard
+                )
+            return request(model)
+        except FALLBACK_ERRORS as e:
+            if is_last:
+                raise _to_openai_error(e)
+            logger.warning("Failed to create completion with %s, falling back: %s", model, e)
+
+
+def _create_completion(
+        model: str, messages: List[dict], stream: bool, timeout: float, prompt: CompiledPrompt):
+    options = {}
+    if prompt.temperature is not None:
+        options["temperature"] = prompt.temperature
+    return openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        max_tokens=prompt.max_tokens,
+        stream=stream,
+        request_timeout=timeout,
+        **options
+    )
 
-    messages.extend(replies[-constants.MAX_REPLIES:])
-    logger.info(f"Messages sent to ChatGPT: {messages}")
+
+def _estimate_tokens(messages: List[dict], model: str, max_tokens: int) -> int:
+    return context_window.count_messages_tokens(messages, model) + max_tokens
+
+
+def _close_completion(result: Tuple[str, List[dict], Any, rate_limiter.RateLimitLease]):
+    # ヘッジで使われなかったストリーミングのレスポンスを閉じる
+    completion = result[2]
+    if hasattr(completion, "close"):
+        completion.close()
+
+
+def _to_openai_error(error: Exception) -> Exception:
+    if isinstance(error, OpenAIError):
+        return error
+    if isinstance(error, QuotaExceededError):
+        return OpenAIError(str(error))
+    if isinstance(error, RateLimitExceededError):
+        return OpenAIError("リクエストが混み合っています。しばらく待ってから再度お試しください。")
+    if isinstance(error, RateLimitError):
+        return OpenAIError("レートリミットに達しました。しばらく待ってから再度お試しください。")
+    if isinstance(error, (ServiceUnavailableError, CircuitOpenError)):
+        return OpenAIError("サービスが一時的に利用できません。しばらく待ってから再度お試しください。")
+    if isinstance(error, (openai_error.Timeout, DeadlineExceededError)):
+        return OpenAIError("ChatGPTからの応答がタイムアウトしました。しばらく待ってから再度お試しください。")
+    return error
+
+
+def _prepare_messages(
+        replies: List[dict],
+        prompt: CompiledPrompt,
+        thread_key: str = None,
+        user_id: str = None) -> Tuple[List[dict], List[dict]]:
+    messages = list(prompt.system_messages)
+
+    # 長いスレッドは古いメッセージを要約に置き換える
+    if thread_key and constants.SUMMARY_ENABLED:
+        summary, replies = _compact_replies(thread_key, replies, user_id)
+        if summary:
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"これまでの会話の要約:\n{summary}",
+                }
+            )
+
+    # スレッド履歴のtsなど、OpenAIに不要な項目は送らない
+    replies = [
+        {"role": reply.get("role"), "content": reply.get("content")}
+        for reply in replies
+    ]
+    return messages, replies
+
+
+def _build_messages(
+        system_messages: List[dict], replies: List[dict], model: str, max_tokens: int) -> List[dict]:
+    messages = context_window.build_context(
+        system_messages,
+        replies,
+        model,
+        max_tokens
+    )
+    logger.info("Messages sent to ChatGPT(%s): %s", model, log.summarize(messages))
+    logger.debug("Messages sent to ChatGPT(%s) BODY: %s", model, messages)
+
+    return messages
+
+
+def _compact_replies(thread_key: str, replies: List[dict], user_id: str = None) -> Tuple[str, List[dict]]:
+    history = thread_history.load(thread_key)
+    if history is None:
+        return "", replies
+
+    summary = history.summary
+    replies = _replies_after(replies, history.summarized_until_ts)
+
+    model = constants.DEFAULT_CHAT_GPT_MODEL
+    if context_window.count_messages_tokens(replies, model) <= constants.SUMMARY_TRIGGER_TOKENS:
+        return summary, replies
+
+    # 直近のメッセージはそのまま残し、それより古いメッセージを一度だけ要約する
+    recent_tokens = 0
+    split_position = len(replies)
+    while split_position > 0:
+        reply_tokens = context_window.count_message_tokens(replies[split_position - 1], model)
+        if recent_tokens + reply_tokens > constants.SUMMARY_KEEP_RECENT_TOKENS:
+            break
+        recent_tokens += reply_tokens
+        split_position -= 1
+    # 変更されたメッセージなど、tsのないメッセージは要約しない
+    while split_position > 0 and not replies[split_position - 1].get("ts"):
+        split_position -= 1
+    older_replies = replies[:split_position]
+    if not older_replies:
+        return summary, replies
 
     try:
-        completion = openai.ChatCompletion.create(
-            model=constants.DEFAULT_CHAT_GPT_MODEL,
-            messages=messages,
-            max_tokens=constants.DEFAULT_CHAT_GPT_MAX_TOKENS
+        summary = _summarize_replies(summary, older_replies, user_id, thread_history.channel_of(thread_key))
+    except OpenAIError:
+        logger.warning("Failed to summarize thread: %s", thread_key)
+        return history.summary, replies
+
+    history.summary = summary
+    history.summarized_until_ts = older_replies[-1].get("ts")
+    thread_history.save(history)
+    logger.info("Summarized thread %s until %s", thread_key, history.summarized_until_ts)
+
+    return summary, replies[split_position:]
+
+
+def _replies_after(replies: List[dict], ts: str) -> List[dict]:
+    if not ts:
+        return replies
+    return [
+        reply for reply in replies
+        if not reply.get("ts")
+        or thread_history.ts_order(reply.get("ts")) > thread_history.ts_order(ts)
+    ]
+
+
+@tracing.traced("openai.summary")
+def _summarize_replies(summary: str, replies: List[dict], user_id: str = None, channel: str = None) -> str:
+    # 要約用のモデルのコンテキスト長に収まるように分けて、順に要約を更新する
+    model = constants.SUMMARY_CHAT_GPT_MODEL
+    clients.setup_openai()
+
+    position = 0
+    while position < len(replies):
+        lines = []
+        used_tokens = context_window.count_text_tokens(summary, model)
+        while position < len(replies):
+            line = f'{replies[position].get("role")}: {replies[position].get("content")}'
+            line_tokens = context_window.count_text_tokens(line, model)
+            if lines and used_tokens + line_tokens > constants.SUMMARY_INPUT_TOKEN_BUDGET:
+                break
+            if line_tokens > constants.SUMMARY_INPUT_TOKEN_BUDGET:
+                line = context_window.truncate_text(line, constants.SUMMARY_INPUT_TOKEN_BUDGET, model)
+            lines.append(line)
+            used_tokens += line_tokens
+            position += 1
+
+        content = "\n".join(lines)
+        if summary:
+            content = f"これまでの要約:\n{summary}\n\n続きの会話:\n{content}"
+
+        messages = [
+            {"role": "system", "content": constants.SUMMARY_SYSTEM_ROLE_CONTENT},
+            {"role": "user", "content": content},
+        ]
+        deadline = resilience.Deadline(constants.OPEN_AI_REQUEST_TIMEOUT_SECONDS)
+        lease = None
+        try:
+            lease = rate_limiter.acquire(
+                model,
+                context_window.count_messages_tokens(messages, model) + constants.SUMMARY_MAX_TOKENS,
+                deadline=deadline
+            )
+            completion = resilience.call_with_retry(
+                model,
+                lambda timeout: openai.ChatCompletion.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=constants.SUMMARY_MAX_TOKENS,
+                    request_timeout=timeout
+                ),
+                deadline
+            )
+        except FALLBACK_ERRORS as e:
+            rate_limiter.release(lease)
+            raise OpenAIError(str(e))
+        usage = completion.get("usage") or {}
+        rate_limiter.settle(lease, usage.get("total_tokens", lease.tokens if lease else 0))
+        # 要約もメッセージを送ったユーザの使用量として数える
+        usage_ledger.record(
+            user_id, channel, model, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
         )
-    except RateLimitError:
-        raise OpenAIError("レートリミットに達しました。しばらく待ってから再度お試しください。")
-    except ServiceUnavailableError:
-        raise OpenAIError("サービスが一時的に利用できません。しばらく待ってから再度お試しください。")
+        summary = completion.get("choices")[0].get("message").get("content")
 
-    return completion.get("choices")[0].get("message").get("content")
+    return summary
@@ -0,0 +1,124 @@
+import hashlib
+import threading
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Callable
+
+import constants
+
+if TYPE_CHECKING:
+    import requests
+    from botocore.config import Config
+    from slack_sdk import WebClient
+
+# ウォームコンテナ間で使い回すクライアント。初回利用時に1度だけ生成する
+# 署名の検証に失敗したリクエストなどでSDKを読み込まないよう、importも初回利用時に行う
+# 受け付けの処理でも、重複排除のテーブルとワーカーの呼び出しにはboto3を読み込む。OpenAIとSlackのSDKは読み込まない
+_clients = {}
+_lock = threading.Lock()
+_created_counts = Counter()
+_reused_counts = Counter()
+
+
+def _get_or_create(name: str, factory: Callable[[], Any]) -> Any:
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            client = factory()
+            _clients[name] = client
+            _created_counts[name] += 1
+        else:
+            _reused_counts[name] += 1
+        return client
+
+
+def _boto3_config() -> "Config":
+    from botocore.config import Config
+
+    return Config(
+        tcp_keepalive=True,
+        max_pool_connections=constants.HTTP_MAX_POOL_CONNECTIONS
+    )
+
+
+def dynamodb_resource():
+    def create_resource():
+        import boto3
+
+        return boto3.resource("dynamodb", config=_boto3_config())
+
+    return _get_or_create("dynamodb", create_resource)
+
+
+def lambda_client():
+    def create_client():
+        import boto3
+
+        return boto3.client("lambda", config=_boto3_config())
+
+    return _get_or_create("lambda", create_client)
+
+
+def slack_web_client(token: str = None) -> "WebClient":
+    # 複数のワークスペースに応答するときは、トークンごとに接続を分けたクライアントを使う
+    name = slack_web_client_name(token)
+
+    def create_client() -> "WebClient":
+        import slack_api
+        from slack_sdk import WebClient
+
+        # メソッドごとのレートリミットの中で呼び出し、429のときはRetry-Afterだけ待って再試行する
+        return slack_api.RateLimitedWebClient(
+            WebClient(token or constants.SLACK_BOT_TOKEN, base_url=constants.SLACK_API_BASE_URL)
+        )
+
+    return _get_or_create(name, create_client)
+
+
+def slack_web_client_name(token: str = None) -> str:
+    # トークンそのものを名前にしてログに出さないよう、ハッシュの先頭を使う
+    if not token or token == constants.SLACK_BOT_TOKEN:
+        return "slack"
+    return "slack:" + hashlib.sha256(token.encode()).hexdigest()[:12]
+
+
+def setup_openai():
+    # openaiはモジュール単位で設定するため、セッションを差し替えて接続プールを共有する
+    def create_session() -> "requests.Session":
+        import openai
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=constants.HTTP_MAX_POOL_CONNECTIONS,
+            pool_maxsize=constants.HTTP_MAX_POOL_CONNECTIONS
+        )
+        session.mount("https://", adapter)
+        openai.requestssession = session
+        return session
+
+    return _get_or_create("openai", create_session)
+
+
+def override(name: str, client: Any):
+    # ベンチマークなどでフェイクのクライアントに差し替える
+    with _lock:
+        _clients[name] = client
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            name: {
+                "created": _created_counts[name],
+                "reused": _reused_counts[name],
+            }
+            for name in _clients
+        }
+
+
+def reset():
+    with _lock:
+        _clients.clear()
+        _created_counts.clear()
+        _reused_counts.clear()
@@ -0,0 +1,51 @@
+import re
+from dataclasses import replace
+from typing import Dict, List, Tuple
+
+import constants
+import slack_client
+from dynamo_db_client import DynamoDBClient, UserConfigItem
+from errors import CommandParseError, PermissionDeniedError
+from slack_sdk import WebClient
+
+# コマンドの直後に書いたユーザグループ(<!subteam^S123|@team>)とチャンネル(<#C123|general>)のメンバーを対象にする
+_re_target = re.compile(r'<(!subteam\^|#)([A-Z0-9]+)(?:\|[^>]*)?>\s*')
+
+
+def parse_targets(text: str) -> Tuple[List[Tuple[str, str]], str]:
+    # ("usergroup" or "channel", ID)の一覧と、対象を取り除いた残りのテキストを返す
+    targets = []
+    position = 0
+    while True:
+        match = _re_target.match(text, position)
+        if not match:
+            return targets, text[position:]
+        kind = "usergroup" if match.group(1) == "!subteam^" else "channel"
+        targets.append((kind, match.group(2)))
+        position = match.end()
+
+
+def resolve_user_ids(user_id: str, targets: List[Tuple[str, str]], client: WebClient = None) -> List[str]:
+    if user_id not in constants.ADMIN_USER_IDS:
+        raise PermissionDeniedError("チャンネルやユーザグループへの一括設定は管理者だけが実行できます")
+
+    # メンバーは、コマンドが送られたワークスペースのトークン(client)で取得する
+    user_ids = []
+    for kind, target_id in targets:
+        if kind == "usergroup":
+            user_ids.extend(slack_client.usergroup_members(target_id, client))
+        else:
+            user_ids.extend(slack_client.channel_members(target_id, client))
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        raise CommandParseError("対象のメンバーが見つかりませんでした")
+    return user_ids
+
+
+def apply_user_config(db_client: DynamoDBClient, user_ids: List[str], values: Dict[str, str]):
+    # 他のキーの設定値を消さないように、まとめて読んだ現在の設定に上書きしてまとめて書き込む
+    user_configs = db_client.batch_get_items_from_user_config(user_ids)
+    db_client.batch_put_items_to_user_config([
+        replace(user_configs.get(user_id) or UserConfigItem(user_id), **values)
+        for user_id in user_ids
+    ])
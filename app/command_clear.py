@@ -1,29 +1,45 @@
-from dynamo_db_client import DynamoDBClient, UserConfigItem
+import command_bulk
+from dynamo_db_client import DynamoDBClient
 from errors import CommandParseError, NotImplementedCommandError
+from slack_sdk import WebClient
 
-available_clear_command_keys = ["system_role_content"]
+available_clear_command_keys = ["system_role_content", "model", "response_cache", "max_tokens", "temperature"]
 
 
 class ClearCommand:
-    def __init__(self, text: str, user_id: str) -> None:
+    def __init__(self, text: str, user_id: str, slack_web_client: WebClient = None) -> None:
         split_text = text.split(" ", 1)
-        if len(split_text) < 2:
+        self.targets, keys = command_bulk.parse_targets(split_text[1].strip() if len(split_text) > 1 else "")
+        # スペース区切りで複数のキーをまとめて削除できる
+        self.keys = list(dict.fromkeys(keys.split()))
+        if not self.keys:
             raise CommandParseError(
                 f"キーを指定してください。\n使用可能なキーは{','.join(available_clear_command_keys)}です。"
             )
-        self.key = split_text[1].strip()
         self.user_id = user_id
+        self.slack_web_client = slack_web_client
+        self.user_count = 1
         self.db_client = DynamoDBClient()
 
     def clear_value(self):
-        if self.key == "system_role_content":
-            self._clear_system_role_content()
-        else:
-            raise NotImplementedCommandError(
-                f'clearコマンドで{self.key}のキーは存在しません\n削除可能なキーはsystem_role_contentです。'
-            )
+        for key in self.keys:
+            if key not in available_clear_command_keys:
+                raise NotImplementedCommandError(
+                    f'clearコマンドで{key}のキーは存在しません\n削除可能なキーは{",".join(available_clear_command_keys)}です。'
+                )
+        # 空文字を書き込むのではなく、属性ごと削除する
+        values = {key: None for key in self.keys}
+
+        if self.targets:
+            user_ids = command_bulk.resolve_user_ids(self.user_id, self.targets, self.slack_web_client)
+            command_bulk.apply_user_config(self.db_client, user_ids, values)
+            self.user_count = len(user_ids)
+            return
+
+        self.db_client.update_item_in_user_config(self.user_id, values)
 
-    def _clear_system_role_content(self):
-        self.db_client.put_item_to_user_config(
-            UserConfigItem(self.user_id, "")
-        )
+    def summary(self) -> str:
+        message = "\n".join(f"CLEAR {key}" for key in self.keys)
+        if self.targets:
+            message += f"\n({self.user_count}人の設定を削除しました)"
+        return message
@@ -1,29 +1,45 @@
+from typing import List
+
+import command_bulk
+import constants
+import usage_ledger
 from dynamo_db_client import DynamoDBClient, UserConfigItem
 from errors import CommandParseError, NotImplementedCommandError
+from slack_sdk import WebClient
 
-available_list_command_keys = ["user_config"]
+available_list_command_keys = ["user_config", "usage"]
 
 
 class ListCommand:
-    def __init__(self, text: str, user_id: str):
+    def __init__(self, text: str, user_id: str, slack_web_client: WebClient = None):
         split_text = text.split(" ", 1)
-        if len(split_text) < 2:
+        self.targets, key = command_bulk.parse_targets(split_text[1].strip() if len(split_text) > 1 else "")
+        self.key = key.strip()
+        if not self.key:
             raise CommandParseError(
                 f"キーを指定してください。\n使用可能なキーは{','.join(available_list_command_keys)}です。"
             )
-        self.key = split_text[1].strip()
         self.user_id = user_id
+        self.slack_web_client = slack_web_client
         self.db_client = DynamoDBClient()
 
     def list_key_value(self) -> str:
         message = ""
         if self.key == "user_config":
+            if self.targets:
+                return self.list_user_configs()
+
             user_config = self.list_user_config()
             if not user_config:
                 message = "何も設定されていません"
             else:
                 message = str(user_config)
 
+        elif self.key == "usage":
+            if self.targets:
+                return self.list_usages()
+            return self.list_usage()
+
         else:
             raise NotImplementedCommandError(
                 f"listコマンドで{self.key}のキーは存在しません\n参照可能なキーは{','.join(available_list_command_keys)}です。"
@@ -34,3 +50,84 @@ class ListCommand:
     def list_user_config(self) -> UserConfigItem:
         user_config = self.db_client.get_item_from_user_config(self.user_id)
         return user_config
+
+    def list_user_configs(self) -> str:
+        # メンバーの設定をまとめて読み、1人1行で表示する。全員に通知されないようメンションにはしない
+        user_ids = command_bulk.resolve_user_ids(self.user_id, self.targets, self.slack_web_client)
+        user_configs = self.db_client.batch_get_items_from_user_config(user_ids)
+        configured = [
+            user_configs[user_id] for user_id in user_ids
+            if user_id in user_configs and user_configs[user_id] != UserConfigItem(user_id)
+        ]
+
+        lines = [f"{len(user_ids)}人中{len(configured)}人が設定しています"]
+        for user_config in configured[:constants.COMMAND_LIST_MAX_USERS]:
+            lines.append(
+                f"{user_config.user_id}: model={user_config.model or '-'}"
+                f" response_cache={user_config.response_cache or '-'}"
+                f" max_tokens={user_config.max_tokens or '-'}"
+                f" temperature={'-' if user_config.temperature is None else user_config.temperature}"
+                f" system_role_content={len(user_config.system_role_content or '')}文字"
+            )
+        if len(configured) > constants.COMMAND_LIST_MAX_USERS:
+            lines.append(f"...他{len(configured) - constants.COMMAND_LIST_MAX_USERS}人")
+        return "\n".join(lines)
+
+    def list_usage(self) -> str:
+        # 今日の自分の使用量をモデルごとに表示する
+        models = _usage_models()
+        usages = usage_ledger.get_usages([usage_ledger.usage_key("user", self.user_id, model) for model in models])
+        lines = [f"{usage_ledger.current_bucket()}(UTC)の使用量"]
+        for model in models:
+            usage = usages[usage_ledger.usage_key("user", self.user_id, model)]
+            if not usage.requests:
+                continue
+            line = (f"{model}: {usage.total_tokens:,}トークン"
+                    f"(入力{usage.prompt_tokens:,} 出力{usage.completion_tokens:,}) {usage.requests}回")
+            quota = constants.USAGE_USER_DAILY_TOKEN_QUOTAS.get(model)
+            if quota:
+                line += f" 上限{quota:,}トークン"
+            lines.append(line)
+        if len(lines) == 1:
+            return f"{usage_ledger.current_bucket()}(UTC)はまだ使用していません"
+        return "\n".join(lines)
+
+    def list_usages(self) -> str:
+        # 対象のチャンネルの合計と、使用量の多いメンバーから1人1行で表示する
+        user_ids = command_bulk.resolve_user_ids(self.user_id, self.targets, self.slack_web_client)
+        channels = [target_id for kind, target_id in self.targets if kind == "channel"]
+        models = _usage_models()
+        usages = usage_ledger.get_usages(
+            [usage_ledger.usage_key("user", user_id, model) for user_id in user_ids for model in models]
+            + [usage_ledger.usage_key("channel", channel, model) for channel in channels for model in models]
+        )
+
+        def total(scope: str, scope_id: str) -> usage_ledger.Usage:
+            return sum(
+                (usages[usage_ledger.usage_key(scope, scope_id, model)] for model in models), usage_ledger.Usage()
+            )
+
+        def by_model(scope: str, scope_id: str) -> str:
+            return " ".join(
+                f"{model}={usages[usage_ledger.usage_key(scope, scope_id, model)].total_tokens:,}"
+                for model in models if usages[usage_ledger.usage_key(scope, scope_id, model)].requests
+            )
+
+        lines = [f"{usage_ledger.current_bucket()}(UTC)の使用量"]
+        for channel in channels:
+            usage = total("channel", channel)
+            lines.append(f"<#{channel}>: {usage.total_tokens:,}トークン {usage.requests}回 {by_model('channel', channel)}")
+
+        user_totals = {user_id: total("user", user_id) for user_id in user_ids}
+        used = sorted((u for u in user_ids if user_totals[u].requests), key=lambda u: -user_totals[u].total_tokens)
+        lines.append(f"{len(user_ids)}人中{len(used)}人が使用しています")
+        for user_id in used[:constants.COMMAND_LIST_MAX_USERS]:
+            usage = user_totals[user_id]
+            lines.append(f"{user_id}: {usage.total_tokens:,}トークン {usage.requests}回 {by_model('user', user_id)}")
+        if len(used) > constants.COMMAND_LIST_MAX_USERS:
+            lines.append(f"...他{len(used) - constants.COMMAND_LIST_MAX_USERS}人")
+        return "\n".join(lines)
+
+
+def _usage_models() -> List[str]:
+    return list(constants.CHAT_GPT_MODEL_CONTEXT_WINDOWS)
@@ -1,31 +1,101 @@
-from dynamo_db_client import DynamoDBClient, UserConfigItem
+from typing import Any, Dict
+
+import command_bulk
+import constants
+from dynamo_db_client import DynamoDBClient
 from errors import CommandParseError, NotImplementedCommandError
+from slack_sdk import WebClient
 
-available_set_command_keys = ["system_role_content"]
+available_set_command_keys = ["system_role_content", "model", "response_cache", "max_tokens", "temperature"]
 
 
 class SetCommand:
-    def __init__(self, text: str, user_id: str):
-        split_text = text.split(" ", 2)
-        if len(split_text) < 3:
+    def __init__(self, text: str, user_id: str, slack_web_client: WebClient = None):
+        split_text = text.split(" ", 1)
+        if len(split_text) < 2:
             raise CommandParseError(
                 f"キーまたは設定する値を指定してください。\n使用可能なキーは{','.join(available_set_command_keys)}です。"
             )
 
-        self.key = split_text[1].strip()
-        self.value = split_text[2].strip()
+        self.targets, key_values = command_bulk.parse_targets(split_text[1].strip())
+        self.values = _parse_key_values(key_values)
         self.user_id = user_id
+        self.slack_web_client = slack_web_client
+        self.user_count = 1
         self.db_client = DynamoDBClient()
 
     def set_key_value(self):
-        if self.key == "system_role_content":
-            self._put_system_role_content()
-        else:
+        values = {key: self._parse_value(key, value) for key, value in self.values.items()}
+
+        if self.targets:
+            user_ids = command_bulk.resolve_user_ids(self.user_id, self.targets, self.slack_web_client)
+            command_bulk.apply_user_config(self.db_client, user_ids, values)
+            self.user_count = len(user_ids)
+            return
+
+        # 指定したキーだけを書き換えるため、現在の設定を読む必要はない
+        self.db_client.update_item_in_user_config(self.user_id, values)
+
+    def summary(self) -> str:
+        message = "\n".join(f"SET {key}: {value}" for key, value in self.values.items())
+        if self.targets:
+            message += f"\n({self.user_count}人に設定しました)"
+        return message
+
+    def _parse_value(self, key: str, value: str) -> Any:
+        if key not in available_set_command_keys:
             raise NotImplementedCommandError(
-                f"setコマンドで{self.key}のキーは使用できません\n使用可能なキーは{','.join(available_set_command_keys)}です。"
+                f"setコマンドで{key}のキーは使用できません\n使用可能なキーは{','.join(available_set_command_keys)}です。"
+            )
+        if key == "model" and value not in constants.CHAT_GPT_MODEL_CONTEXT_WINDOWS:
+            raise CommandParseError(
+                f"{value}のモデルは使用できません\n使用可能なモデルは{','.join(constants.CHAT_GPT_MODEL_CONTEXT_WINDOWS)}です。"
+            )
+        if key == "response_cache" and value not in ["on", "off"]:
+            raise CommandParseError(
+                "response_cacheにはonまたはoffを指定してください"
+            )
+        if key == "max_tokens":
+            if not value.isdigit() or not 1 <= int(value) <= constants.USER_CONFIG_MAX_TOKENS_LIMIT:
+                raise CommandParseError(
+                    f"max_tokensには1から{constants.USER_CONFIG_MAX_TOKENS_LIMIT}までの整数を指定してください"
+                )
+            return int(value)
+        if key == "temperature":
+            try:
+                temperature = float(value)
+            except ValueError:
+                temperature = None
+            if temperature is None or not 0 <= temperature <= 2:
+                raise CommandParseError(
+                    "temperatureには0から2までの数値を指定してください"
+                )
+            return temperature
+        return value
+
+
+def _parse_key_values(text: str) -> Dict[str, str]:
+    # "キー 値"を1行ずつ書くと複数のキーをまとめて設定できる
+    # system_role_contentは複数行の値を持てるため、それ以降の行はキーで始まっていてもすべて値として扱う
+    values = {}
+    lines = text.split("\n")
+    for index, line in enumerate(lines):
+        if not line.strip():
+            continue
+        key, _, rest = line.strip().partition(" ")
+        if key == "system_role_content":
+            values[key] = "\n".join([rest] + lines[index + 1:])
+            break
+        if values and key not in available_set_command_keys:
+            raise CommandParseError(
+                "複数のキーを設定するときは、1行に1つずつ「キー 値」を指定してください。\n"
+                "複数行のsystem_role_contentは最後に指定してください。"
             )
+        values[key] = rest
 
-    def _put_system_role_content(self):
-        self.db_client.put_item_to_user_config(
-            UserConfigItem(self.user_id, self.value)
+    values = {key: value.strip() for key, value in values.items()}
+    if not values or not all(values.values()):
+        raise CommandParseError(
+            f"キーまたは設定する値を指定してください。\n使用可能なキーは{','.join(available_set_command_keys)}です。"
         )
+    return values
@@ -1,14 +1,184 @@
 import os
 
 USER_CONFIG_TABLE = os.environ.get("USER_CONFIG_TABLE")
+EVENT_DEDUPE_TABLE = os.environ.get("EVENT_DEDUPE_TABLE")
+THREAD_HISTORY_TABLE = os.environ.get("THREAD_HISTORY_TABLE")
+RATE_LIMIT_TABLE = os.environ.get("RATE_LIMIT_TABLE")
+RESPONSE_CACHE_TABLE = os.environ.get("RESPONSE_CACHE_TABLE")
+GENERATION_TABLE = os.environ.get("GENERATION_TABLE")
+USAGE_TABLE = os.environ.get("USAGE_TABLE")
+# 複数のワークスペースに応答するときの、ワークスペースごとのトークンとアプリごとの署名シークレット
+INSTALLATION_TABLE = os.environ.get("INSTALLATION_TABLE")
 OPEN_AI_API_KEY = os.environ.get("OPEN_AI_API_KEY")
 SLACK_BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
 SLACK_SIGNING_SECRET = os.environ.get("SLACK_SIGNING_SECRET").encode()
+# 署名シークレットのローテーション中は、古いシークレットで署名されたリクエストも受け付ける
+SLACK_SIGNING_SECRETS = [SLACK_SIGNING_SECRET] + [
+    secret.encode() for secret in os.environ.get("SLACK_PREVIOUS_SIGNING_SECRETS", "").split(",") if secret
+]
+# 署名シークレットをテーブルに登録したアプリのID(カンマ区切り)
+# 署名を検証する前のリクエストでは、これ以外のアプリIDでテーブルを読まない
+SLACK_APP_IDS = frozenset(
+    app_id.strip() for app_id in os.environ.get("SLACK_APP_IDS", "").split(",") if app_id.strip()
+)
+# Socket Modeのワーカーだけで使うApp-Level Token(xapp-)
+SLACK_APP_TOKEN = os.environ.get("SLACK_APP_TOKEN")
+SLACK_API_BASE_URL = os.environ.get("SLACK_API_BASE_URL", "https://slack.com/api/")
+ASYNC_WORKER_ENABLED = os.environ.get("ASYNC_WORKER_ENABLED", "true").lower() == "true"
+WORKER_FUNCTION_NAME = os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+HTTP_MAX_POOL_CONNECTIONS = 10
+PREFETCH_MAX_WORKERS = 3
+USER_CONFIG_CACHE_SIZE = 1024
+INSTALLATION_CACHE_SIZE = 256
+INSTALLATION_CACHE_TTL_SECONDS = 60 * 5
+USER_CONFIG_CACHE_TTL_SECONDS = 60
+USER_CONFIG_CACHE_MAX_AGE_SECONDS = 60 * 60
+# BatchGetItemは100件、BatchWriteItemは25件までを1回のリクエストで送れる
+DYNAMODB_BATCH_GET_SIZE = 100
+DYNAMODB_BATCH_WRITE_SIZE = 25
+DYNAMODB_BATCH_MAX_ATTEMPTS = 8
+DYNAMODB_BATCH_BASE_BACKOFF_SECONDS = 0.05
+DYNAMODB_BATCH_MAX_BACKOFF_SECONDS = 2
+# チャンネルやユーザグループのメンバーに一括で設定できる管理者のユーザID(カンマ区切り)
+ADMIN_USER_IDS = {user_id.strip() for user_id in os.environ.get("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+SLACK_MEMBERS_PAGE_LIMIT = 1000
+COMMAND_LIST_MAX_USERS = 100
+# Socket Modeのワーカーで同時に処理するイベントの数と、1人のユーザが同時に使える数
+SOCKET_MODE_MAX_WORKERS = int(os.environ.get("SOCKET_MODE_MAX_WORKERS", "8"))
+SOCKET_MODE_MAX_EVENTS_PER_USER = int(os.environ.get("SOCKET_MODE_MAX_EVENTS_PER_USER", "2"))
+# 処理待ちがこの数を超えたらackせず、Slackに再送させる
+SOCKET_MODE_MAX_PENDING_EVENTS = int(os.environ.get("SOCKET_MODE_MAX_PENDING_EVENTS", "100"))
+SOCKET_MODE_DRAIN_TIMEOUT_SECONDS = 60
+# 同じスレッドで新しいメッセージが来たら、古いメッセージへの生成を取り消す
+GENERATION_ENABLED = os.environ.get("GENERATION_ENABLED", "true").lower() == "true"
+GENERATION_TTL_SECONDS = 60 * 60 * 24
+# 別のコンテナで新しい生成が始まっていないかを確認する間隔
+GENERATION_CHECK_INTERVAL_SECONDS = 1.0
+# 前のメッセージからこの秒数以内に続けて送られたら、少し待って最後のメッセージだけで生成する
+GENERATION_COALESCE_WINDOW_SECONDS = 5
+GENERATION_COALESCE_WAIT_SECONDS = 1.0
+USAGE_ENABLED = os.environ.get("USAGE_ENABLED", "true").lower() == "true"
+# 1人のユーザが1日(UTC)に使えるモデルごとのトークン数。0は無制限
+USAGE_USER_DAILY_TOKEN_QUOTAS = {
+    "gpt-4": int(os.environ.get("USAGE_USER_DAILY_GPT4_TOKEN_QUOTA") or 0),
+    "gpt-4-32k": int(os.environ.get("USAGE_USER_DAILY_GPT4_32K_TOKEN_QUOTA") or 0),
+}
+# 使用量はコンテナ内で集計し、一定の間隔でまとめて書き込む
+USAGE_FLUSH_INTERVAL_SECONDS = 30
+USAGE_FLUSH_MAX_KEYS = 100
+USAGE_CACHE_SIZE = 1024
+USAGE_CACHE_TTL_SECONDS = 60
+USAGE_TTL_SECONDS = 60 * 60 * 24 * 400
+THREAD_HISTORY_CACHE_SIZE = 256
+THREAD_HISTORY_TTL_SECONDS = 60 * 60 * 24 * 7
+THREAD_HISTORY_MAX_MESSAGES = 200
+EVENT_DEDUPE_TTL_SECONDS = 60 * 60
+EVENT_DEDUPE_CACHE_SIZE = 1024
 SLACK_PROGRESS_MESSAGE = 'Generating... :ultra-fast-parrot:'
+SLACK_EMPTY_ANSWER_MESSAGE = 'ChatGPTから空の応答が返ってきました。質問を変えて、もう一度お試しください。'
 SLACK_MAX_EDIT_BYTE_SIZE = 3000
+SLACK_STREAM_UPDATE_INTERVAL_SECONDS = 1.0
+SLACK_STREAM_UPDATE_BYTE_SIZE = 500
+SLACK_RATE_LIMIT_ENABLED = os.environ.get("SLACK_RATE_LIMIT_ENABLED", "true").lower() == "true"
+# SlackのWeb APIのTierごとの1分あたりの呼び出し回数 https://api.slack.com/docs/rate-limits
+SLACK_RATE_TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+SLACK_METHOD_TIERS = {
+    "conversations.replies": 3,
+    "conversations.members": 4,
+    "usergroups.users.list": 2,
+    "chat.update": 3,
+    "chat.delete": 3,
+}
+# chat.postMessageはTierではなく、1つのチャンネルに1秒あたり1件まで
+SLACK_CHANNEL_POSTS_PER_SECOND = 1
+SLACK_CHANNEL_POST_BURST = 3
+SLACK_RATE_LIMIT_MAX_WAIT_SECONDS = 10
+SLACK_RETRY_MAX_ATTEMPTS = 3
 DEFAULT_CHAT_GPT_MODEL = "gpt-4"
+CHEAP_CHAT_GPT_MODEL = "gpt-3.5-turbo"
+CHAT_GPT_FALLBACK_MODELS = ["gpt-4", "gpt-3.5-turbo"]
+OPEN_AI_REQUEST_TIMEOUT_SECONDS = 120
+CHAT_GPT_DEFAULT_DEADLINE_SECONDS = 300
+LAMBDA_DEADLINE_MARGIN_SECONDS = 5
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_BACKOFF_SECONDS = 0.5
+RETRY_MAX_BACKOFF_SECONDS = 20
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_TIMEOUT_SECONDS = 30
+CHAT_GPT_HEDGE_ENABLED = os.environ.get("CHAT_GPT_HEDGE_ENABLED", "false").lower() == "true"
+CHAT_GPT_HEDGE_PERCENTILE = 95
+CHAT_GPT_HEDGE_MIN_SAMPLES = 20
+CHAT_GPT_HEDGE_MAX_WORKERS = 4
+CHAT_GPT_LATENCY_WINDOW_SIZE = 100
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# OpenAIのOrganizationに設定されたモデルごとのレートリミット。(1分あたりのトークン数, 1分あたりのリクエスト数)
+CHAT_GPT_RATE_LIMITS = {
+    "gpt-4": (40000, 200),
+    "gpt-4-32k": (80000, 200),
+    "gpt-3.5-turbo": (90000, 3500),
+    "gpt-3.5-turbo-16k": (180000, 3500),
+}
+RATE_LIMIT_WINDOW_SECONDS = 60
+# 1人のユーザ、1つのチャンネルが使えるモデルのレートリミットの割合
+RATE_LIMIT_USER_SHARE = 0.25
+RATE_LIMIT_CHANNEL_SHARE = 0.5
+RATE_LIMIT_MAX_WAIT_SECONDS = 30
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL_SECONDS = 60 * 60 * 24
+# 言い回しが違うだけの質問にも答えるため、埋め込みベクトルの類似度で検索する(numpyが必要)
+RESPONSE_CACHE_SEMANTIC_ENABLED = os.environ.get("RESPONSE_CACHE_SEMANTIC_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_EMBEDDING_MODEL = "text-embedding-ada-002"
+RESPONSE_CACHE_SIMILARITY_THRESHOLD = 0.95
+RESPONSE_CACHE_INDEX_SIZE = 1024
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "true").lower() == "true"
+TRACING_NAMESPACE = "ChatGPTSlack"
+TRACING_SERVICE_NAME = "chat-gpt-slack"
+# プロファイルする呼び出しの割合(0から1)
+TRACING_PROFILE_SAMPLE_RATE = float(os.environ.get("TRACING_PROFILE_SAMPLE_RATE", "0"))
+TRACING_PROFILE_TOP_N = 20
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "text"または"json"
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+# DEBUGレベルで出力するリクエストの割合(0から1)
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "0"))
+LOG_PAYLOAD_MAX_CHARS = 1000
+MODEL_ROUTER_TINY_PROMPT_TOKENS = 16
+MODEL_ROUTER_SHORT_PROMPT_TOKENS = 64
+MODEL_ROUTER_SHORT_THREAD_LENGTH = 1
 DEFAULT_CHAT_GPT_MAX_TOKENS = 1000
-MAX_REPLIES = 7
+# setコマンドでユーザごとに設定できるmax_tokensの上限
+USER_CONFIG_MAX_TOKENS_LIMIT = 4000
+CHAT_GPT_STREAM_ENABLED = os.environ.get("CHAT_GPT_STREAM_ENABLED", "true").lower() == "true"
+CHAT_GPT_MODEL_CONTEXT_WINDOWS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+}
+DEFAULT_CHAT_GPT_CONTEXT_WINDOW = 4096
+# 1,000トークンあたりの料金(USD)。(プロンプト, 生成)
+CHAT_GPT_MODEL_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+}
+# 0の場合はモデルのコンテキスト長からmax_tokensを引いた値を上限とする
+CHAT_GPT_PROMPT_TOKEN_BUDGET = int(os.environ.get("CHAT_GPT_PROMPT_TOKEN_BUDGET", "0"))
+TOKEN_COUNT_CACHE_SIZE = 4096
+SUMMARY_ENABLED = os.environ.get("SUMMARY_ENABLED", "true").lower() == "true"
+SUMMARY_CHAT_GPT_MODEL = "gpt-3.5-turbo"
+SUMMARY_MAX_TOKENS = 500
+SUMMARY_TRIGGER_TOKENS = 3000
+SUMMARY_KEEP_RECENT_TOKENS = 1500
+SUMMARY_INPUT_TOKEN_BUDGET = 2500
+SUMMARY_SYSTEM_ROLE_CONTENT = """
+以下の会話を、続きの会話で参照できるように要約してください。
+これまでの要約がある場合は、それも含めて1つの要約にまとめてください。
+質問の意図、決まったこと、固有名詞や数値などの重要な情報は省略しないでください。
+""".strip()
+SLACK_REPLIES_PAGE_LIMIT = 200
 CHAT_GPT_SYSTEM_ROLE_CONTENT = """
 """.strip()
 # CHAT_GPT_SYSTEM_ROLE_CONTENT = """
@@ -20,3 +190,4 @@ CHAT_GPT_SYSTEM_ROLE_CONTENT = """
 # """
 
 RE_MENTION_PATTERN = r'<@.*?>\s*'
+RE_MODEL_OVERRIDE_PATTERN = r'^--model[= ](\S+)\s*'
@@ -0,0 +1,117 @@
+import math
+from functools import lru_cache
+from typing import List
+
+import constants
+import utils
+from cache import TTLCache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = utils.setup_logger(__name__)
+
+# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY_PRIMING = 3
+
+# (model, content) -> トークン数。同じメッセージは一度だけ数える
+_token_count_cache = TTLCache(max_size=constants.TOKEN_COUNT_CACHE_SIZE)
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # エンコーディングのファイルを取得できないときは概算で数える
+        logger.warning("Cannot load tiktoken encoding for %s, falling back to estimate", model)
+        return None
+
+
+def count_text_tokens(text: str, model: str) -> int:
+    if not text:
+        return 0
+
+    key = (model, text)
+    count = _token_count_cache.get(key)
+    if count is None:
+        encoding = _encoding(model)
+        if encoding:
+            count = len(encoding.encode(text))
+        else:
+            count = math.ceil(len(text.encode("utf-8")) / 3)
+        _token_count_cache.set(key, count)
+    return count
+
+
+def count_message_tokens(message: dict, model: str) -> int:
+    return TOKENS_PER_MESSAGE \
+        + count_text_tokens(message.get("role"), model) \
+        + count_text_tokens(message.get("content"), model)
+
+
+def count_messages_tokens(messages: List[dict], model: str) -> int:
+    return TOKENS_PER_REPLY_PRIMING + sum(
+        count_message_tokens(message, model) for message in messages
+    )
+
+
+def prompt_token_budget(model: str, max_tokens: int) -> int:
+    context_window = constants.CHAT_GPT_MODEL_CONTEXT_WINDOWS.get(
+        model, constants.DEFAULT_CHAT_GPT_CONTEXT_WINDOW
+    )
+    budget = context_window - max_tokens
+    if constants.CHAT_GPT_PROMPT_TOKEN_BUDGET:
+        budget = min(budget, constants.CHAT_GPT_PROMPT_TOKEN_BUDGET)
+    return budget
+
+
+def truncate_text(text: str, max_text_tokens: int, model: str) -> str:
+    encoding = _encoding(model)
+    if encoding:
+        return encoding.decode(encoding.encode(text)[:max_text_tokens])
+    return utils.separate_text_with_chunk_size(text, max_text_tokens * 3)[0]
+
+
+def build_context(
+        system_messages: List[dict],
+        replies: List[dict],
+        model: str,
+        max_tokens: int) -> List[dict]:
+    # システムプロンプトは必ず残し、残りの予算に収まるだけ新しいメッセージから詰める
+    budget = prompt_token_budget(model, max_tokens)
+    used_tokens = count_messages_tokens(system_messages, model)
+
+    selected = []
+    for reply in reversed(replies):
+        reply_tokens = count_message_tokens(reply, model)
+        if used_tokens + reply_tokens > budget:
+            break
+        selected.append(reply)
+        used_tokens += reply_tokens
+
+    # 最新のメッセージだけで予算を超えるときは、送れる長さまで切り詰める
+    if not selected and replies:
+        newest = replies[-1]
+        remain_tokens = budget - used_tokens - count_message_tokens(
+            {"role": newest.get("role"), "content": ""}, model
+        )
+        if remain_tokens > 0:
+            selected.append({
+                **newest,
+                "content": truncate_text(newest.get("content"), remain_tokens, model),
+            })
+            used_tokens = budget
+
+    logger.info(
+        "Context window: %d/%d messages, %d/%d tokens",
+        len(selected), len(replies), used_tokens, budget
+    )
+    return system_messages + list(reversed(selected))
@@ -1,42 +1,528 @@
-from dataclasses import asdict, dataclass
+import random
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field, fields
+from decimal import Decimal
+from typing import Any, Dict, List, Tuple
 
-import boto3
+import clients
 import constants
+import log
+import tracing
 import utils
+from botocore.exceptions import ClientError
+from cache import TTLCache
+from errors import UnexpectedError
 
 logger = utils.setup_logger(__name__)
 
+# user_id -> (UserConfigItem or None, version, 確認した時刻)。設定がないユーザもNoneとしてキャッシュする
+_user_config_cache = TTLCache(
+    max_size=constants.USER_CONFIG_CACHE_SIZE,
+    ttl_seconds=constants.USER_CONFIG_CACHE_MAX_AGE_SECONDS
+)
+user_config_cache_stats = Counter()
+
 
 @dataclass
 class UserConfigItem:
+    # 設定されていないキーはNone。DynamoDBには設定されたキーだけを属性として保存する
     user_id: str
-    system_role_content: str
+    system_role_content: str = None
+    model: str = None
+    # "off"の場合は応答キャッシュを使わない
+    response_cache: str = None
+    # Noneの場合はDEFAULT_CHAT_GPT_MAX_TOKENSとOpenAIの既定のtemperatureを使う
+    max_tokens: int = None
+    temperature: float = None
 
     def __str__(self) -> str:
-        return f'USER_ID: {self.user_id}\nSYSTEM_ROLE_CONTENT: {self.system_role_content}'
+        return "\n".join(
+            f"{f.name.upper()}: {'' if getattr(self, f.name) is None else getattr(self, f.name)}"
+            for f in fields(self)
+        )
+
+
+# 読み取りではユーザ設定の属性とversionだけを返させる
+_USER_CONFIG_ATTRIBUTE_NAMES = {
+    f"#{name}": name for name in [f.name for f in fields(UserConfigItem)] + ["version"]
+}
+_USER_CONFIG_PROJECTION = ", ".join(_USER_CONFIG_ATTRIBUTE_NAMES)
+
+
+@dataclass
+class ThreadHistoryItem:
+    thread_key: str
+    # {"ts", "role", "content"}の形式に変換済みのメッセージ
+    messages: List[dict] = field(default_factory=list)
+    # summarized_until_tsまでのメッセージを要約したもの
+    summary: str = ""
+    summarized_until_ts: str = None
+    # 要約の項目の期限(UNIX時刻)。メッセージの項目はこれより後に期限切れになる
+    expires_at: int = None
+
+
+# スレッドごとに、要約の項目とメッセージごとの項目(tsがソートキー)を保存する
+_THREAD_HISTORY_SUMMARY_TS = "summary"
+_THREAD_HISTORY_KEY_NAMES = {"thread_key", "expires_at"}
 
 
 class DynamoDBClient:
     def __init__(self):
-        dynamodb = boto3.resource('dynamodb')
-        self.user_config_table = dynamodb.Table(constants.USER_CONFIG_TABLE)
+        self.dynamodb = clients.dynamodb_resource()
+        self.user_config_table = self.dynamodb.Table(constants.USER_CONFIG_TABLE)
+
+    @tracing.traced("dynamodb.update_item_in_user_config")
+    def update_item_in_user_config(self, user_id: str, values: Dict[str, Any]) -> UserConfigItem:
+        # 指定したキーだけを書き換え、値がNoneのキーは属性ごと削除する。他のキーは読まずにそのまま残る
+        # versionは他のウォームコンテナがキャッシュの鮮度を確認するために使う
+        attribute_names = {"#version": "version"}
+        attribute_values = {":version": time.time_ns() // 1_000_000}
+        set_actions = ["#version = :version"]
+        remove_actions = []
+        for i, (key, value) in enumerate(values.items()):
+            attribute_names[f"#k{i}"] = key
+            if value is None:
+                remove_actions.append(f"#k{i}")
+            else:
+                attribute_values[f":v{i}"] = _to_dynamodb_value(value)
+                set_actions.append(f"#k{i} = :v{i}")
+        update_expression = "SET " + ", ".join(set_actions)
+        if remove_actions:
+            update_expression += " REMOVE " + ", ".join(remove_actions)
 
-    def put_item_to_user_config(self, item: UserConfigItem):
-        self.user_config_table.put_item(
-            Item=asdict(item)
+        response = self.user_config_table.update_item(
+            Key={
+                "user_id": user_id
+            },
+            UpdateExpression=update_expression,
+            ExpressionAttributeNames=attribute_names,
+            ExpressionAttributeValues=attribute_values,
+            ReturnValues="ALL_NEW"
         )
-        logger.info(f"PUT Item to USER_CONFIG: {item}")
+        user_config_cache_stats["invalidated"] += 1
+        logger.info("UPDATE Item in USER_CONFIG: %s", log.summarize({"user_id": user_id, **values}))
+        return _cache_user_config(response["Attributes"])
 
+    @tracing.traced("dynamodb.get_item_from_user_config")
     def get_item_from_user_config(self, user_id: str) -> UserConfigItem:
+        cached = _user_config_cache.get(user_id)
+        if cached:
+            item, version, checked_at = cached
+            if time.monotonic() - checked_at < constants.USER_CONFIG_CACHE_TTL_SECONDS:
+                user_config_cache_stats["hit"] += 1
+                tracing.incr("user_config_cache.hit")
+                return item
+
+            # TTLが切れたらversionだけを読み、変わっていなければキャッシュを使い続ける
+            if self._get_version_from_user_config(user_id) == version:
+                _user_config_cache.set(user_id, (item, version, time.monotonic()))
+                user_config_cache_stats["revalidated"] += 1
+                tracing.incr("user_config_cache.revalidated")
+                return item
+
+        user_config_cache_stats["miss"] += 1
+        tracing.incr("user_config_cache.miss")
         response = self.user_config_table.get_item(
             Key={
                 "user_id": user_id
-            }
+            },
+            ProjectionExpression=_USER_CONFIG_PROJECTION,
+            ExpressionAttributeNames=_USER_CONFIG_ATTRIBUTE_NAMES
         )
         item = response.get("Item")
         if not item:
+            _user_config_cache.set(user_id, (None, None, time.monotonic()))
+            return None
+
+        return _cache_user_config(item)
+
+    @tracing.traced("dynamodb.batch_put_items_to_user_config")
+    def batch_put_items_to_user_config(self, items: List[UserConfigItem]):
+        # 同じキーを1回のBatchWriteItemに含めるとエラーになるため、ユーザごとに最後の1件だけを書き込む
+        items = list({item.user_id: item for item in items}.values())
+        version = time.time_ns() // 1_000_000
+        self._batch_write_items(constants.USER_CONFIG_TABLE, [
+            {"PutRequest": {"Item": {**_to_dynamodb_item(item), "version": version}}}
+            for item in items
+        ])
+
+        checked_at = time.monotonic()
+        for item in items:
+            _user_config_cache.set(item.user_id, (item, version, checked_at))
+        user_config_cache_stats["invalidated"] += len(items)
+        logger.info("BATCH PUT %d Items to USER_CONFIG", len(items))
+
+    @tracing.traced("dynamodb.batch_get_items_from_user_config")
+    def batch_get_items_from_user_config(self, user_ids: List[str]) -> Dict[str, UserConfigItem]:
+        # 一括で変更する前に読むため、キャッシュは使わずに最新の設定を読み、キャッシュも更新する
+        user_ids = list(dict.fromkeys(user_ids))
+        items = self._batch_get_items(
+            constants.USER_CONFIG_TABLE,
+            [{"user_id": user_id} for user_id in user_ids],
+            ProjectionExpression=_USER_CONFIG_PROJECTION,
+            ExpressionAttributeNames=_USER_CONFIG_ATTRIBUTE_NAMES
+        )
+        user_configs = {}
+        for item in items:
+            user_config = _cache_user_config(item)
+            user_configs[user_config.user_id] = user_config
+
+        checked_at = time.monotonic()
+        for user_id in user_ids:
+            if user_id not in user_configs:
+                _user_config_cache.set(user_id, (None, None, checked_at))
+        return user_configs
+
+    def _batch_get_items(self, table_name: str, keys: List[dict], **options) -> List[dict]:
+        items = []
+        attempt = 0
+        while keys:
+            unprocessed = []
+            for chunk in _chunks(keys, constants.DYNAMODB_BATCH_GET_SIZE):
+                response = self.dynamodb.batch_get_item(RequestItems={table_name: {"Keys": chunk, **options}})
+                items.extend(response.get("Responses", {}).get(table_name, []))
+                unprocessed.extend(response.get("UnprocessedKeys", {}).get(table_name, {}).get("Keys", []))
+            # スループットを超えた分はUnprocessedKeysとして返る。全チャンクの分をまとめて、バックオフしてから送り直す
+            keys = unprocessed
+            if keys:
+                attempt = _wait_for_unprocessed_items("BatchGetItem", attempt)
+        return items
+
+    def _batch_write_items(self, table_name: str, requests: List[dict]):
+        attempt = 0
+        while requests:
+            unprocessed = []
+            for chunk in _chunks(requests, constants.DYNAMODB_BATCH_WRITE_SIZE):
+                response = self.dynamodb.batch_write_item(RequestItems={table_name: chunk})
+                unprocessed.extend(response.get("UnprocessedItems", {}).get(table_name, []))
+            requests = unprocessed
+            if requests:
+                attempt = _wait_for_unprocessed_items("BatchWriteItem", attempt)
+
+    @tracing.traced("dynamodb.get_version_from_user_config")
+    def _get_version_from_user_config(self, user_id: str) -> int:
+        response = self.user_config_table.get_item(
+            Key={
+                "user_id": user_id
+            },
+            ProjectionExpression="#version",
+            ExpressionAttributeNames={"#version": "version"}
+        )
+        item = response.get("Item")
+        if not item or item.get("version") is None:
             return None
-        return UserConfigItem(
-            item.get("user_id"),
-            item.get("system_role_content")
+        return int(item.get("version"))
+
+    @tracing.traced("dynamodb.batch_write_items_to_thread_history")
+    def batch_write_items_to_thread_history(
+            self,
+            item: ThreadHistoryItem,
+            messages: List[dict],
+            deleted_ts: List[str],
+            put_summary: bool):
+        # メッセージの項目には、要約の項目より後の期限を付ける
+        expires_at = max(item.expires_at or 0, int(time.time()) + constants.THREAD_HISTORY_TTL_SECONDS)
+        requests = [
+            {"PutRequest": {"Item": {**message, "thread_key": item.thread_key, "expires_at": expires_at}}}
+            for message in messages
+        ]
+        requests.extend(
+            {"DeleteRequest": {"Key": {"thread_key": item.thread_key, "ts": ts}}}
+            for ts in deleted_ts
+        )
+        if put_summary:
+            requests.append({"PutRequest": {"Item": {
+                "thread_key": item.thread_key,
+                "ts": _THREAD_HISTORY_SUMMARY_TS,
+                "summary": item.summary,
+                "summarized_until_ts": item.summarized_until_ts,
+                "expires_at": item.expires_at,
+            }}})
+        self._batch_write_items(constants.THREAD_HISTORY_TABLE, requests)
+
+    @tracing.traced("dynamodb.query_items_from_thread_history")
+    def query_items_from_thread_history(self, thread_key: str) -> ThreadHistoryItem:
+        thread_history_table = self.dynamodb.Table(constants.THREAD_HISTORY_TABLE)
+        items = []
+        options = {}
+        while True:
+            response = thread_history_table.query(
+                KeyConditionExpression="#thread_key = :thread_key",
+                ExpressionAttributeNames={"#thread_key": "thread_key"},
+                ExpressionAttributeValues={":thread_key": thread_key},
+                **options
+            )
+            items.extend(response.get("Items", []))
+            if not response.get("LastEvaluatedKey"):
+                break
+            options = {"ExclusiveStartKey": response["LastEvaluatedKey"]}
+
+        # TTLによる削除は遅れることがあるため、期限切れの項目は読まなかったものとして扱う
+        now = time.time()
+        items = [item for item in items if item.get("expires_at") is None or int(item["expires_at"]) > now]
+        summary = next((item for item in items if item.get("ts") == _THREAD_HISTORY_SUMMARY_TS), None)
+        if summary is None:
+            return None
+        return ThreadHistoryItem(
+            thread_key,
+            [
+                {key: value for key, value in item.items() if key not in _THREAD_HISTORY_KEY_NAMES}
+                for item in items if item.get("ts") != _THREAD_HISTORY_SUMMARY_TS
+            ],
+            summary.get("summary", ""),
+            summary.get("summarized_until_ts"),
+            int(summary["expires_at"]) if summary.get("expires_at") is not None else None
+        )
+
+    @tracing.traced("dynamodb.claim_item_in_event_dedupe")
+    def claim_item_in_event_dedupe(self, event_key: str) -> bool:
+        # 条件付き書き込みで、同じイベントを処理できるのは最初の1回だけにする
+        event_dedupe_table = self.dynamodb.Table(constants.EVENT_DEDUPE_TABLE)
+        try:
+            event_dedupe_table.put_item(
+                Item={
+                    "event_key": event_key,
+                    "expires_at": int(time.time()) + constants.EVENT_DEDUPE_TTL_SECONDS,
+                },
+                ConditionExpression="attribute_not_exists(event_key)"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    @tracing.traced("dynamodb.delete_item_from_event_dedupe")
+    def delete_item_from_event_dedupe(self, event_key: str):
+        event_dedupe_table = self.dynamodb.Table(constants.EVENT_DEDUPE_TABLE)
+        event_dedupe_table.delete_item(
+            Key={
+                "event_key": event_key
+            }
         )
+
+    @tracing.traced("dynamodb.consume_item_in_rate_limit")
+    def consume_item_in_rate_limit(
+            self,
+            bucket_key: str,
+            tokens: int,
+            token_limit: int,
+            request_limit: int) -> bool:
+        # アトミックカウンタに加算し、上限を超える場合は条件付き書き込みで弾く
+        rate_limit_table = self.dynamodb.Table(constants.RATE_LIMIT_TABLE)
+        try:
+            rate_limit_table.update_item(
+                Key={
+                    "bucket_key": bucket_key
+                },
+                UpdateExpression="ADD #tokens :tokens, #requests :one SET expires_at = :expires_at",
+                ConditionExpression="(attribute_not_exists(#tokens) OR #tokens <= :max_tokens)"
+                " AND (attribute_not_exists(#requests) OR #requests <= :max_requests)",
+                ExpressionAttributeNames={"#tokens": "tokens", "#requests": "requests"},
+                ExpressionAttributeValues={
+                    ":tokens": tokens,
+                    ":one": 1,
+                    ":max_tokens": token_limit - tokens,
+                    ":max_requests": request_limit - 1,
+                    ":expires_at": int(time.time()) + constants.RATE_LIMIT_WINDOW_SECONDS * 2,
+                }
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    @tracing.traced("dynamodb.refund_item_in_rate_limit")
+    def refund_item_in_rate_limit(self, bucket_key: str, tokens: int, requests: int):
+        # 期限切れで消えたウィンドウは作り直さない
+        rate_limit_table = self.dynamodb.Table(constants.RATE_LIMIT_TABLE)
+        try:
+            rate_limit_table.update_item(
+                Key={
+                    "bucket_key": bucket_key
+                },
+                UpdateExpression="ADD #tokens :tokens, #requests :requests",
+                ConditionExpression="attribute_exists(bucket_key)",
+                ExpressionAttributeNames={"#tokens": "tokens", "#requests": "requests"},
+                ExpressionAttributeValues={
+                    ":tokens": -tokens,
+                    ":requests": -requests,
+                }
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    @tracing.traced("dynamodb.increment_item_in_generation")
+    def increment_item_in_generation(self, thread_key: str) -> Tuple[int, float]:
+        # 世代を1つ進め、新しい世代の番号と、1つ前の世代がまだ終わっていなければ始まった時刻を返す
+        generation_table = self.dynamodb.Table(constants.GENERATION_TABLE)
+        now = time.time()
+        response = generation_table.update_item(
+            Key={
+                "thread_key": thread_key
+            },
+            UpdateExpression="ADD #generation :one SET started_at = :now, expires_at = :expires_at",
+            ExpressionAttributeNames={"#generation": "generation"},
+            ExpressionAttributeValues={
+                ":one": 1,
+                ":now": _to_dynamodb_value(now),
+                ":expires_at": int(now) + constants.GENERATION_TTL_SECONDS,
+            },
+            ReturnValues="ALL_OLD"
+        )
+        previous = response.get("Attributes") or {}
+        number = int(previous.get("generation", 0))
+        started_at = previous.get("started_at")
+        if started_at is None or int(previous.get("finished_generation", 0)) >= number:
+            return number + 1, None
+        return number + 1, float(started_at)
+
+    @tracing.traced("dynamodb.finish_item_in_generation")
+    def finish_item_in_generation(self, thread_key: str, number: int):
+        # 終わった世代を記録する。古い世代が後から終わっても、新しい世代の記録を戻さない
+        generation_table = self.dynamodb.Table(constants.GENERATION_TABLE)
+        try:
+            generation_table.update_item(
+                Key={
+                    "thread_key": thread_key
+                },
+                UpdateExpression="SET finished_generation = :number",
+                ConditionExpression="attribute_not_exists(finished_generation) OR finished_generation < :number",
+                ExpressionAttributeValues={":number": number}
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    @tracing.traced("dynamodb.get_item_from_generation")
+    def get_item_from_generation(self, thread_key: str) -> int:
+        generation_table = self.dynamodb.Table(constants.GENERATION_TABLE)
+        response = generation_table.get_item(
+            Key={
+                "thread_key": thread_key
+            },
+            ProjectionExpression="#generation",
+            ExpressionAttributeNames={"#generation": "generation"},
+            ConsistentRead=True
+        )
+        item = response.get("Item")
+        return int(item.get("generation", 0)) if item else 0
+
+    @tracing.traced("dynamodb.add_item_to_usage")
+    def add_item_to_usage(self, usage_key: str, prompt_tokens: int, completion_tokens: int, requests: int):
+        # 別のコンテナと同時に書き込んでも失われないよう、アトミックに加算する
+        usage_table = self.dynamodb.Table(constants.USAGE_TABLE)
+        usage_table.update_item(
+            Key={
+                "usage_key": usage_key
+            },
+            UpdateExpression="ADD #prompt_tokens :prompt_tokens, #completion_tokens :completion_tokens, "
+                             "#requests :requests SET expires_at = if_not_exists(expires_at, :expires_at)",
+            ExpressionAttributeNames={
+                "#prompt_tokens": "prompt_tokens",
+                "#completion_tokens": "completion_tokens",
+                "#requests": "requests",
+            },
+            ExpressionAttributeValues={
+                ":prompt_tokens": prompt_tokens,
+                ":completion_tokens": completion_tokens,
+                ":requests": requests,
+                ":expires_at": int(time.time()) + constants.USAGE_TTL_SECONDS,
+            }
+        )
+
+    @tracing.traced("dynamodb.batch_get_items_from_usage")
+    def batch_get_items_from_usage(self, usage_keys: List[str]) -> Dict[str, dict]:
+        items = self._batch_get_items(constants.USAGE_TABLE, [{"usage_key": key} for key in usage_keys])
+        return {item["usage_key"]: item for item in items}
+
+    @tracing.traced("dynamodb.get_item_from_installation")
+    def get_item_from_installation(self, installation_key: str) -> dict:
+        installation_table = self.dynamodb.Table(constants.INSTALLATION_TABLE)
+        response = installation_table.get_item(
+            Key={
+                "installation_key": installation_key
+            }
+        )
+        return response.get("Item")
+
+    @tracing.traced("dynamodb.put_item_to_installation")
+    def put_item_to_installation(self, item: dict):
+        installation_table = self.dynamodb.Table(constants.INSTALLATION_TABLE)
+        installation_table.put_item(Item=item)
+
+    @tracing.traced("dynamodb.put_item_to_response_cache")
+    def put_item_to_response_cache(self, cache_key: str, model: str, content: str):
+        response_cache_table = self.dynamodb.Table(constants.RESPONSE_CACHE_TABLE)
+        response_cache_table.put_item(
+            Item={
+                "cache_key": cache_key,
+                "model": model,
+                "content": content,
+                "expires_at": int(time.time()) + constants.RESPONSE_CACHE_TTL_SECONDS,
+            }
+        )
+
+    @tracing.traced("dynamodb.get_item_from_response_cache")
+    def get_item_from_response_cache(self, cache_key: str) -> str:
+        response_cache_table = self.dynamodb.Table(constants.RESPONSE_CACHE_TABLE)
+        response = response_cache_table.get_item(
+            Key={
+                "cache_key": cache_key
+            }
+        )
+        item = response.get("Item")
+        # TTLによる削除は遅れることがあるため、期限切れは読み取り時にも除外する
+        if not item or int(item.get("expires_at", 0)) <= time.time():
+            return None
+        return item.get("content")
+
+
+def _cache_user_config(item: dict) -> UserConfigItem:
+    # DynamoDBの数値はDecimalで返るため、フィールドの型に変換する。以前のclearで保存された空文字は未設定として扱う
+    user_config = UserConfigItem(**{
+        f.name: f.type(item[f.name])
+        for f in fields(UserConfigItem)
+        if item.get(f.name) not in (None, "")
+    })
+    version = item.get("version")
+    _user_config_cache.set(
+        user_config.user_id,
+        (user_config, int(version) if version is not None else None, time.monotonic())
+    )
+    return user_config
+
+
+def _to_dynamodb_item(item: UserConfigItem) -> dict:
+    return {
+        key: _to_dynamodb_value(value)
+        for key, value in asdict(item).items()
+        if value is not None
+    }
+
+
+def _to_dynamodb_value(value: Any) -> Any:
+    # boto3はfloatを受け付けないため、Decimalに変換する
+    if isinstance(value, float):
+        return Decimal(str(value))
+    return value
+
+
+def _chunks(items: list, size: int) -> List[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _wait_for_unprocessed_items(operation: str, attempt: int) -> int:
+    attempt += 1
+    if attempt >= constants.DYNAMODB_BATCH_MAX_ATTEMPTS:
+        raise UnexpectedError(f"{operation} left unprocessed items after {attempt} attempts")
+    tracing.incr("dynamodb.batch_retries")
+    # Full Jitter: https://aws.amazon.com/jp/blogs/architecture/exponential-backoff-and-jitter/
+    time.sleep(random.uniform(0, min(
+        constants.DYNAMODB_BATCH_MAX_BACKOFF_SECONDS,
+        constants.DYNAMODB_BATCH_BASE_BACKOFF_SECONDS * 2 ** attempt
+    )))
+    return attempt
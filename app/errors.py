@@ -13,3 +13,27 @@ class CommandParseError(Exception):
 
 class OpenAIError(Exception):
     pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class RateLimitExceededError(Exception):
+    pass
+
+
+class PermissionDeniedError(Exception):
+    pass
+
+
+class GenerationSupersededError(Exception):
+    pass
+
+
+class QuotaExceededError(Exception):
+    pass
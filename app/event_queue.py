@@ -0,0 +1,72 @@
+import json
+from abc import ABC, abstractmethod
+from typing import Callable, List
+
+import clients
+import constants
+import utils
+
+logger = utils.setup_logger(__name__)
+
+WORKER_EVENT_SOURCE = "chat-gpt-slack.worker"
+
+
+class EventQueue(ABC):
+    @abstractmethod
+    def enqueue(self, body: dict):
+        pass
+
+
+class LambdaEventQueue(EventQueue):
+    # 自分自身のLambda関数を非同期(InvocationType=Event)で呼び出してワーカーに渡す
+    def __init__(self, function_name: str):
+        self.function_name = function_name
+        self.lambda_client = clients.lambda_client()
+
+    def enqueue(self, body: dict):
+        self.lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType="Event",
+            Payload=json.dumps(to_worker_event(body)).encode()
+        )
+        logger.info("Enqueued event to worker: %s", body.get("event_id"))
+
+
+class InProcessEventQueue(EventQueue):
+    # テスト用。workerを指定した場合は同一プロセスで即時に処理する
+    def __init__(self, worker: Callable[[dict], dict] = None):
+        self.worker = worker
+        self.events: List[dict] = []
+
+    def enqueue(self, body: dict):
+        if self.worker:
+            self.worker(body)
+            return
+        self.events.append(body)
+
+    def drain(self, worker: Callable[[dict], dict]):
+        while self.events:
+            worker(self.events.pop(0))
+
+
+_event_queue: EventQueue = None
+
+
+def get_event_queue() -> EventQueue:
+    global _event_queue
+    if _event_queue is None:
+        _event_queue = LambdaEventQueue(constants.WORKER_FUNCTION_NAME)
+    return _event_queue
+
+
+def set_event_queue(event_queue: EventQueue):
+    global _event_queue
+    _event_queue = event_queue
+
+
+def to_worker_event(body: dict) -> dict:
+    return {"source": WORKER_EVENT_SOURCE, "body": body}
+
+
+def is_worker_event(event: dict) -> bool:
+    return event.get("source") == WORKER_EVENT_SOURCE
@@ -0,0 +1,189 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterator, Tuple
+
+import constants
+import tracing
+import utils
+from dynamo_db_client import DynamoDBClient
+from errors import GenerationSupersededError
+
+logger = utils.setup_logger(__name__)
+
+
+class GenerationBackend(ABC):
+    @abstractmethod
+    def start(self, generation_key: str) -> Tuple[int, float]:
+        # 新しい世代の番号と、1つ前の世代が始まった時刻(壁時計。終わっている場合や初めての場合はNone)を返す
+        pass
+
+    @abstractmethod
+    def current(self, generation_key: str) -> int:
+        pass
+
+    @abstractmethod
+    def finish(self, generation_key: str, number: int):
+        pass
+
+
+class DynamoDBGenerationBackend(GenerationBackend):
+    # スレッドごとのアトミックカウンタで、別のコンテナで始まった生成も検知できるようにする
+    def __init__(self):
+        self.dynamo_db_client = DynamoDBClient()
+
+    def start(self, generation_key: str) -> Tuple[int, float]:
+        return self.dynamo_db_client.increment_item_in_generation(generation_key)
+
+    def current(self, generation_key: str) -> int:
+        return self.dynamo_db_client.get_item_from_generation(generation_key)
+
+    def finish(self, generation_key: str, number: int):
+        self.dynamo_db_client.finish_item_in_generation(generation_key, number)
+
+
+class InMemoryGenerationBackend(GenerationBackend):
+    # テスト用。テーブルがないときはコンテナ内だけで世代を管理する
+    def __init__(self):
+        # generation_key -> (世代, 始まった時刻, 終わった最新の世代)
+        self.generations: Dict[str, Tuple[int, float, int]] = {}
+        self._lock = threading.Lock()
+
+    def start(self, generation_key: str) -> Tuple[int, float]:
+        with self._lock:
+            number, started_at, finished = self.generations.get(generation_key, (0, None, 0))
+            self.generations[generation_key] = (number + 1, time.time(), finished)
+            return number + 1, started_at if finished < number else None
+
+    def current(self, generation_key: str) -> int:
+        with self._lock:
+            return self.generations.get(generation_key, (0, None, 0))[0]
+
+    def finish(self, generation_key: str, number: int):
+        with self._lock:
+            current, started_at, finished = self.generations.get(generation_key, (0, None, 0))
+            self.generations[generation_key] = (current, started_at, max(finished, number))
+
+
+class Generation:
+    # 1つのスレッドで1人のユーザに対して実行中の生成。同じユーザの後の世代が始まったら取り消す
+    def __init__(self, generation_key: str, number: int, previous_started_at: float = None):
+        self.generation_key = generation_key
+        self.number = number
+        self.previous_started_at = previous_started_at
+        self.cancelled = threading.Event()
+        self._checked_at = time.monotonic()
+
+    def superseded(self) -> bool:
+        if self.cancelled.is_set():
+            return True
+        # 別のコンテナで始まった世代は、一定の間隔でバックエンドを確認して検知する
+        now = time.monotonic()
+        if now - self._checked_at < constants.GENERATION_CHECK_INTERVAL_SECONDS:
+            return False
+        self._checked_at = now
+        if get_backend().current(self.generation_key) > self.number:
+            self.cancelled.set()
+        return self.cancelled.is_set()
+
+    def check(self):
+        if self.superseded():
+            tracing.incr("generation.superseded")
+            raise GenerationSupersededError(
+                f"Generation {self.number} of {self.generation_key} was superseded"
+            )
+
+    def coalesce(self):
+        # 同じスレッドの前の生成がまだ実行中のときだけ、少し待ってから最後の1件の世代だけで生成する
+        # 前の生成が終わっていれば、続けて送られたメッセージでも待たない
+        if self.previous_started_at is None \
+                or time.time() - self.previous_started_at > constants.GENERATION_COALESCE_WINDOW_SECONDS:
+            return
+        time.sleep(constants.GENERATION_COALESCE_WAIT_SECONDS)
+        self._checked_at = float("-inf")
+        self.check()
+
+    def guard(self, chunks: Iterator[str]) -> Iterator[str]:
+        # 取り消されたら元のストリームを閉じ、途中までの応答を投稿しないように例外を送出する
+        try:
+            for chunk in chunks:
+                self.check()
+                yield chunk
+        finally:
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+
+
+class _NoopGeneration(Generation):
+    # 無効のときに返す。取り消されることはない
+    def __init__(self, generation_key: str = None):
+        super().__init__(generation_key, 0)
+
+    def superseded(self) -> bool:
+        return False
+
+    def coalesce(self):
+        pass
+
+
+_backend: GenerationBackend = None
+
+# generation_key -> このコンテナで実行中の最新の世代
+_running: Dict[str, Generation] = {}
+_running_lock = threading.Lock()
+
+
+def get_backend() -> GenerationBackend:
+    global _backend
+    if _backend is None:
+        if constants.GENERATION_TABLE:
+            _backend = DynamoDBGenerationBackend()
+        else:
+            _backend = InMemoryGenerationBackend()
+    return _backend
+
+
+def set_backend(backend: GenerationBackend):
+    global _backend
+    _backend = backend
+
+
+def to_generation_key(thread_key: str, user_id: str = None) -> str:
+    # 取り消しとまとめる対象は、同じスレッドで同じユーザが続けて送ったメッセージだけにする
+    # 別のユーザが同じスレッドでメンションしても、実行中の応答は取り消さない
+    return f"{thread_key}:{user_id}" if thread_key and user_id else thread_key
+
+
+def start(thread_key: str, user_id: str = None) -> Generation:
+    generation_key = to_generation_key(thread_key, user_id)
+    if not constants.GENERATION_ENABLED or not generation_key:
+        return _NoopGeneration(generation_key)
+
+    number, previous_started_at = get_backend().start(generation_key)
+    generation = Generation(generation_key, number, previous_started_at)
+    with _running_lock:
+        running = _running.get(generation_key)
+        # 同時に始まった場合は、番号の大きい方だけを残す
+        if running and running.number > number:
+            generation.cancelled.set()
+        else:
+            _running[generation_key] = generation
+            if running:
+                running.cancelled.set()
+                logger.info("Cancelled generation %d of %s", running.number, generation_key)
+    return generation
+
+
+def finish(generation: Generation):
+    with _running_lock:
+        if _running.get(generation.generation_key) is generation:
+            del _running[generation.generation_key]
+    if not generation.number:
+        return
+
+    try:
+        get_backend().finish(generation.generation_key, generation.number)
+    except Exception:
+        # 記録できなくても、次のメッセージが少し待つだけなので応答は失敗させない
+        logger.exception("Failed to finish generation %d of %s", generation.number, generation.generation_key)
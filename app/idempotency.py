@@ -0,0 +1,63 @@
+import constants
+import utils
+from cache import TTLCache
+
+logger = utils.setup_logger(__name__)
+
+# ウォームコンテナで既に受け付けたイベントは、DynamoDBに問い合わせずに重複と判定する
+_claimed_event_keys = TTLCache(
+    max_size=constants.EVENT_DEDUPE_CACHE_SIZE,
+    ttl_seconds=constants.EVENT_DEDUPE_TTL_SECONDS
+)
+
+
+def event_dedupe_key(body: dict) -> str:
+    # 同じメッセージに対してapp_mentionとmessageの両方のイベントが届くことがあるため、
+    # client_msg_idがあればevent_idより優先する。編集時は編集日時で区別する
+    body_event: dict = body.get("event") or {}
+    message: dict = body_event.get("message") or body_event
+    client_msg_id = message.get("client_msg_id")
+    if client_msg_id:
+        edited: dict = message.get("edited") or {}
+        return f"msg:{client_msg_id}:{edited.get('ts', '')}"
+
+    event_id = body.get("event_id")
+    if event_id:
+        return f"event:{event_id}"
+
+    return None
+
+
+def claim_event(body: dict) -> bool:
+    event_key = event_dedupe_key(body)
+    if not event_key:
+        return True
+
+    if event_key in _claimed_event_keys:
+        logger.info("Duplicate event in cache: %s", event_key)
+        return False
+
+    claimed = True
+    if constants.EVENT_DEDUPE_TABLE:
+        # boto3はテーブルを使うときだけ読み込む
+        from dynamo_db_client import DynamoDBClient
+
+        claimed = DynamoDBClient().claim_item_in_event_dedupe(event_key)
+    _claimed_event_keys.set(event_key, True)
+
+    if not claimed:
+        logger.info("Duplicate event in DynamoDB: %s", event_key)
+    return claimed
+
+
+def release_event(body: dict):
+    # 受け付けたイベントを処理できなかったとき、Slackの再送で処理し直せるようにする
+    event_key = event_dedupe_key(body)
+    if not event_key:
+        return
+
+    _claimed_event_keys.delete(event_key)
+    if constants.EVENT_DEDUPE_TABLE:
+        from dynamo_db_client import DynamoDBClient
+
+        DynamoDBClient().delete_item_from_event_dedupe(event_key)
@@ -0,0 +1,121 @@
+# 1つのデプロイで複数のワークスペースに応答するための、ワークスペースごとのトークンとアプリごとの署名シークレット
+# テーブルに登録がないワークスペースとアプリには、環境変数のトークンと署名シークレットを使う
+# 署名シークレットを登録したアプリのIDは、環境変数のSLACK_APP_IDSにも追加する
+#   $ python installation_store.py install <api_app_id> <team_id>
+#   $ python installation_store.py signing-secrets <api_app_id>
+import json
+from dataclasses import dataclass
+from typing import List
+
+import constants
+import utils
+from cache import TTLCache
+
+logger = utils.setup_logger(__name__)
+
+_MISSING = object()
+
+# installation_key -> テーブルの項目(登録がなければNone)。リクエストごとにDynamoDBを読まないようにする
+_installation_cache = TTLCache(
+    max_size=constants.INSTALLATION_CACHE_SIZE,
+    ttl_seconds=constants.INSTALLATION_CACHE_TTL_SECONDS
+)
+
+
+@dataclass(frozen=True)
+class Installation:
+    team_id: str = None
+    api_app_id: str = None
+    # Noneの場合は環境変数のSLACK_BOT_TOKENを使う
+    bot_token: str = None
+
+
+def installation_key(api_app_id: str, team_id: str = None) -> str:
+    # アプリの項目は"api_app_id"、アプリをインストールしたワークスペースの項目は"api_app_id:team_id"
+    return f"{api_app_id}:{team_id}" if team_id else api_app_id
+
+
+def find(body: dict) -> Installation:
+    team_id = body.get("team_id") or (body.get("event") or {}).get("team")
+    api_app_id = body.get("api_app_id")
+    item = _get_item(installation_key(api_app_id, team_id)) if api_app_id and team_id else None
+    return Installation(team_id, api_app_id, item.get("bot_token") if item else None)
+
+
+def signing_secrets(api_app_id: str) -> List[bytes]:
+    # 新しいシークレットを追加してから古いシークレットを消すまでの間は、どちらで署名されていても受け付ける
+    item = _get_item(installation_key(api_app_id)) if api_app_id else None
+    return [secret.encode() for secret in (item or {}).get("signing_secrets") or []]
+
+
+def has_valid_signature(headers: dict, body: str) -> bool:
+    # 環境変数の署名シークレットで検証できないときだけ、アプリごとに登録した署名シークレットで検証する
+    if utils.has_valid_signature(headers, body):
+        return True
+    if not constants.INSTALLATION_TABLE or not constants.SLACK_APP_IDS:
+        return False
+
+    try:
+        api_app_id = json.loads(body).get("api_app_id")
+    except (TypeError, ValueError, AttributeError):
+        return False
+    # 検証前のapi_app_idは信用できないため、知らないアプリIDではテーブルを読まず、キャッシュにも入れない
+    if api_app_id not in constants.SLACK_APP_IDS:
+        return False
+    secrets = signing_secrets(api_app_id)
+    return bool(secrets) and utils.has_valid_signature(headers, body, secrets)
+
+
+def save(installation: Installation):
+    from dynamo_db_client import DynamoDBClient
+
+    key = installation_key(installation.api_app_id, installation.team_id)
+    item = {"installation_key": key, "team_id": installation.team_id, "bot_token": installation.bot_token}
+    DynamoDBClient().put_item_to_installation(item)
+    _installation_cache.delete(key)
+
+
+def save_signing_secrets(api_app_id: str, secrets: List[str]):
+    from dynamo_db_client import DynamoDBClient
+
+    DynamoDBClient().put_item_to_installation(
+        {"installation_key": installation_key(api_app_id), "signing_secrets": secrets}
+    )
+    _installation_cache.delete(installation_key(api_app_id))
+
+
+def _get_item(key: str) -> dict:
+    if not constants.INSTALLATION_TABLE:
+        return None
+
+    item = _installation_cache.get(key, _MISSING)
+    if item is _MISSING:
+        # boto3はテーブルを使うときだけ読み込む
+        from dynamo_db_client import DynamoDBClient
+
+        item = DynamoDBClient().get_item_from_installation(key)
+        _installation_cache.set(key, item)
+    return item
+
+
+if __name__ == "__main__":
+    import argparse
+    import getpass
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    install_parser = subparsers.add_parser("install", help="register the bot token of a workspace")
+    install_parser.add_argument("api_app_id")
+    install_parser.add_argument("team_id")
+    secrets_parser = subparsers.add_parser("signing-secrets", help="register the signing secrets of an app")
+    secrets_parser.add_argument("api_app_id")
+    args = parser.parse_args()
+
+    # トークンやシークレットがシェルの履歴に残らないよう、引数ではなく入力で受け取る
+    if args.command == "install":
+        save(Installation(args.team_id, args.api_app_id, getpass.getpass("Bot token (xoxb-): ")))
+    else:
+        secrets = getpass.getpass("Signing secrets (comma separated, new first): ").split(",")
+        save_signing_secrets(args.api_app_id, [secret.strip() for secret in secrets if secret.strip()])
+        if args.api_app_id not in constants.SLACK_APP_IDS:
+            print(f"Add {args.api_app_id} to SLACK_APP_IDS to accept requests signed with these secrets")
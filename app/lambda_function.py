@@ -1,78 +1,154 @@
 import json
-import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-import chat_gpt_client
 import constants
+import event_queue
+import idempotency
+import installation_store
+import log
+import slack_event
+import tracing
 import utils
-from command_clear import ClearCommand
-from command_list import ListCommand
-from command_set import SetCommand
-from errors import (CommandParseError, NotImplementedCommandError, OpenAIError,
-                    UnexpectedError)
+from errors import (CommandParseError, GenerationSupersededError,
+                    NotImplementedCommandError, OpenAIError,
+                    PermissionDeniedError, UnexpectedError)
 from response import Response
-from slack_client import SlackClient
 
 logger = utils.setup_logger(__name__)
 
+# ウォームコンテナ間でスレッドを使い回す
+_prefetch_executor = ThreadPoolExecutor(max_workers=constants.PREFETCH_MAX_WORKERS)
+# 使用量の書き込みは、プリフェッチのスレッドを塞がないように別のスレッドで行う
+_usage_flush_executor = ThreadPoolExecutor(max_workers=1)
 
-SLACK_MESSAGE_TYPE_APP_MENTION = "app_mention"
-SLACK_MESSAGE_TYPE_MESSAGE = "message"
 
-SLACK_MESSAGE_SUB_TYPE_MESSAGE_CHANGED = "message_changed"
-SLACK_MESSAGE_SUB_TYPE_MESSAGE_DELETED = "message_deleted"
-SLACK_MESSAGE_SUB_TYPE_MESSAGE_TOMBSTONE = "tombstone"
+@tracing.traced_request
+def lambda_handler(event, context):
+    log.start_request(getattr(context, "aws_request_id", None))
 
+    # ワーカーとして非同期に呼び出されたとき
+    if event_queue.is_worker_event(event):
+        tracing.set_property("Path", "worker")
+        return handle_slack_event(event.get("body"), context)
 
-def lambda_handler(event, context):
-    slackClient = None
-    progress_message_ts = None
     try:
         headers = event.get("headers")
+        body = event.get("body")
+        with tracing.span("ingress.signature"):
+            if not installation_store.has_valid_signature(headers, body):
+                return Response.unauthorized()
+
+        with tracing.span("ingress.classify"):
+            # Botのメッセージ(ストリーミング中の更新も含む)はワーカーを起動せずに無視する
+            if slack_event.is_bot_payload(body):
+                return Response.success()
 
-        if utils.slack_sending_retry(headers):
+            body: dict = json.loads(body)
+
+        if not accept_event(body):
             return Response.success()
 
-        body = event.get("body")
-        if not utils.has_valid_signature(headers, body):
-            return Response.unauthorized()
+        if not constants.ASYNC_WORKER_ENABLED:
+            # 失敗したときは、Slackからの再送を重複として捨てないように取得した処理の権利を戻す
+            try:
+                response = handle_slack_event(body, context)
+            except Exception:
+                idempotency.release_event(body)
+                raise
+            if response.get("statusCode", 200) >= 300:
+                idempotency.release_event(body)
+            return response
+
+        # Slackの3秒タイムアウト内に応答するため、重い処理はワーカーに任せてすぐに返す
+        try:
+            with tracing.span("ingress.enqueue"):
+                event_queue.get_event_queue().enqueue(body)
+        except Exception:
+            idempotency.release_event(body)
+            raise
+        return Response.success()
 
-        body: dict = json.loads(body)
+    except Exception:
+        logger.exception("Failed to accept Slack event")
+        return Response.unexpected("Unexpected error!")
+
+
+def accept_event(body: dict) -> bool:
+    # Socket Modeのワーカーと共通の、処理しないイベントの判定
+    if slack_event.classify(body.get("event")).kind == slack_event.KIND_BOT:
+        return False
+
+    # Slackからの再送や重複したイベントは、event_idなどをキーに一度だけ処理する
+    tracing.set_property("EventId", body.get("event_id"))
+    with tracing.span("ingress.dedupe"):
+        return idempotency.claim_event(body)
+
+
+def configure_concurrency(max_concurrent_events: int):
+    # Socket Modeのように1つのプロセスで複数のイベントを同時に処理するときは、
+    # プリフェッチのスレッドと接続プールをイベントの数に合わせて増やす。クライアントを作る前に呼ぶ
+    global _prefetch_executor
+    max_workers = constants.PREFETCH_MAX_WORKERS * max_concurrent_events
+    _prefetch_executor = ThreadPoolExecutor(max_workers=max_workers)
+    constants.HTTP_MAX_POOL_CONNECTIONS = max(constants.HTTP_MAX_POOL_CONNECTIONS, max_workers)
+
+
+def handle_slack_event(body: dict, context=None) -> dict:
+    # OpenAIやSlackのSDKは、Slackへの応答だけを行うリクエストでは読み込まない
+    import chat_gpt_client
+    import clients
+    import dynamo_db_client
+    import generation
+    import resilience
+    import response_cache
+    import usage_ledger
+    from command_clear import ClearCommand
+    from command_list import ListCommand
+    from command_set import SetCommand
+    from dynamo_db_client import DynamoDBClient
+    from slack_client import SlackClient
+
+    slackClient = None
+    current_generation = None
+    deadline = resilience.Deadline.from_context(context)
+    # 前の呼び出しの後にコンテナがフリーズしていた場合は、古くなった使用量をこの呼び出しの間に書き込む
+    usage_ledger.install_shutdown_hook()
+    _usage_flush_executor.submit(usage_ledger.flush_if_due)
+    try:
         body_event: dict = body.get("event")
 
-        logger.info(f"EVENT: {body_event}")
+        logger.info("EVENT: %s", log.summarize(body_event))
+        logger.debug("EVENT BODY: %s", body_event)
 
         # 初回Slack認証時
         # if body.get("challenge") is not None:
         #     return Response.success(body.get("challenge"))
 
-        text = body_event.get("text")
-        channel = body_event.get("channel")
-        thread_ts = body_event.get("thread_ts")
-        if not thread_ts:
-            message = body_event.get("message")
-            if message:
-                thread_ts = message.get("thread_ts")
-            else:
-                thread_ts = body_event.get("ts")
-
-        slackClient = SlackClient(channel=channel, thread_ts=thread_ts)
+        classified_event = slack_event.classify(body_event)
 
         # DMでBotから送信されたメッセージは無視する
-        if event_triggered_by_bot(body_event):
+        if classified_event.kind == slack_event.KIND_BOT:
             return Response.success()
+
+        text = classified_event.text
+        # イベントが届いたワークスペースのトークンで応答する
+        installation = installation_store.find(body)
+        slack_web_client = clients.slack_web_client(installation.bot_token)
+        slackClient = SlackClient(
+            channel=classified_event.channel,
+            thread_ts=classified_event.thread_ts,
+            client=slack_web_client
+        )
+
         # DMでユーザがメッセージを削除したとき
-        if event_triggered_by_user_message_delete_on_dm(body_event):
+        if classified_event.deleted:
+            slackClient.remove_from_thread_history(classified_event.deleted_ts)
             return Response.success()
 
-        user_edited_message = False
-        # DMでユーザがメッセージを変更したとき
-        if event_triggered_by_user_message_edit_on_dm(body_event):
-            text = body_event.get("message").get("text")
-            user_edited_message = True
-        # チャンネルでユーザがメッセージを変更したとき
-        if event_triggered_by_user_message_edit_on_channel(body_event):
-            text = body_event.get("text")
-            user_edited_message = True
+        # ユーザがメッセージを変更したとき
+        user_edited_message = classified_event.edited
+        if user_edited_message:
+            slackClient.patch_thread_history(classified_event.edited_message)
 
         if not text:
             raise UnexpectedError("Cannot get text")
@@ -82,152 +158,132 @@ def lambda_handler(event, context):
         if sent:
             return Response.success()
 
-        user_id = body_event.get("user")
-        if not user_id:
-            message = body_event.get("message")
-            if message:
-                user_id = message.get("user")
+        user_id = classified_event.user
 
         # セットコマンドの場合
         if utils.is_command("set", text):
-            set_command = SetCommand(text, user_id)
+            set_command = SetCommand(text, user_id, slack_web_client)
             set_command.set_key_value()
-            slackClient.send_text_to_channel(
-                f"SET {set_command.key}: {set_command.value}"
-            )
+            slackClient.send_text_to_channel(set_command.summary())
             return Response.success()
         # リストコマンドの場合
         elif utils.is_command("list", text):
-            list_command = ListCommand(text, user_id)
+            list_command = ListCommand(text, user_id, slack_web_client)
             message = list_command.list_key_value()
             slackClient.send_text_to_channel(message)
             return Response.success()
         # 削除コマンド
         elif utils.is_command("clear", text):
-            clear_command = ClearCommand(text, user_id)
+            clear_command = ClearCommand(text, user_id, slack_web_client)
             clear_command.clear_value()
-            slackClient.send_text_to_channel(
-                f"CLEAR {clear_command.key}"
-            )
+            slackClient.send_text_to_channel(clear_command.summary())
             return Response.success()
 
-        progress_message_ts = slackClient.send_text_to_thread(
-            constants.SLACK_PROGRESS_MESSAGE
+        model_override, text = utils.parse_model_override(text)
+
+        # 同じユーザが同じスレッドで送った古いメッセージへの生成を取り消し、続けて送られたメッセージは最後の1件にまとめる
+        current_generation = generation.start(slackClient.thread_key(), user_id)
+        current_generation.coalesce()
+
+        # プログレスメッセージの送信、スレッドの取得、ユーザ設定の取得は互いに依存しないため並行に行う
+        updated_text = text if user_edited_message else None
+        progress_future = _prefetch_executor.submit(
+            slackClient.send_text_to_thread,
+            constants.SLACK_PROGRESS_MESSAGE,
+            user_id
         )
-        replies = None
-        if user_edited_message:
-            replies = slackClient.thread_replies(text)
-        else:
-            replies = slackClient.thread_replies()
-        response_from_chat_gpt = chat_gpt_client.create_chat_gpt_completion(
-            replies,
+        replies_future = _prefetch_executor.submit(
+            slackClient.thread_replies,
+            updated_text
+        )
+        user_config_future = _prefetch_executor.submit(
+            DynamoDBClient().get_item_from_user_config,
             user_id
         )
+        with tracing.span("worker.prefetch"):
+            progress_message_ts = progress_future.result()
+            replies = replies_future.result()
+            user_config = user_config_future.result()
+        current_generation.check()
+
+        # ストリーミング時はプログレスメッセージを生成中のテキストで更新していく
+        if constants.CHAT_GPT_STREAM_ENABLED:
+            chunks = chat_gpt_client.create_chat_gpt_completion_stream(
+                replies,
+                user_id,
+                user_config,
+                slackClient.thread_key(),
+                model_override,
+                deadline
+            )
+            slackClient.stream_text_to_thread(
+                current_generation.guard(chunks), progress_message_ts, user_id
+            )
+            return Response.success()
 
-        slackClient.delete_sent_text(progress_message_ts)
-        slackClient.send_text_to_thread(response_from_chat_gpt, user_id)
+        with tracing.span("worker.completion"):
+            response_from_chat_gpt = chat_gpt_client.create_chat_gpt_completion(
+                replies,
+                user_id,
+                user_config,
+                slackClient.thread_key(),
+                model_override,
+                deadline
+            )
+
+        # 生成中に新しいメッセージが来ていたら、古い応答は投稿しない
+        current_generation.check()
+        slackClient.replace_sent_text(progress_message_ts, response_from_chat_gpt, user_id)
 
         return Response.success()
 
     except CommandParseError as e:
-        logger.error(traceback.print_exc())
-        slackClient.send_text_to_channel(str(e))
+        logger.exception("Failed to parse command")
+        if slackClient:
+            slackClient.send_text_to_channel(str(e))
         return Response.success()
 
     except NotImplementedCommandError as e:
-        logger.error(traceback.print_exc())
-        slackClient.send_text_to_channel(str(e))
+        logger.exception("Command not implemented")
+        if slackClient:
+            slackClient.send_text_to_channel(str(e))
+        return Response.success()
+
+    except PermissionDeniedError as e:
+        logger.warning("Permission denied: %s", e)
+        if slackClient:
+            slackClient.send_text_to_channel(str(e))
+        return Response.success()
+
+    except GenerationSupersededError as e:
+        # 新しいメッセージへの応答に任せ、古いメッセージへの途中までの応答は消す
+        logger.info("Discarded superseded generation: %s", e)
+        if slackClient:
+            slackClient.delete_posted_texts()
         return Response.success()
 
     except OpenAIError as e:
-        logger.error(traceback.print_exc())
-        slackClient.send_text_to_channel(str(e))
-        if progress_message_ts:
-            slackClient.delete_sent_text(progress_message_ts)
+        logger.exception("Failed to create ChatGPT completion")
+        if slackClient:
+            slackClient.send_text_to_channel(str(e))
+            slackClient.delete_posted_texts()
         return Response.success()
 
     except Exception:
-        logger.error(traceback.print_exc())
-        slackClient.send_text_to_channel("予期しないエラーが発生しちゃいました！ :(")
-        if progress_message_ts:
-            slackClient.delete_sent_text(progress_message_ts)
+        logger.exception("Failed to handle Slack event")
+        # ワークスペースのトークンを取得する前に失敗したときは、Slackには送らずにログだけ残す
+        if slackClient:
+            slackClient.send_text_to_channel("予期しないエラーが発生しちゃいました！ :(")
+            slackClient.delete_posted_texts()
         return Response.unexpected("Unexpected error!")
 
-
-def event_triggered_by_bot(body_event: dict) -> bool:
-    # Botによるメッセージ送信がトリガーとなったとき
-    bot_id = body_event.get("bot_id")
-    if bot_id:
-        return True
-
-    subtype = body_event.get("subtype")
-
-    # Botによるメッセージ変更、削除がトリガーとなったとき
-    if subtype in [
-            SLACK_MESSAGE_SUB_TYPE_MESSAGE_CHANGED,
-            SLACK_MESSAGE_SUB_TYPE_MESSAGE_DELETED
-    ]:
-        message = body_event.get("message")
-        if message:
-            bot_id = message.get("bot_id")
-            if bot_id:
-                return True
-        previous_message = body_event.get("previous_message")
-        if previous_message:
-            bot_id = previous_message.get("bot_id")
-            if bot_id:
-                return True
-
-        # DMの場合、Botのメッセージを削除から追加すると、送信元であるユーザーのメッセージ変更が発火されてしまう
-        if message and previous_message:
-            current_text = message.get("text")
-            previous_text = previous_message.get("text")
-            if current_text == previous_text:
-                return True
-
-    return False
-
-
-def event_triggered_by_user_message_edit_on_dm(body_event: dict) -> bool:
-    subtype = body_event.get("subtype")
-
-    if subtype == SLACK_MESSAGE_SUB_TYPE_MESSAGE_CHANGED:
-        message = body_event.get("message")
-        if message:
-            client_msg_id = message.get("client_msg_id")
-            if client_msg_id:
-                return True
-
-    return False
-
-
-def event_triggered_by_user_message_delete_on_dm(body_event: dict) -> bool:
-    subtype = body_event.get("subtype")
-
-    if subtype == SLACK_MESSAGE_SUB_TYPE_MESSAGE_DELETED:
-        previous_message = body_event.get("previous_message")
-        if previous_message:
-            client_msg_id = previous_message.get("client_msg_id")
-            if client_msg_id:
-                return True
-
-    # メッセージが削除された後に、削除したメッセージがSlackBotの投稿に変わってイベントが発生してしまう
-    if subtype == SLACK_MESSAGE_SUB_TYPE_MESSAGE_CHANGED:
-        message = body_event.get("message")
-        if message:
-            message_subtype = message.get("subtype")
-            if message_subtype == SLACK_MESSAGE_SUB_TYPE_MESSAGE_TOMBSTONE:
-                return True
-
-    return False
-
-
-def event_triggered_by_user_message_edit_on_channel(body_event: dict) -> bool:
-    client_msg_id = body_event.get("client_msg_id")
-    if client_msg_id:
-        edited = body_event.get("edited")
-        if edited:
-            return True
-
-    return False
-    return False
+    finally:
+        if current_generation:
+            generation.finish(current_generation)
+        # 使用量はリクエストごとではなく、一定の間隔でまとめて書き込む
+        usage_ledger.flush_if_due()
+        # ウォームコンテナでクライアントが再利用されているかを確認するためのメトリクス
+        logger.info("CLIENT REGISTRY: %s", clients.stats())
+        logger.info("USER CONFIG CACHE: %s", dynamo_db_client.user_config_cache_stats)
+        logger.info("RESPONSE CACHE: %s", response_cache.response_cache_stats)
+        logger.info("SLACK CALLS: %s", tracing.counters("slack."))
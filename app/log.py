@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import random
+from typing import Any, List
+
+import constants
+
+# 個人の入力を含みうるため、値をそのまま出力するのはIDや種類などのキーだけにする
+SAFE_KEYS = {
+    "type", "subtype", "event_id", "user", "channel", "channel_type",
+    "ts", "thread_ts", "event_ts", "deleted_ts", "client_msg_id",
+    "bot_id", "user_id", "role", "model",
+}
+
+_loggers: List[logging.Logger] = []
+_request_id: str = None
+
+
+class JsonFormatter(logging.Formatter):
+    # CloudWatch Logs Insightsで検索しやすいよう、1行1レコードのJSONで出力する
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "level": record.levelname,
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if _request_id:
+            entry["request_id"] = _request_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logger(name: str) -> logging.Logger:
+    logger = logging.getLogger(name)
+    # 同じ名前で何度呼ばれてもハンドラを重複して追加しない
+    if logger in _loggers:
+        return logger
+
+    handler = logging.StreamHandler()
+    if constants.LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '[%(levelname)s]: %(asctime)s - %(name)s: %(message)s'
+        ))
+
+    logger.handlers = [handler]
+    logger.setLevel(constants.LOG_LEVEL)
+    logger.propagate = False
+    _loggers.append(logger)
+    return logger
+
+
+def start_request(request_id: str = None):
+    # 一部のリクエストだけDEBUGレベルで出力し、ペイロードの全文を確認できるようにする
+    global _request_id
+    _request_id = request_id
+    sampled = random.random() < constants.LOG_DEBUG_SAMPLE_RATE
+    level = logging.DEBUG if sampled else constants.LOG_LEVEL
+    for logger in _loggers:
+        logger.setLevel(level)
+
+
+class PayloadSummary:
+    # ログが出力されるときに初めて要約を作る。本文の代わりに件数・文字数・ハッシュを出す
+    __slots__ = ("payload",)
+
+    def __init__(self, payload: Any):
+        self.payload = payload
+
+    def __str__(self) -> str:
+        summary = _summarize(self.payload, depth=0)
+        if len(summary) > constants.LOG_PAYLOAD_MAX_CHARS:
+            summary = summary[:constants.LOG_PAYLOAD_MAX_CHARS] + "..."
+        return summary
+
+
+def summarize(payload: Any) -> PayloadSummary:
+    return PayloadSummary(payload)
+
+
+def _summarize(value: Any, depth: int) -> str:
+    if isinstance(value, dict):
+        if depth >= 2:
+            return f"<dict {len(value)} keys>"
+        items = []
+        for key, item in value.items():
+            if key in SAFE_KEYS and isinstance(item, (str, int, float, bool)):
+                items.append(f"{key}={item}")
+            else:
+                items.append(f"{key}={_summarize(item, depth + 1)}")
+        return "{" + ", ".join(items) + "}"
+    if isinstance(value, (list, tuple)):
+        # メッセージの一覧は、文字列の値だけを数えてハッシュする(JSONへの変換はしない)
+        digest = hashlib.sha256()
+        chars = 0
+        roles = {}
+        for item in value:
+            texts = item.values() if isinstance(item, dict) else (item,)
+            for text in texts:
+                if isinstance(text, str):
+                    digest.update(text.encode("utf-8"))
+                    chars += len(text)
+            if isinstance(item, dict) and item.get("role"):
+                roles[item.get("role")] = roles.get(item.get("role"), 0) + 1
+        summary = f"<{len(value)} items, {chars} chars, sha256={digest.hexdigest()[:12]}"
+        if roles:
+            summary += f", roles={roles}"
+        return summary + ">"
+    if isinstance(value, str):
+        return f"<{len(value)} chars, sha256={_hash(value)}>"
+    return str(value)
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+from typing import List
+
+import constants
+import context_window
+import tracing
+import utils
+from dynamo_db_client import UserConfigItem
+
+logger = utils.setup_logger(__name__)
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    # 先頭から順に試すモデル。失敗したら次のモデルにフォールバックする
+    models: List[str]
+    reason: str
+
+
+def route(
+        replies: List[dict],
+        user_config: UserConfigItem,
+        model_override: str = None) -> ModelRoute:
+    if model_override in constants.CHAT_GPT_MODEL_CONTEXT_WINDOWS:
+        return _with_fallbacks(model_override, "override")
+
+    if user_config and user_config.model in constants.CHAT_GPT_MODEL_CONTEXT_WINDOWS:
+        return _with_fallbacks(user_config.model, "user_config")
+
+    prompt = replies[-1].get("content") if replies else ""
+    prompt_tokens = context_window.count_text_tokens(
+        prompt, constants.DEFAULT_CHAT_GPT_MODEL
+    )
+    # お礼などのごく短いメッセージは、スレッドの長さに関わらず安いモデルで十分
+    if prompt_tokens <= constants.MODEL_ROUTER_TINY_PROMPT_TOKENS:
+        return _with_fallbacks(constants.CHEAP_CHAT_GPT_MODEL, "tiny_prompt")
+    # スレッドの最初の短い1行の質問
+    if len(replies) <= constants.MODEL_ROUTER_SHORT_THREAD_LENGTH \
+            and prompt_tokens <= constants.MODEL_ROUTER_SHORT_PROMPT_TOKENS \
+            and "\n" not in prompt.strip():
+        return _with_fallbacks(constants.CHEAP_CHAT_GPT_MODEL, "short_question")
+
+    return _with_fallbacks(constants.DEFAULT_CHAT_GPT_MODEL, "default")
+
+
+def _with_fallbacks(model: str, reason: str) -> ModelRoute:
+    models = [model] + [
+        fallback for fallback in constants.CHAT_GPT_FALLBACK_MODELS
+        if fallback != model
+    ]
+    return ModelRoute(models, reason)
+
+
+def log_result(
+        model: str,
+        reason: str,
+        latency_seconds: float,
+        prompt_tokens: int,
+        completion_tokens: int):
+    # ルーティングのポリシーを調整するため、モデルごとのレイテンシとコストを記録する
+    prompt_price, completion_price = constants.CHAT_GPT_MODEL_PRICES.get(model, (0, 0))
+    cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+    tracing.set_property("Model", model)
+    tracing.set_property("RouteReason", reason)
+    tracing.incr("openai.prompt_tokens", prompt_tokens)
+    tracing.incr("openai.completion_tokens", completion_tokens)
+    logger.info(
+        "MODEL ROUTE: model=%s reason=%s latency_ms=%.0f prompt_tokens=%d completion_tokens=%d cost_usd=%.6f",
+        model, reason, latency_seconds * 1000, prompt_tokens, completion_tokens, cost
+    )
@@ -0,0 +1,210 @@
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import constants
+import resilience
+import tracing
+import utils
+from dynamo_db_client import DynamoDBClient
+from errors import RateLimitExceededError
+
+logger = utils.setup_logger(__name__)
+
+
+@dataclass(frozen=True)
+class Bucket:
+    key: str
+    token_limit: int
+    request_limit: int
+
+
+@dataclass(frozen=True)
+class RateLimitLease:
+    # 確保したウィンドウとトークン数。実際の使用量が分かったらsettleで差分を返す
+    buckets: Tuple[Bucket, ...]
+    window: int
+    tokens: int
+
+
+class RateLimitBackend(ABC):
+    @abstractmethod
+    def consume(
+            self,
+            key: str,
+            window: int,
+            tokens: int,
+            token_limit: int,
+            request_limit: int) -> bool:
+        pass
+
+    @abstractmethod
+    def refund(self, key: str, window: int, tokens: int, requests: int):
+        pass
+
+
+class DynamoDBRateLimitBackend(RateLimitBackend):
+    # ウィンドウごとのアトミックカウンタで、Lambdaコンテナ間で同じ上限を共有する
+    def __init__(self):
+        self.dynamo_db_client = DynamoDBClient()
+
+    def consume(
+            self,
+            key: str,
+            window: int,
+            tokens: int,
+            token_limit: int,
+            request_limit: int) -> bool:
+        return self.dynamo_db_client.consume_item_in_rate_limit(
+            f"{key}:{window}", tokens, token_limit, request_limit
+        )
+
+    def refund(self, key: str, window: int, tokens: int, requests: int):
+        self.dynamo_db_client.refund_item_in_rate_limit(
+            f"{key}:{window}", tokens, requests
+        )
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    # テスト用。テーブルがないときはコンテナ内だけで制限する
+    def __init__(self):
+        # key -> (window, tokens, requests)。現在のウィンドウの分だけを持つ
+        self.counters: Dict[str, Tuple[int, int, int]] = {}
+        self._lock = threading.Lock()
+
+    def consume(
+            self,
+            key: str,
+            window: int,
+            tokens: int,
+            token_limit: int,
+            request_limit: int) -> bool:
+        with self._lock:
+            counted_window, used_tokens, used_requests = self.counters.get(key, (window, 0, 0))
+            if counted_window != window:
+                used_tokens, used_requests = 0, 0
+            # DynamoDBと同じく、空のウィンドウでは上限より大きいリクエストも1件は通す
+            if used_requests and (
+                    used_tokens + tokens > token_limit or used_requests + 1 > request_limit):
+                return False
+            self.counters[key] = (window, used_tokens + tokens, used_requests + 1)
+            return True
+
+    def refund(self, key: str, window: int, tokens: int, requests: int):
+        with self._lock:
+            counted_window, used_tokens, used_requests = self.counters.get(key, (None, 0, 0))
+            if counted_window == window:
+                self.counters[key] = (window, used_tokens - tokens, used_requests - requests)
+
+
+_backend: RateLimitBackend = None
+
+
+def get_backend() -> RateLimitBackend:
+    global _backend
+    if _backend is None:
+        if constants.RATE_LIMIT_TABLE:
+            _backend = DynamoDBRateLimitBackend()
+        else:
+            _backend = InMemoryRateLimitBackend()
+    return _backend
+
+
+def set_backend(backend: RateLimitBackend):
+    global _backend
+    _backend = backend
+
+
+def current_window() -> int:
+    # コンテナ間で揃えるため、単調時計ではなく壁時計で区切る
+    return int(time.time() // constants.RATE_LIMIT_WINDOW_SECONDS)
+
+
+def buckets_for(model: str, user_id: str = None, channel: str = None) -> Tuple[Bucket, ...]:
+    # 1人のユーザや1つのチャンネルがモデルの上限を使い切らないよう、それぞれに割合で上限を設ける
+    token_limit, request_limit = constants.CHAT_GPT_RATE_LIMITS[model]
+    buckets: List[Bucket] = []
+    if user_id:
+        buckets.append(_share(f"{model}:user:{user_id}", token_limit, request_limit,
+                              constants.RATE_LIMIT_USER_SHARE))
+    if channel:
+        buckets.append(_share(f"{model}:channel:{channel}", token_limit, request_limit,
+                              constants.RATE_LIMIT_CHANNEL_SHARE))
+    buckets.append(Bucket(f"{model}:model", token_limit, request_limit))
+    return tuple(buckets)
+
+
+def _share(key: str, token_limit: int, request_limit: int, share: float) -> Bucket:
+    return Bucket(key, int(token_limit * share), max(1, int(request_limit * share)))
+
+
+def acquire(
+        model: str,
+        tokens: int,
+        user_id: str = None,
+        channel: str = None,
+        deadline: resilience.Deadline = None) -> RateLimitLease:
+    if not constants.RATE_LIMIT_ENABLED or model not in constants.CHAT_GPT_RATE_LIMITS:
+        return None
+
+    buckets = buckets_for(model, user_id, channel)
+    max_wait_seconds = constants.RATE_LIMIT_MAX_WAIT_SECONDS
+    if deadline:
+        max_wait_seconds = min(max_wait_seconds, deadline.remaining())
+    give_up_at = time.monotonic() + max_wait_seconds
+
+    while True:
+        window = current_window()
+        denied = _consume_all(buckets, window, tokens)
+        if denied is None:
+            return RateLimitLease(buckets, window, tokens)
+
+        # 次のウィンドウまで待てるなら待ち、待てないならOpenAIに送らずに諦める
+        next_window_at = (window + 1) * constants.RATE_LIMIT_WINDOW_SECONDS
+        delay = next_window_at - time.time() + random.uniform(0, 1)
+        if time.monotonic() + delay > give_up_at:
+            logger.warning("Rate limit exceeded, shedding: %s tokens=%d", denied.key, tokens)
+            tracing.incr("rate_limit.shed")
+            raise RateLimitExceededError(f"Rate limit exceeded: {denied.key}")
+        logger.info("Rate limit exceeded, waiting %.2fs: %s tokens=%d", delay, denied.key, tokens)
+        tracing.incr("rate_limit.waits")
+        with tracing.span("rate_limit.wait"):
+            time.sleep(delay)
+
+
+def _consume_all(buckets: Tuple[Bucket, ...], window: int, tokens: int) -> Bucket:
+    # 範囲の狭いバケットから確保し、どこかで弾かれたら確保済みの分を戻す
+    backend = get_backend()
+    consumed: List[Bucket] = []
+    for bucket in buckets:
+        if not backend.consume(
+                bucket.key, window, tokens, bucket.token_limit, bucket.request_limit):
+            for consumed_bucket in consumed:
+                backend.refund(consumed_bucket.key, window, tokens, 1)
+            return bucket
+        consumed.append(bucket)
+    return None
+
+
+def settle(lease: RateLimitLease, used_tokens: int):
+    # 見積もり(max_tokensを含む)より実際の使用量が少なければ、差分を他のリクエストに回す
+    if lease is None or lease.window != current_window():
+        return
+    unused_tokens = lease.tokens - used_tokens
+    if unused_tokens <= 0:
+        return
+    backend = get_backend()
+    for bucket in lease.buckets:
+        backend.refund(bucket.key, lease.window, unused_tokens, 0)
+
+
+def release(lease: RateLimitLease):
+    # OpenAIに受け付けられなかったリクエストの分を戻す
+    if lease is None or lease.window != current_window():
+        return
+    backend = get_backend()
+    for bucket in lease.buckets:
+        backend.refund(bucket.key, lease.window, lease.tokens, 1)
@@ -0,0 +1,215 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
+from typing import Any, Callable, Dict
+
+import constants
+import tracing
+import utils
+from errors import CircuitOpenError, DeadlineExceededError
+from openai.error import (APIConnectionError, APIError, RateLimitError,
+                          ServiceUnavailableError, Timeout)
+
+logger = utils.setup_logger(__name__)
+
+RETRYABLE_ERRORS = (
+    RateLimitError,
+    ServiceUnavailableError,
+    APIError,
+    APIConnectionError,
+    Timeout,
+)
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_context(cls, context) -> "Deadline":
+        # Slackにエラーを返す時間を残して、Lambdaの残り時間を処理全体の締め切りにする
+        if context is None:
+            return cls(constants.CHAT_GPT_DEFAULT_DEADLINE_SECONDS)
+        remaining_seconds = context.get_remaining_time_in_millis() / 1000
+        return cls(remaining_seconds - constants.LAMBDA_DEADLINE_MARGIN_SECONDS)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN \
+                    and time.monotonic() - self.opened_at >= self.reset_timeout_seconds:
+                # 一定時間経ったら1件だけ試して、回復したかを確認する
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Circuit opened: %s", self.name)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+# モデルごとのサーキットブレーカーとレイテンシ。コンテナ内で共有する
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_latencies: Dict[str, deque] = {}
+_lock = threading.Lock()
+_hedge_executor = ThreadPoolExecutor(max_workers=constants.CHAT_GPT_HEDGE_MAX_WORKERS)
+
+
+def circuit_breaker(name: str) -> CircuitBreaker:
+    with _lock:
+        if name not in _circuit_breakers:
+            _circuit_breakers[name] = CircuitBreaker(
+                name,
+                constants.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                constants.CIRCUIT_BREAKER_RESET_TIMEOUT_SECONDS
+            )
+        return _circuit_breakers[name]
+
+
+def record_latency(name: str, seconds: float):
+    with _lock:
+        if name not in _latencies:
+            _latencies[name] = deque(maxlen=constants.CHAT_GPT_LATENCY_WINDOW_SIZE)
+        _latencies[name].append(seconds)
+
+
+def latency_percentile(name: str, percentile: float) -> float:
+    with _lock:
+        latencies = sorted(_latencies.get(name) or [])
+    if len(latencies) < constants.CHAT_GPT_HEDGE_MIN_SAMPLES:
+        return None
+    index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+    return latencies[index]
+
+
+def retry_after_seconds(error: Exception) -> float:
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def backoff_seconds(attempt: int, retry_after: float = None) -> float:
+    # Full Jitter: https://aws.amazon.com/jp/blogs/architecture/exponential-backoff-and-jitter/
+    delay = random.uniform(
+        0,
+        min(constants.RETRY_MAX_BACKOFF_SECONDS, constants.RETRY_BASE_BACKOFF_SECONDS * 2 ** attempt)
+    )
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def call_with_retry(
+        name: str,
+        request: Callable[[float], Any],
+        deadline: Deadline) -> Any:
+    # requestにはタイムアウトの秒数を渡す
+    breaker = circuit_breaker(name)
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            tracing.incr("openai.circuit_open")
+            raise CircuitOpenError(f"Circuit is open: {name}")
+        if deadline.expired():
+            raise DeadlineExceededError(f"Deadline exceeded: {name}")
+
+        started_at = time.monotonic()
+        try:
+            result = request(min(deadline.remaining(), constants.OPEN_AI_REQUEST_TIMEOUT_SECONDS))
+        except RETRYABLE_ERRORS as e:
+            breaker.record_failure()
+            delay = backoff_seconds(attempt, retry_after_seconds(e))
+            attempt += 1
+            if attempt > constants.RETRY_MAX_ATTEMPTS or delay >= deadline.remaining():
+                raise
+            logger.warning("Retrying %s in %.2fs (%d): %s", name, delay, attempt, e)
+            tracing.incr("openai.retries")
+            time.sleep(delay)
+            continue
+        except Exception:
+            # 不正なリクエストなどのエラーはサービス自体は応答しているため、障害として数えない
+            breaker.record_success()
+            raise
+
+        breaker.record_success()
+        record_latency(name, time.monotonic() - started_at)
+        return result
+
+
+def hedge(
+        request: Callable[[str], Any],
+        name: str,
+        hedge_name: str,
+        discard: Callable[[Any], None] = None) -> Any:
+    # nameへのリクエストが普段のレイテンシ(パーセンタイル)を超えたら、hedge_nameにも同時に送り、早い方を使う
+    hedge_after = latency_percentile(name, constants.CHAT_GPT_HEDGE_PERCENTILE)
+    if hedge_after is None:
+        return request(name)
+
+    primary = _hedge_executor.submit(request, name)
+    try:
+        return primary.result(timeout=hedge_after)
+    except FutureTimeoutError:
+        pass
+
+    logger.info("Hedging %s with %s after %.2fs", name, hedge_name, hedge_after)
+    tracing.incr("openai.hedged")
+    secondary = _hedge_executor.submit(request, hedge_name)
+    pending = {primary, secondary}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((f for f in done if f.exception() is None), None)
+        if winner is None:
+            error = error or next(iter(done)).exception()
+            continue
+        # 遅れて返ってきた方の結果は破棄する
+        for loser in (primary, secondary):
+            if loser is not winner:
+                loser.add_done_callback(lambda f: _discard_result(f, discard))
+        return winner.result()
+    raise error
+
+
+def _discard_result(future: Future, discard: Callable[[Any], None]):
+    if discard and future.exception() is None:
+        discard(future.result())
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, List, Tuple
+
+import clients
+import constants
+import openai
+import resilience
+import tracing
+import utils
+from cache import TTLCache
+from dynamo_db_client import DynamoDBClient, UserConfigItem
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = utils.setup_logger(__name__)
+
+_re_whitespace = re.compile(r"\s+")
+
+# cache_key -> 応答。DynamoDBに問い合わせる前にウォームコンテナ内で返す
+_response_cache = TTLCache(
+    max_size=constants.RESPONSE_CACHE_SIZE,
+    ttl_seconds=constants.RESPONSE_CACHE_TTL_SECONDS
+)
+response_cache_stats = Counter()
+
+
+@dataclass
+class CacheLookup:
+    model: str
+    key: str
+    # モデルとシステムプロンプトが同じものだけを類似検索の対象にする
+    scope: str
+    question: str = None
+    embedding: Any = None
+    content: str = None
+
+
+class VectorIndex:
+    # 正規化した埋め込みベクトルを固定長の配列に持ち、内積(コサイン類似度)で最も近いものを探す
+    # 上限に達したら古いものから上書きする
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.vectors = None
+        self.scopes = numpy.zeros(capacity, dtype=numpy.int64)
+        self.keys: List[str] = [None] * capacity
+        self.size = 0
+        self.position = 0
+        self._lock = threading.Lock()
+
+    def add(self, scope: str, vector, key: str):
+        with self._lock:
+            if self.vectors is None:
+                self.vectors = numpy.zeros((self.capacity, len(vector)), dtype=numpy.float32)
+            self.vectors[self.position] = vector
+            self.scopes[self.position] = _scope_id(scope)
+            self.keys[self.position] = key
+            self.position = (self.position + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+
+    def search(self, scope: str, vector) -> Tuple[str, float]:
+        with self._lock:
+            if not self.size:
+                return None, 0.0
+            scores = self.vectors[:self.size] @ vector
+            scores[self.scopes[:self.size] != _scope_id(scope)] = -1.0
+            index = int(numpy.argmax(scores))
+            return self.keys[index], float(scores[index])
+
+
+_vector_index: VectorIndex = None
+
+
+def is_enabled(user_config: UserConfigItem) -> bool:
+    if not constants.RESPONSE_CACHE_ENABLED:
+        return False
+    return not (user_config and user_config.response_cache == "off")
+
+
+def lookup(model: str, messages: List[dict]) -> CacheLookup:
+    system_messages = [m for m in messages if m.get("role") == "system"]
+    conversation = [m for m in messages if m.get("role") != "system"]
+    cache_lookup = CacheLookup(
+        model=model,
+        key=_hash(model, messages),
+        scope=_hash(model, system_messages),
+    )
+
+    content = _get(cache_lookup.key)
+    if content is not None:
+        response_cache_stats["exact_hit"] += 1
+        tracing.incr("response_cache.exact_hit")
+        logger.info("Response cache hit: %s", cache_lookup.key)
+        cache_lookup.content = content
+        return cache_lookup
+
+    # 類似検索は、スレッドの最初の質問(前後の文脈がないもの)だけを対象にする
+    if _semantic_enabled() and len(conversation) == 1 and conversation[0].get("role") == "user":
+        cache_lookup.question = _normalize(conversation[0].get("content"))
+        cache_lookup.embedding = _embed(cache_lookup.question)
+        if cache_lookup.embedding is not None:
+            key, score = _get_vector_index().search(cache_lookup.scope, cache_lookup.embedding)
+            content = _get(key) if score >= constants.RESPONSE_CACHE_SIMILARITY_THRESHOLD else None
+            if content is not None:
+                response_cache_stats["semantic_hit"] += 1
+                tracing.incr("response_cache.semantic_hit")
+                logger.info("Response cache semantic hit: %s score=%.3f", key, score)
+                # 同じ言い回しの質問は次から完全一致で返す
+                _response_cache.set(cache_lookup.key, content)
+                cache_lookup.content = content
+                return cache_lookup
+
+    response_cache_stats["miss"] += 1
+    tracing.incr("response_cache.miss")
+    return cache_lookup
+
+
+def store(cache_lookup: CacheLookup, content: str):
+    if not content:
+        return
+    _response_cache.set(cache_lookup.key, content)
+    if constants.RESPONSE_CACHE_TABLE:
+        DynamoDBClient().put_item_to_response_cache(cache_lookup.key, cache_lookup.model, content)
+    if cache_lookup.embedding is not None:
+        _get_vector_index().add(cache_lookup.scope, cache_lookup.embedding, cache_lookup.key)
+
+
+def _get(key: str) -> str:
+    if key is None:
+        return None
+    content = _response_cache.get(key)
+    if content is None and constants.RESPONSE_CACHE_TABLE:
+        content = DynamoDBClient().get_item_from_response_cache(key)
+        if content is not None:
+            _response_cache.set(key, content)
+    return content
+
+
+def _normalize(text: str) -> str:
+    # 全角・半角や空白の違いだけのメッセージは同じものとして扱う
+    return _re_whitespace.sub(" ", unicodedata.normalize("NFKC", text or "")).strip()
+
+
+def _hash(model: str, messages: List[dict]) -> str:
+    normalized = [
+        [message.get("role"), _normalize(message.get("content"))]
+        for message in messages
+    ]
+    payload = json.dumps([model, normalized], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _scope_id(scope: str) -> int:
+    return int(scope[:15], 16)
+
+
+def _semantic_enabled() -> bool:
+    return constants.RESPONSE_CACHE_SEMANTIC_ENABLED and numpy is not None
+
+
+def _get_vector_index() -> VectorIndex:
+    global _vector_index
+    if _vector_index is None:
+        _vector_index = VectorIndex(constants.RESPONSE_CACHE_INDEX_SIZE)
+    return _vector_index
+
+
+def _embed(text: str):
+    # 埋め込みを取得できなくても、応答の生成は続ける
+    model = constants.RESPONSE_CACHE_EMBEDDING_MODEL
+    clients.setup_openai()
+    try:
+        response = resilience.call_with_retry(
+            model,
+            lambda timeout: openai.Embedding.create(
+                model=model,
+                input=text,
+                request_timeout=timeout
+            ),
+            resilience.Deadline(constants.OPEN_AI_REQUEST_TIMEOUT_SECONDS)
+        )
+    except Exception as e:
+        logger.warning("Failed to create embedding: %s", e)
+        return None
+
+    vector = numpy.asarray(response.get("data")[0].get("embedding"), dtype=numpy.float32)
+    norm = numpy.linalg.norm(vector)
+    return vector / norm if norm else None
@@ -0,0 +1,157 @@
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Tuple
+
+import constants
+import tracing
+import utils
+from slack_sdk.errors import SlackApiError
+
+logger = utils.setup_logger(__name__)
+
+# コンテナ内でレートリミットのために待った回数と、429で再試行した回数
+# メソッドごとの呼び出し回数は、リクエストごとにトレースで数える
+slack_call_stats = Counter()
+
+
+class Budget:
+    # トークンバケット。1秒あたりrate回ずつ回復し、capacity回まで続けて呼び出せる
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def available(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return now >= self.blocked_until and self.tokens >= 1
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def wait_seconds(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+    def block(self, seconds: float):
+        # 429のRetry-Afterの間は、同じワークスペースへの他の呼び出しも待たせる
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def budget_limits(method: str, channel: str = None) -> Tuple[str, float, float]:
+    # メソッド(chat.postMessageはチャンネルごと)の予算のキーと、1秒あたりの回復量、上限を返す
+    if method == "chat.postMessage" and channel:
+        return f"{method}:{channel}", constants.SLACK_CHANNEL_POSTS_PER_SECOND, constants.SLACK_CHANNEL_POST_BURST
+    if method in constants.SLACK_METHOD_TIERS:
+        per_minute = constants.SLACK_RATE_TIERS[constants.SLACK_METHOD_TIERS[method]]
+        return method, per_minute / 60, per_minute
+    return None, 0, 0
+
+
+def has_budget(client: Any, method: str, channel: str = None) -> bool:
+    # ストリーミング中の途中の更新など、省略できる呼び出しの前に確認する。予算がなければ次の呼び出しにまとめる
+    if not constants.SLACK_RATE_LIMIT_ENABLED or not isinstance(client, RateLimitedWebClient):
+        return True
+    return all(budget.available() for budget in client.budgets(method, channel))
+
+
+def acquire(budgets: List[Budget], method: str):
+    # 予算が回復するまで待つ。待ち時間が長すぎるときは待たずに呼び出し、429になったらRetry-Afterに従う
+    waited = 0.0
+    for budget in budgets:
+        while not budget.try_acquire():
+            delay = budget.wait_seconds()
+            if waited + delay > constants.SLACK_RATE_LIMIT_MAX_WAIT_SECONDS:
+                logger.warning("Calling %s without budget after waiting %.2fs", method, waited)
+                break
+            time.sleep(delay)
+            waited += delay
+
+    if waited:
+        slack_call_stats["throttled"] += 1
+        tracing.incr("slack.throttled")
+        tracing.record_span("slack.throttle_wait", waited)
+
+
+def retry_after_seconds(error: SlackApiError) -> float:
+    headers = getattr(error.response, "headers", None) or {}
+    for key, value in headers.items():
+        if key.lower() == "retry-after":
+            try:
+                return float(value)
+            except ValueError:
+                break
+    return 1.0
+
+
+class RateLimitedWebClient:
+    # WebClientのメソッド(chat_postMessageなど)を、Slackのメソッドごと・チャンネルごとの予算の中で呼び出す
+    # レートリミットの上限はワークスペースごとのため、予算はワークスペースのトークンごとのクライアントに持たせる
+    def __init__(self, client: Any):
+        self.client = client
+        self._budgets: Dict[str, Budget] = {}
+        self._lock = threading.Lock()
+
+    def budgets(self, method: str, channel: str = None) -> List[Budget]:
+        key, rate, capacity = budget_limits(method, channel)
+        if key is None:
+            return []
+        with self._lock:
+            if key not in self._budgets:
+                self._budgets[key] = Budget(rate, capacity)
+            return [self._budgets[key]]
+
+    def call(self, method: str, channel: str, request: Callable[[], Any]) -> Any:
+        attempt = 0
+        while True:
+            if constants.SLACK_RATE_LIMIT_ENABLED:
+                acquire(self.budgets(method, channel), method)
+            tracing.incr("slack.calls")
+            tracing.incr(f"slack.{method}")
+            try:
+                return request()
+            except SlackApiError as e:
+                if getattr(e.response, "status_code", None) != 429 or attempt >= constants.SLACK_RETRY_MAX_ATTEMPTS:
+                    raise
+                retry_after = retry_after_seconds(e)
+                attempt += 1
+                for budget in self.budgets(method, channel):
+                    budget.block(retry_after)
+                slack_call_stats["rate_limited"] += 1
+                tracing.incr("slack.rate_limited")
+                logger.warning("Rate limited on %s, retrying in %.2fs (%d)", method, retry_after, attempt)
+                time.sleep(retry_after)
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.client, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        method = name.replace("_", ".")
+
+        def wrapper(*args, **kwargs):
+            return self.call(method, kwargs.get("channel"), lambda: attribute(*args, **kwargs))
+
+        return wrapper
+
+
+def reset():
+    slack_call_stats.clear()
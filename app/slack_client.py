@@ -1,8 +1,15 @@
+import time
 from dataclasses import dataclass
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, List, Tuple
 
+import clients
 import constants
+import log
+import slack_api
+import thread_history
+import tracing
 import utils
+from dynamo_db_client import ThreadHistoryItem
 from slack_sdk import WebClient
 
 logger = utils.setup_logger(__name__)
@@ -12,12 +19,21 @@ logger = utils.setup_logger(__name__)
 class SlackClient:
     channel: str
     thread_ts: str
-    client: WebClient = WebClient(constants.SLACK_BOT_TOKEN)
+    client: WebClient = None
     thread_messages: list = None
+    # このリクエストでスレッドに投稿し、まだ削除していないメッセージのts(ストリーミングで続きを書いたものも含む)
+    posted_ts: list = None
 
     def __post_init__(self):
+        if self.client is None:
+            self.client = clients.slack_web_client()
         if self.thread_messages is None:
             self.thread_messages = []
+        if self.posted_ts is None:
+            self.posted_ts = []
+
+    def thread_key(self) -> str:
+        return thread_history.thread_key(self.channel, self.thread_ts)
 
     def _append_assistant_role(self, text: str) -> dict:
         return self.thread_messages.append(
@@ -26,32 +42,36 @@ class SlackClient:
     def _append_user_role(self, text: str) -> dict:
         return self.thread_messages.append({"role": "user", "content": text})
 
+    @tracing.traced("slack.thread_replies")
     def thread_replies(self, updated_text: str = None) -> List[Dict]:
-        messages: list = self.client.conversations_replies(
-            channel=self.channel, ts=self.thread_ts
-        ).get("messages")
-        logger.info(f'THREAD REPLIES: {messages}')
-
-        for message in messages:
-            text = message.get("text")
+        history = thread_history.load(self.thread_key())
+        oldest = None
+        if history is None:
+            history = ThreadHistoryItem(self.thread_key())
+        else:
+            # 最後のユーザのメッセージより後は、生成中に更新されたBotのメッセージを含むため取得し直す
+            oldest = thread_history.last_user_message_ts(history)
+            if oldest:
+                history.messages = [
+                    m for m in history.messages
+                    if thread_history.ts_order(m.get("ts")) <= thread_history.ts_order(oldest)
+                ]
+            else:
+                history.messages = []
 
-            # プログレスメッセージは無視する
-            if text == constants.SLACK_PROGRESS_MESSAGE:
-                continue
+        messages = self._fetch_replies(oldest)
+        logger.info("THREAD REPLIES: %s", log.summarize(messages))
+        logger.debug("THREAD REPLIES BODY: %s", messages)
 
-            # Botが送信したメッセージの場合
-            if message.get("bot_id"):
-                text = utils.remove_mention(text)
-                self._append_assistant_role(text)
+        for message in messages:
+            if oldest and thread_history.ts_order(message.get("ts")) <= thread_history.ts_order(oldest):
                 continue
+            chat_message = to_chat_message(message)
+            if chat_message:
+                history.messages.append(chat_message)
 
-            # ユーザがメンション指定している場合
-            if utils.mention_matches(text):
-                text = utils.remove_mention(text)
-                if text != "":
-                    self._append_user_role(text)
-
-                continue
+        thread_history.save(history)
+        self.thread_messages.extend(history.messages)
 
         # ユーザがメッセージを変更したとき、最新のメッセージとして扱う
         if updated_text:
@@ -59,6 +79,37 @@ class SlackClient:
 
         return self.thread_messages
 
+    @tracing.traced("slack.conversations_replies")
+    def _fetch_replies(self, oldest: str = None) -> List[Dict]:
+        # ページングしながら、oldestより新しいメッセージ(未指定の場合は全件)を取得する
+        messages = []
+        cursor = None
+        while True:
+            kwargs = {
+                "channel": self.channel,
+                "ts": self.thread_ts,
+                "limit": constants.SLACK_REPLIES_PAGE_LIMIT,
+            }
+            if oldest:
+                kwargs["oldest"] = oldest
+            if cursor:
+                kwargs["cursor"] = cursor
+            response = self.client.conversations_replies(**kwargs)
+            messages.extend(response.get("messages") or [])
+
+            cursor = (response.get("response_metadata") or {}).get("next_cursor")
+            if not response.get("has_more") or not cursor:
+                return messages
+
+    def patch_thread_history(self, message: dict):
+        thread_history.patch_message(
+            self.channel, self.thread_ts, message.get("ts"), to_chat_message(message)
+        )
+
+    def remove_from_thread_history(self, ts: str):
+        thread_history.patch_message(self.channel, self.thread_ts, ts, None)
+
+    @tracing.traced("slack.chat_post_message")
     def send_text_to_thread(self, text: str, user_id: str = None) -> str:
         if user_id:
             text = f'<@{user_id}>\n{text}'
@@ -68,19 +119,97 @@ class SlackClient:
             channel=self.channel,
             thread_ts=self.thread_ts
         )
-        return response.data.get("ts")
+        ts = response.data.get("ts")
+        self.posted_ts.append(ts)
+        return ts
 
+    @tracing.traced("slack.chat_post_message")
     def send_text_to_channel(self, text: str):
         self.client.chat_postMessage(
             text=text,
             channel=self.channel
         )
 
+    @tracing.traced("slack.chat_update")
+    def update_sent_text(self, ts: str, text: str):
+        self.client.chat_update(
+            text=text,
+            channel=self.channel,
+            ts=ts
+        )
+
+    @tracing.traced("slack.stream")
+    def stream_text_to_thread(
+            self, chunks: Iterable[str], ts: str, user_id: str = None) -> str:
+        # 送信済みのメッセージ(ts)を、生成されたテキストで順次更新する
+        # 編集で追加したメンションは通知されないため、tsはuser_idへのメンション付きで送信しておく
+        prefix = f'<@{user_id}>\n' if user_id else ''
+        text = prefix
+        sent_text = text
+        rolled_over = False
+        last_updated_at = time.monotonic()
+
+        for chunk in chunks:
+            text += chunk
+
+            # 1メッセージの上限を超えたら、新しいメッセージに続きを書く
+            while len(text.encode('utf-8')) > constants.SLACK_MAX_EDIT_BYTE_SIZE:
+                first_chunk, text = utils.separate_text_with_chunk_size(
+                    text, constants.SLACK_MAX_EDIT_BYTE_SIZE
+                )
+                self.update_sent_text(ts, first_chunk)
+                ts = self.send_text_to_thread(constants.SLACK_PROGRESS_MESSAGE)
+                prefix = ''
+                sent_text = ''
+                rolled_over = True
+                last_updated_at = time.monotonic()
+
+            # 更新回数を抑えるため、一定時間または一定サイズごとにまとめて更新する
+            elapsed = time.monotonic() - last_updated_at
+            pending_byte_size = len(text.encode('utf-8')) - len(sent_text.encode('utf-8'))
+            # chat.updateの予算が足りないときは、途中の更新を省略して次の更新にまとめる
+            if text.strip() and (
+                elapsed >= constants.SLACK_STREAM_UPDATE_INTERVAL_SECONDS
+                or pending_byte_size >= constants.SLACK_STREAM_UPDATE_BYTE_SIZE
+            ) and slack_api.has_budget(self.client, "chat.update"):
+                self.update_sent_text(ts, text)
+                sent_text = text
+                last_updated_at = time.monotonic()
+
+        # メンションだけで本文がないときも、プログレスメッセージを残さない
+        if not text[len(prefix):].strip():
+            if rolled_over:
+                # 続きのメッセージに書く分が残らなかったときは消す
+                self.delete_sent_text(ts)
+            else:
+                # 応答が空だったときは、そのことを伝える
+                self.update_sent_text(ts, prefix + constants.SLACK_EMPTY_ANSWER_MESSAGE)
+        elif text != sent_text:
+            self.update_sent_text(ts, text)
+
+        return ts
+
+    def replace_sent_text(self, ts: str, text: str, user_id: str = None) -> str:
+        # 削除して投稿し直す代わりに、送信済みのメッセージ(プログレスメッセージ)を1回の更新で応答に書き換える
+        # 1メッセージの上限を超える分は、ストリーミングと同じく新しいメッセージに続きを書く
+        return self.stream_text_to_thread([text], ts, user_id)
+
+    @tracing.traced("slack.chat_delete")
     def delete_sent_text(self, ts: str):
         self.client.chat_delete(
             channel=self.channel,
             ts=ts
         )
+        if ts in self.posted_ts:
+            self.posted_ts.remove(ts)
+
+    def delete_posted_texts(self):
+        # 取り消しや失敗のとき、途中までの応答を続きのメッセージも含めてすべて消す
+        for ts in reversed(list(self.posted_ts)):
+            try:
+                self.delete_sent_text(ts)
+            except Exception:
+                logger.exception("Failed to delete posted message: %s", ts)
 
     def send_error_when_text_is_empty_or_no_mention(
             self, text: str) -> Tuple[bool, str]:
@@ -94,3 +223,49 @@ class SlackClient:
             return True, None
 
         return False, text
+
+
+@tracing.traced("slack.conversations_members")
+def channel_members(channel: str, client: WebClient = None) -> List[str]:
+    # conversations.membersはページングが必要なため、1ページを大きくしてリクエストの回数を減らす
+    client = client or clients.slack_web_client()
+    members = []
+    cursor = None
+    while True:
+        kwargs = {"channel": channel, "limit": constants.SLACK_MEMBERS_PAGE_LIMIT}
+        if cursor:
+            kwargs["cursor"] = cursor
+        response = client.conversations_members(**kwargs)
+        members.extend(response.get("members") or [])
+
+        cursor = (response.get("response_metadata") or {}).get("next_cursor")
+        if not cursor:
+            return members
+
+
+@tracing.traced("slack.usergroups_users_list")
+def usergroup_members(usergroup: str, client: WebClient = None) -> List[str]:
+    response = (client or clients.slack_web_client()).usergroups_users_list(usergroup=usergroup)
+    return response.get("users") or []
+
+
+def to_chat_message(message: dict) -> dict:
+    text = message.get("text")
+
+    # プログレスメッセージと空の応答の通知は無視する
+    if utils.remove_mention(text) in (constants.SLACK_PROGRESS_MESSAGE, constants.SLACK_EMPTY_ANSWER_MESSAGE):
+        return None
+
+    # Botが送信したメッセージの場合
+    if message.get("bot_id"):
+        text = utils.remove_mention(text)
+        return {"ts": message.get("ts"), "role": "assistant", "content": text}
+
+    # ユーザがメンション指定している場合
+    if utils.mention_matches(text):
+        text = utils.remove_mention(text)
+        _, text = utils.parse_model_override(text)
+        if text != "":
+            return {"ts": message.get("ts"), "role": "user", "content": text}
+
+    return None
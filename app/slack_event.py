@@ -0,0 +1,111 @@
+from typing import NamedTuple
+
+SLACK_MESSAGE_TYPE_APP_MENTION = "app_mention"
+SLACK_MESSAGE_TYPE_MESSAGE = "message"
+
+SLACK_MESSAGE_SUB_TYPE_MESSAGE_CHANGED = "message_changed"
+SLACK_MESSAGE_SUB_TYPE_MESSAGE_DELETED = "message_deleted"
+SLACK_MESSAGE_SUB_TYPE_MESSAGE_TOMBSTONE = "tombstone"
+
+KIND_MESSAGE = "message"
+KIND_EDIT = "edit"
+KIND_DELETE = "delete"
+KIND_BOT = "bot"
+
+_EMPTY = {}
+
+
+class SlackEvent(NamedTuple):
+    kind: str
+    channel: str = None
+    thread_ts: str = None
+    user: str = None
+    text: str = None
+    # 変更されたメッセージ(KIND_EDIT)
+    edited_message: dict = None
+    # 削除されたメッセージのts(KIND_DELETE)
+    deleted_ts: str = None
+
+    @property
+    def edited(self) -> bool:
+        return self.kind == KIND_EDIT
+
+    @property
+    def deleted(self) -> bool:
+        return self.kind == KIND_DELETE
+
+
+def is_bot_payload(raw_body: str) -> bool:
+    # JSONをデコードする前に、Botのイベント(ストリーミング中の更新を含む)を文字列の検索だけで弾く
+    # ユーザのテキスト中の引用符はエスケープされるため、"bot_id":が現れるのはキーの場合だけ
+    # 添付やスレッドの親メッセージにBotの情報を含むことがあるため、それらはデコードして判定する
+    if not raw_body or '"bot_id":' not in raw_body:
+        return False
+    return '"attachments":' not in raw_body and '"root":' not in raw_body
+
+
+def classify(body_event: dict) -> SlackEvent:
+    # イベントの種類と、処理に必要な値を1回の走査で取り出す
+    body_event = body_event or _EMPTY
+    subtype = body_event.get("subtype")
+    message = body_event.get("message")
+    previous_message = body_event.get("previous_message")
+    message_or_empty = message or _EMPTY
+
+    if _triggered_by_bot(body_event, subtype, message, previous_message):
+        return SlackEvent(KIND_BOT)
+
+    thread_ts = body_event.get("thread_ts")
+    if not thread_ts:
+        if message:
+            thread_ts = message.get("thread_ts")
+        else:
+            thread_ts = body_event.get("ts")
+
+    channel = body_event.get("channel")
+    user = body_event.get("user") or message_or_empty.get("user")
+
+    # DMでユーザがメッセージを削除したとき
+    # 削除した後に、削除したメッセージがSlackBotの投稿に変わってイベントが発生することもある
+    if (subtype == SLACK_MESSAGE_SUB_TYPE_MESSAGE_DELETED
+            and previous_message and previous_message.get("client_msg_id")) \
+            or (subtype == SLACK_MESSAGE_SUB_TYPE_MESSAGE_CHANGED
+                and message_or_empty.get("subtype") == SLACK_MESSAGE_SUB_TYPE_MESSAGE_TOMBSTONE):
+        return SlackEvent(
+            KIND_DELETE, channel, thread_ts, user,
+            deleted_ts=body_event.get("deleted_ts") or message_or_empty.get("ts")
+        )
+
+    # DMでユーザがメッセージを変更したとき
+    if subtype == SLACK_MESSAGE_SUB_TYPE_MESSAGE_CHANGED and message_or_empty.get("client_msg_id"):
+        return SlackEvent(
+            KIND_EDIT, channel, thread_ts, user, message.get("text"), edited_message=message
+        )
+    # チャンネルでユーザがメッセージを変更したとき
+    if body_event.get("client_msg_id") and body_event.get("edited"):
+        return SlackEvent(
+            KIND_EDIT, channel, thread_ts, user, body_event.get("text"), edited_message=body_event
+        )
+
+    return SlackEvent(KIND_MESSAGE, channel, thread_ts, user, body_event.get("text"))
+
+
+def _triggered_by_bot(
+        body_event: dict, subtype: str, message: dict, previous_message: dict) -> bool:
+    # Botによるメッセージ送信がトリガーとなったとき
+    if body_event.get("bot_id"):
+        return True
+
+    # Botによるメッセージ変更、削除がトリガーとなったとき
+    if subtype not in (SLACK_MESSAGE_SUB_TYPE_MESSAGE_CHANGED, SLACK_MESSAGE_SUB_TYPE_MESSAGE_DELETED):
+        return False
+    if message and message.get("bot_id"):
+        return True
+    if previous_message and previous_message.get("bot_id"):
+        return True
+
+    # DMの場合、Botのメッセージを削除から追加すると、送信元であるユーザーのメッセージ変更が発火されてしまう
+    if message and previous_message:
+        return message.get("text") == previous_message.get("text")
+
+    return False
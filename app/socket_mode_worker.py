@@ -0,0 +1,131 @@
+# Lambdaの代わりに、Slack Socket Modeで常駐してイベントを処理するワーカー
+#   $ SLACK_APP_TOKEN=xapp-... python socket_mode_worker.py
+# イベントごとの処理はlambda_functionと同じ。Slack・OpenAI・DynamoDBのクライアントと接続プールはプロセス内で共有する
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Callable, Dict, List, Set
+
+import constants
+import lambda_function
+import slack_event
+import usage_ledger
+import utils
+from slack_sdk.socket_mode.request import SocketModeRequest
+from slack_sdk.socket_mode.response import SocketModeResponse
+
+if TYPE_CHECKING:
+    from slack_sdk.socket_mode.async_client import AsyncBaseSocketModeClient
+
+logger = utils.setup_logger(__name__)
+
+
+class SocketModeWorker:
+    def __init__(
+            self,
+            client: "AsyncBaseSocketModeClient",
+            handler: Callable[[dict], dict] = None,
+            max_workers: int = constants.SOCKET_MODE_MAX_WORKERS,
+            max_events_per_user: int = constants.SOCKET_MODE_MAX_EVENTS_PER_USER,
+            max_pending_events: int = constants.SOCKET_MODE_MAX_PENDING_EVENTS):
+        self.client = client
+        self.handler = handler or lambda_function.handle_slack_event
+        self.max_events_per_user = max_events_per_user
+        self.max_pending_events = max_pending_events
+        # OpenAIやboto3は同期のAPIのため、イベントの処理は上限のあるスレッドプールで行う
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="socket-mode-worker")
+        self.worker_slots = asyncio.Semaphore(max_workers)
+        # user_id -> [Semaphore, 処理中または待っているイベントの数]
+        self.user_slots: Dict[str, List] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.accepting = True
+        client.socket_mode_request_listeners.append(self.on_request)
+
+    async def on_request(self, client: "AsyncBaseSocketModeClient", request: SocketModeRequest):
+        # 停止中や処理待ちが多すぎるときはackしない。Slackが別の接続に再送する
+        if not self.accepting or len(self.tasks) >= self.max_pending_events:
+            logger.warning("Not accepting envelope %s (pending=%d)", request.envelope_id, len(self.tasks))
+            return
+
+        # Slackの3秒タイムアウト内に応答するため、処理の前にackを返す
+        await client.send_socket_mode_response(SocketModeResponse(envelope_id=request.envelope_id))
+        if request.type != "events_api":
+            return
+
+        task = asyncio.ensure_future(self._process(request.payload))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _process(self, body: dict):
+        loop = asyncio.get_running_loop()
+        try:
+            # 重複の確認はDynamoDBを呼ぶため、イベントの処理とは別のスレッドで行う
+            if not await loop.run_in_executor(None, lambda_function.accept_event, body):
+                return
+
+            user_id = slack_event.classify(body.get("event")).user
+            async with self._user_slot(user_id):
+                async with self.worker_slots:
+                    await loop.run_in_executor(self.executor, self.handler, body)
+        except Exception:
+            logger.exception("Failed to process Socket Mode event")
+
+    @asynccontextmanager
+    async def _user_slot(self, user_id: str):
+        # 1人のユーザのイベントがワーカーを占有しないよう、ワーカーを確保する前にユーザごとの上限で待つ
+        slot = self.user_slots.get(user_id)
+        if slot is None:
+            slot = self.user_slots[user_id] = [asyncio.Semaphore(self.max_events_per_user), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self.user_slots[user_id]
+
+    async def drain(self, timeout: float = constants.SOCKET_MODE_DRAIN_TIMEOUT_SECONDS):
+        # 新しいイベントの受け付けを止め、処理中のイベントが終わるのを待ってから接続を閉じる
+        self.accepting = False
+        await self.client.close()
+        if self.tasks:
+            logger.info("Draining %d events", len(self.tasks))
+            _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+            if pending:
+                logger.warning("Gave up waiting for %d events", len(pending))
+        self.executor.shutdown(wait=False)
+        # 集計したままの使用量を書き込んでから終了する
+        await asyncio.get_running_loop().run_in_executor(None, usage_ledger.flush)
+
+
+def create_client() -> "AsyncBaseSocketModeClient":
+    from slack_sdk.socket_mode.aiohttp import SocketModeClient
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    return SocketModeClient(
+        app_token=constants.SLACK_APP_TOKEN,
+        web_client=AsyncWebClient(token=constants.SLACK_BOT_TOKEN, base_url=constants.SLACK_API_BASE_URL)
+    )
+
+
+async def run(client: "AsyncBaseSocketModeClient" = None, stop: asyncio.Event = None):
+    lambda_function.configure_concurrency(constants.SOCKET_MODE_MAX_WORKERS)
+    client = client or create_client()
+    worker = SocketModeWorker(client)
+
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    await client.connect()
+    logger.info("Socket Mode worker started (workers=%d)", constants.SOCKET_MODE_MAX_WORKERS)
+    await stop.wait()
+    await worker.drain()
+    logger.info("Socket Mode worker stopped")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,126 @@
+import time
+from dataclasses import replace
+from typing import List, Tuple
+
+import constants
+import utils
+from cache import TTLCache
+from dynamo_db_client import DynamoDBClient, ThreadHistoryItem
+
+logger = utils.setup_logger(__name__)
+
+# 変換済みのスレッド履歴をウォームコンテナ内に保持し、DynamoDBへの問い合わせも省く
+_thread_history_cache = TTLCache(
+    max_size=constants.THREAD_HISTORY_CACHE_SIZE,
+    ttl_seconds=constants.THREAD_HISTORY_TTL_SECONDS
+)
+# DynamoDBへの書き込みに失敗したスレッド。次に保存するときに、差分ではなくすべてのメッセージを書き込む
+_unsaved_keys = set()
+
+
+def thread_key(channel: str, thread_ts: str) -> str:
+    return f"{channel}:{thread_ts}"
+
+
+def channel_of(key: str) -> str:
+    return key.partition(":")[0] if key else None
+
+
+def ts_order(ts: str) -> Tuple[int, int]:
+    # Slackのtsは桁数が大きくfloatでは精度が足りないため、整数の組として比較する
+    seconds, _, micros = ts.partition(".")
+    return int(seconds), int(micros or 0)
+
+
+def load(key: str) -> ThreadHistoryItem:
+    item = _cached(key)
+    if item is None and constants.THREAD_HISTORY_TABLE:
+        try:
+            item = DynamoDBClient().query_items_from_thread_history(key)
+        except Exception:
+            # 読めないときはSlackからスレッド全体を取得し直す
+            logger.exception("Failed to load thread history: %s", key)
+            return None
+        if item is None or _is_expired(item):
+            return None
+        item.messages.sort(key=lambda m: ts_order(m.get("ts")))
+        item.messages = item.messages[-constants.THREAD_HISTORY_MAX_MESSAGES:]
+        _thread_history_cache.set(key, _copy(item))
+    if item is None:
+        return None
+    # キャッシュ上のオブジェクトを書き換えないようにコピーを返す
+    return _copy(item)
+
+
+def save(item: ThreadHistoryItem):
+    # メッセージごとに1項目として、前回保存したときから追加・変更・削除されたメッセージだけを書き込む
+    item.messages = item.messages[-constants.THREAD_HISTORY_MAX_MESSAGES:]
+    previous = None if item.thread_key in _unsaved_keys else _cached(item.thread_key)
+    if previous is None:
+        # スレッドの項目はすべて、この期限(要約の項目の期限)より後に期限切れになる
+        item.expires_at = int(time.time()) + constants.THREAD_HISTORY_TTL_SECONDS
+    else:
+        item.expires_at = previous.expires_at
+    _thread_history_cache.set(item.thread_key, _copy(item))
+    if not constants.THREAD_HISTORY_TABLE:
+        return
+
+    put_messages, deleted_ts = _diff(previous, item)
+    put_summary = previous is None or (previous.summary, previous.summarized_until_ts) \
+        != (item.summary, item.summarized_until_ts)
+    if not put_messages and not deleted_ts and not put_summary:
+        return
+
+    try:
+        DynamoDBClient().batch_write_items_to_thread_history(item, put_messages, deleted_ts, put_summary)
+        _unsaved_keys.discard(item.thread_key)
+    except Exception:
+        # 履歴を書き込めなくても応答は続け、このコンテナではキャッシュの履歴を使う
+        logger.exception("Failed to save thread history: %s", item.thread_key)
+        _unsaved_keys.add(item.thread_key)
+
+
+def _cached(key: str) -> ThreadHistoryItem:
+    item = _thread_history_cache.get(key)
+    return None if item is None or _is_expired(item) else item
+
+
+def _is_expired(item: ThreadHistoryItem) -> bool:
+    # 要約の項目が期限切れになったら、メッセージの項目が欠けている可能性があるため履歴を使わない
+    return item.expires_at is not None and item.expires_at <= time.time()
+
+
+def _copy(item: ThreadHistoryItem) -> ThreadHistoryItem:
+    return replace(item, messages=[dict(m) for m in item.messages])
+
+
+def _diff(previous: ThreadHistoryItem, item: ThreadHistoryItem) -> Tuple[List[dict], List[str]]:
+    previous_messages = {m.get("ts"): m for m in previous.messages} if previous else {}
+    messages = {m.get("ts"): m for m in item.messages if m.get("ts")}
+    put_messages = [m for ts, m in messages.items() if previous_messages.get(ts) != m]
+    # 古いメッセージは件数の上限を超えたものも含めて削除し、スレッドの項目数を上限までに保つ
+    deleted_ts = [ts for ts in previous_messages if ts and ts not in messages]
+    return put_messages, deleted_ts
+
+
+def last_user_message_ts(item: ThreadHistoryItem) -> str:
+    for message in reversed(item.messages):
+        if message.get("role") == "user":
+            return message.get("ts")
+    return None
+
+
+def patch_message(channel: str, thread_ts: str, ts: str, chat_message: dict):
+    # ユーザがメッセージを変更・削除したとき、キャッシュ済みの履歴にも反映する
+    # chat_messageがNoneの場合は履歴から削除する
+    item = load(thread_key(channel, thread_ts))
+    if item is None:
+        return
+
+    messages = [m for m in item.messages if m.get("ts") != ts]
+    if chat_message is not None:
+        messages.append(chat_message)
+        messages.sort(key=lambda m: ts_order(m.get("ts")))
+    item.messages = messages
+    save(item)
+    logger.info("Patched thread history: %s %s", item.thread_key, ts)
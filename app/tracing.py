@@ -0,0 +1,192 @@
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+from typing import Any, Callable, Dict
+
+import constants
+import utils
+
+logger = utils.setup_logger(__name__)
+
+
+class Trace:
+    # 1回の呼び出しで計測した処理ごとの時間(ミリ秒)と回数。プリフェッチのスレッドからも書き込む
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.spans = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.properties = {"Path": "ingress"}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, milliseconds: float):
+        with self._lock:
+            self.spans[name] += milliseconds
+
+    def incr(self, name: str, value: int):
+        with self._lock:
+            self.counters[name] += value
+
+    def to_emf(self) -> dict:
+        # CloudWatch Embedded Metric Format。1行のJSONからメトリクスが作られる
+        # https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+        with self._lock:
+            metrics = [{"Name": name, "Unit": "Milliseconds"} for name in self.spans]
+            metrics += [{"Name": name, "Unit": "Count"} for name in self.counters]
+            return {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [{
+                        "Namespace": constants.TRACING_NAMESPACE,
+                        "Dimensions": [["Service", "Path"]],
+                        "Metrics": metrics,
+                    }],
+                },
+                "Service": constants.TRACING_SERVICE_NAME,
+                **self.properties,
+                **{name: round(value, 3) for name, value in self.spans.items()},
+                **self.counters,
+            }
+
+
+class _Span:
+    __slots__ = ("trace", "name", "started_at")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add_span(self.name, (time.perf_counter() - self.started_at) * 1000)
+        return False
+
+
+class _NoopSpan:
+    # 計測していないときに返す。呼び出しごとにオブジェクトを作らない
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+# Lambdaのコンテナは一度に1つの呼び出しだけを処理するため、実行中のトレースは1つだけ持つ
+_current: Trace = None
+
+
+def span(name: str):
+    trace = _current
+    if trace is None:
+        return _NOOP_SPAN
+    return _Span(trace, name)
+
+
+def traced(name: str) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current
+            if trace is None:
+                return func(*args, **kwargs)
+            with _Span(trace, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_span(name: str, seconds: float):
+    # withで囲めない区間(ストリーミングの最初のトークンまでなど)を記録する
+    trace = _current
+    if trace is not None:
+        trace.add_span(name, seconds * 1000)
+
+
+def incr(name: str, value: int = 1):
+    trace = _current
+    if trace is not None:
+        trace.incr(name, value)
+
+
+def counters(prefix: str) -> Dict[str, int]:
+    # この呼び出しで数えた回数のうち、prefixで始まるもの。計測していないときは空
+    trace = _current
+    if trace is None:
+        return {}
+    with trace._lock:
+        return {name: value for name, value in trace.counters.items() if name.startswith(prefix)}
+
+
+def set_property(key: str, value: Any):
+    trace = _current
+    if trace is not None:
+        trace.properties[key] = value
+
+
+def traced_request(func: Callable) -> Callable:
+    # lambda_handlerに付け、呼び出しごとに1行のEMFを出力する
+    @wraps(func)
+    def wrapper(event, context):
+        global _current
+        if not constants.TRACING_ENABLED or _current is not None:
+            return func(event, context)
+
+        trace = Trace()
+        if context is not None:
+            trace.properties["RequestId"] = getattr(context, "aws_request_id", None)
+        _current = trace
+        profiler = _start_profiler()
+        try:
+            response = func(event, context)
+            if isinstance(response, dict):
+                trace.properties["StatusCode"] = response.get("statusCode")
+            return response
+        finally:
+            _current = None
+            trace.add_span("total", (time.perf_counter() - trace.started_at) * 1000)
+            _stop_profiler(profiler)
+            _emit(trace)
+    return wrapper
+
+
+def _emit(trace: Trace):
+    try:
+        sys.stdout.write(json.dumps(trace.to_emf(), ensure_ascii=False, default=str) + "\n")
+        sys.stdout.flush()
+    except Exception as e:
+        logger.warning("Failed to emit metrics: %s", e)
+
+
+def _start_profiler():
+    # 一部の呼び出しだけをプロファイルし、遅い処理の内訳をログに残す
+    if random.random() >= constants.TRACING_PROFILE_SAMPLE_RATE:
+        return None
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler):
+    if profiler is None:
+        return
+    import io
+    import pstats
+
+    profiler.disable()
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(
+        constants.TRACING_PROFILE_TOP_N
+    )
+    logger.info("PROFILE:\n%s", stream.getvalue())
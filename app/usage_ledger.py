@@ -0,0 +1,228 @@
+import signal
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, List
+
+import constants
+import tracing
+import utils
+from cache import TTLCache
+from dynamo_db_client import DynamoDBClient
+from errors import QuotaExceededError
+
+logger = utils.setup_logger(__name__)
+
+
+@dataclass(frozen=True)
+class Usage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    requests: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def __add__(self, other: "Usage") -> "Usage":
+        return Usage(
+            self.prompt_tokens + other.prompt_tokens,
+            self.completion_tokens + other.completion_tokens,
+            self.requests + other.requests
+        )
+
+
+class UsageBackend(ABC):
+    @abstractmethod
+    def add(self, usages: Dict[str, Usage]):
+        pass
+
+    @abstractmethod
+    def get(self, usage_keys: List[str]) -> Dict[str, Usage]:
+        pass
+
+
+class DynamoDBUsageBackend(UsageBackend):
+    # キーごとのアトミックカウンタに加算する。BatchWriteItemでは加算できないため、キーごとにUpdateItemする
+    def __init__(self):
+        self.dynamo_db_client = DynamoDBClient()
+
+    def add(self, usages: Dict[str, Usage]):
+        for usage_key, usage in usages.items():
+            self.dynamo_db_client.add_item_to_usage(
+                usage_key, usage.prompt_tokens, usage.completion_tokens, usage.requests
+            )
+
+    def get(self, usage_keys: List[str]) -> Dict[str, Usage]:
+        items = self.dynamo_db_client.batch_get_items_from_usage(usage_keys)
+        return {
+            usage_key: Usage(
+                int(item.get("prompt_tokens", 0)),
+                int(item.get("completion_tokens", 0)),
+                int(item.get("requests", 0))
+            )
+            for usage_key, item in items.items()
+        }
+
+
+class InMemoryUsageBackend(UsageBackend):
+    # テスト用。テーブルがないときはコンテナ内だけで集計する
+    def __init__(self):
+        self.usages: Dict[str, Usage] = {}
+        self._lock = threading.Lock()
+
+    def add(self, usages: Dict[str, Usage]):
+        with self._lock:
+            for usage_key, usage in usages.items():
+                self.usages[usage_key] = self.usages.get(usage_key, Usage()) + usage
+
+    def get(self, usage_keys: List[str]) -> Dict[str, Usage]:
+        with self._lock:
+            return {key: self.usages[key] for key in usage_keys if key in self.usages}
+
+
+_backend: UsageBackend = None
+
+# usage_key -> まだ書き込んでいない使用量。リクエストごとではなく、一定の間隔でまとめて書き込む
+# コンテナが停止の通知(SIGTERM)なしに破棄されると、最後の呼び出しから遡って
+# USAGE_FLUSH_INTERVAL_SECONDS以内に記録した分までは失われうる
+_pending: Dict[str, Usage] = {}
+_pending_lock = threading.Lock()
+# まだ書き込んでいない使用量のうち、最も古いものを記録した時刻
+_pending_since: float = None
+_shutdown_hook_installed = False
+
+# usage_key -> 書き込み済みの使用量。上限の確認のたびにDynamoDBを読まないようにする
+_usage_cache = TTLCache(max_size=constants.USAGE_CACHE_SIZE, ttl_seconds=constants.USAGE_CACHE_TTL_SECONDS)
+
+
+def get_backend() -> UsageBackend:
+    global _backend
+    if _backend is None:
+        if constants.USAGE_TABLE:
+            _backend = DynamoDBUsageBackend()
+        else:
+            _backend = InMemoryUsageBackend()
+    return _backend
+
+
+def set_backend(backend: UsageBackend):
+    global _backend
+    _backend = backend
+
+
+def current_bucket() -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+def usage_key(scope: str, scope_id: str, model: str, bucket: str = None) -> str:
+    # scopeは"user"または"channel"。日ごと・モデルごとに集計する
+    return f"{scope}#{scope_id}#{model}#{bucket or current_bucket()}"
+
+
+def record(user_id: str, channel: str, model: str, prompt_tokens: int, completion_tokens: int):
+    if not constants.USAGE_ENABLED:
+        return
+
+    usage = Usage(prompt_tokens, completion_tokens, 1)
+    bucket = current_bucket()
+    keys = [usage_key(scope, scope_id, model, bucket) for scope, scope_id in [("user", user_id), ("channel", channel)]
+            if scope_id]
+    global _pending_since
+    with _pending_lock:
+        for key in keys:
+            _pending[key] = _pending.get(key, Usage()) + usage
+        pending_keys = len(_pending)
+        if _pending_since is None:
+            _pending_since = time.monotonic()
+    tracing.incr("usage.tokens", usage.total_tokens)
+
+    if pending_keys >= constants.USAGE_FLUSH_MAX_KEYS:
+        flush()
+
+
+def flush_if_due():
+    # 呼び出しの終わりと、次の呼び出しの始まりに確認する。フリーズしていた間に古くなった分は始まりで書き込む
+    pending_since = _pending_since
+    if pending_since is not None and time.monotonic() - pending_since >= constants.USAGE_FLUSH_INTERVAL_SECONDS:
+        flush()
+
+
+def flush():
+    global _pending_since
+    with _pending_lock:
+        pending = dict(_pending)
+        pending_since = _pending_since
+        _pending.clear()
+        _pending_since = None
+    if not pending:
+        return
+
+    try:
+        get_backend().add(pending)
+    except Exception:
+        # 書き込めなかった分は次の書き込みにまとめる
+        logger.exception("Failed to flush usage")
+        with _pending_lock:
+            for key, usage in pending.items():
+                _pending[key] = _pending.get(key, Usage()) + usage
+            _pending_since = min(pending_since, _pending_since or pending_since)
+        return
+
+    for key, usage in pending.items():
+        cached = _usage_cache.get(key)
+        if cached is not None:
+            _usage_cache.set(key, cached + usage)
+    tracing.incr("usage.flushed_keys", len(pending))
+
+
+def get_usages(usage_keys: List[str]) -> Dict[str, Usage]:
+    # 書き込み済みの使用量(キャッシュ)と、このコンテナでまだ書き込んでいない使用量を合わせる
+    usages = {}
+    missing = []
+    for key in usage_keys:
+        cached = _usage_cache.get(key)
+        if cached is None:
+            missing.append(key)
+        else:
+            usages[key] = cached
+    if missing:
+        stored = get_backend().get(missing)
+        for key in missing:
+            usages[key] = stored.get(key, Usage())
+            _usage_cache.set(key, usages[key])
+
+    with _pending_lock:
+        return {key: usage + _pending.get(key, Usage()) for key, usage in usages.items()}
+
+
+def check_quota(user_id: str, model: str):
+    quota = constants.USAGE_USER_DAILY_TOKEN_QUOTAS.get(model)
+    if not constants.USAGE_ENABLED or not quota or not user_id:
+        return
+
+    key = usage_key("user", user_id, model)
+    used = get_usages([key])[key].total_tokens
+    if used >= quota:
+        tracing.incr("usage.quota_exceeded")
+        raise QuotaExceededError(f"本日の{model}の利用上限({quota:,}トークン)に達しました。")
+
+
+def install_shutdown_hook():
+    # SIGTERMで停止するときに書き込む。Lambdaは拡張機能が登録されているときだけ、破棄する前にSIGTERMを送る
+    # シグナルハンドラはメインスレッドでしか登録できないため、Socket Modeのワーカーでは停止時のdrainで書き込む
+    global _shutdown_hook_installed
+    if _shutdown_hook_installed or threading.current_thread() is not threading.main_thread():
+        return
+    _shutdown_hook_installed = True
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle(signum, frame):
+        flush()
+        if callable(previous):
+            previous(signum, frame)
+        elif previous == signal.SIG_DFL:
+            raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, handle)
@@ -3,49 +3,49 @@ import hmac
 import logging
 import re
 import time
-from typing import Tuple
+from typing import List, Tuple
 
 import constants
+import log
 
+# メッセージごとに何度も使うため、パターンは読み込み時に一度だけコンパイルする
+_re_mention = re.compile(constants.RE_MENTION_PATTERN)
+_re_model_override = re.compile(constants.RE_MODEL_OVERRIDE_PATTERN)
 
-def setup_logger(name: str) -> logging.Logger:
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.INFO)
-    handler_format = logging.Formatter(
-        '[%(levelname)s]: %(asctime)s - %(name)s: %(message)s'
-    )
-    handler.setFormatter(handler_format)
-
-    logger.addHandler(handler)
-    logger.propagate = False
 
-    return logger
+def setup_logger(name: str) -> logging.Logger:
+    return log.setup_logger(name)
 
 
 def mention_matches(text: str) -> bool:
-    if not text:
+    # メンションを含まないメッセージは正規表現を使わずに判定する
+    if not text or "<@" not in text:
         return False
 
-    return re.search(constants.RE_MENTION_PATTERN, text)
+    return _re_mention.search(text)
 
 
 def remove_mention(text: str) -> str:
     if not text:
         return ""
+    if "<@" not in text:
+        return text.strip()
 
-    return re.sub(constants.RE_MENTION_PATTERN, '', text).strip()
+    return _re_mention.sub('', text).strip()
 
 
-def slack_sending_retry(headers: dict) -> bool:
-    if headers.get("X-Slack-Retry-Num"):
-        return True
-    return False
+def parse_model_override(text: str) -> Tuple[str, str]:
+    # "--model gpt-3.5-turbo 質問"のように、メッセージの先頭でモデルを指定できる
+    if not text or not text.startswith("--model"):
+        return None, text
+
+    match = _re_model_override.match(text)
+    if not match:
+        return None, text
+    return match.group(1), text[match.end():]
 
 
-def has_valid_signature(headers: dict, body: dict) -> bool:
+def has_valid_signature(headers: dict, body: str, secrets: List[bytes] = None) -> bool:
     timestamp = headers.get("X-Slack-Request-Timestamp")
     signature = headers.get("X-Slack-Signature")
     if not timestamp or not signature:
@@ -55,15 +55,14 @@ def has_valid_signature(headers: dict, body: dict) -> bool:
     if time_diff > 60 * 5:
         return False
 
-    request_body_sig = "v0=" + hmac.new(
-        constants.SLACK_SIGNING_SECRET,
-        f'v0:{timestamp}:{body}'.encode(),
-        hashlib.sha256
-    ).hexdigest()
-    if signature != request_body_sig:
-        return False
+    # ローテーション中は、どれか1つのシークレットで署名されていればよい
+    message = f'v0:{timestamp}:{body}'.encode()
+    for secret in constants.SLACK_SIGNING_SECRETS if secrets is None else secrets:
+        request_body_sig = "v0=" + hmac.new(secret, message, hashlib.sha256).hexdigest()
+        if hmac.compare_digest(signature, request_body_sig):
+            return True
 
-    return True
+    return False
 
 
 def is_command(command_name: str, text: str):
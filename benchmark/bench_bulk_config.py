@@ -0,0 +1,47 @@
+# チャンネルのメンバー全員にsystem_role_contentを設定するときの、DynamoDBへのリクエスト数と所要時間を計測する
+# 変更前と同じく1人ずつsetコマンドを実行する場合と、管理者が一括で設定する場合を比べる
+#   $ make bench-bulk-config
+import os
+import time
+
+os.environ.setdefault("ADMIN_USER_IDS", "U0ADMIN")
+
+import fakes  # noqa: E402
+
+import clients  # noqa: E402
+import dynamo_db_client  # noqa: E402
+from command_set import SetCommand  # noqa: E402
+
+MEMBERS = 500
+CHANNEL = "C00000001"
+SYSTEM_ROLE_CONTENT = "あなたは社内のアシスタントです。" * 10
+
+
+def run(web_client: fakes.FakeWebClient, dynamodb: fakes.FakeDynamoDBResource, commands: list) -> tuple:
+    clients.override("slack", web_client)
+    clients.override("dynamodb", dynamodb)
+    dynamo_db_client._user_config_cache.clear()
+    started_at = time.perf_counter()
+    for text, user_id in commands:
+        SetCommand(text, user_id).set_key_value()
+    return time.perf_counter() - started_at, dynamodb.calls()
+
+
+def main():
+    members = [f"U{i:08d}" for i in range(MEMBERS)]
+    for latency, unprocessed_rate in [(0.005, 0.0), (0.005, 0.1)]:
+        print(f"members={MEMBERS} dynamodb latency={latency}s unprocessed rate={unprocessed_rate}")
+        web_client = fakes.FakeWebClient()
+        web_client.members[CHANNEL] = members
+        for name, commands in [
+            ("per user (set x N)", [(f"set system_role_content {SYSTEM_ROLE_CONTENT}", u) for u in members]),
+            ("bulk (set <#C...>)", [(f"set <#{CHANNEL}|general> system_role_content {SYSTEM_ROLE_CONTENT}", "U0ADMIN")]),
+        ]:
+            dynamodb = fakes.FakeDynamoDBResource(latency=latency, unprocessed_rate=unprocessed_rate)
+            duration, calls = run(web_client, dynamodb, commands)
+            stored = len(dynamodb.Table(os.environ["USER_CONFIG_TABLE"]).items)
+            print(f"  {name:<20} {duration * 1000:8.1f}ms  requests={sum(calls.values()):4d} {dict(calls)}  stored={stored}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Lambdaのコールドスタート時の初期化時間(モジュールのimportとハンドラの初回呼び出し)を計測する
+#   $ make bench-coldstart
+#   $ python benchmark/bench_coldstart.py app/package  # ビルドしたパッケージを計測する場合
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+import fakes  # noqa: F401 必須の環境変数にダミー値を入れる
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+ITERATIONS = 5
+TOP_MODULES = 15
+
+RE_IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+# 新しいプロセスで、コールドスタート時と同じ順に読み込み・呼び出しを行う
+INIT_SCRIPT = """
+import json, time
+started_at = time.perf_counter()
+import lambda_function
+imported_at = time.perf_counter()
+lambda_function.lambda_handler({"headers": {}, "body": "{}"}, None)
+rejected_at = time.perf_counter()
+import chat_gpt_client, slack_client, command_set, command_list, command_clear
+worker_imported_at = time.perf_counter()
+print(json.dumps({
+    "import": imported_at - started_at,
+    "first_rejected_request": rejected_at - imported_at,
+    "worker_imports": worker_imported_at - rejected_at,
+}))
+"""
+
+
+def measure_init(path: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", INIT_SCRIPT],
+        cwd=path, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure_import_times(path: str) -> list:
+    # (cumulative_us, self_us, module)。lambda_functionとその直下で読み込まれたモジュールだけを返す
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import lambda_function"],
+        cwd=path, capture_output=True, text=True, check=True
+    )
+    import_times = []
+    for line in result.stderr.splitlines():
+        match = RE_IMPORT_TIME.match(line)
+        if match and len(match.group(3)) <= 2:
+            import_times.append((int(match.group(2)), int(match.group(1)), match.group(4)))
+    return sorted(import_times, reverse=True)
+
+
+def main():
+    path = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else APP_DIR)
+
+    print(f"import time of lambda_function (python -X importtime, {path}):")
+    for cumulative, self_time, module in measure_import_times(path)[:TOP_MODULES]:
+        print(f"  {module:<30} cumulative={cumulative / 1000:8.1f}ms self={self_time / 1000:8.1f}ms")
+
+    inits = [measure_init(path) for _ in range(ITERATIONS)]
+    print(f"init duration (median of {ITERATIONS} cold processes):")
+    for key in inits[0]:
+        print(f"  {key:<30} {statistics.median(i[key] for i in inits) * 1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# 記録したSlackのイベント(slack_events.json)を使って、イベントの判定処理のスループットを計測する
+#   $ make bench-event-classifier
+import json
+import os
+import time
+
+import fakes  # noqa: F401 必須の環境変数にダミー値を入れる
+
+import slack_client
+import slack_event
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "slack_events.json")
+ITERATIONS = 20000
+
+
+def decode_and_classify(raw_bodies: list):
+    for raw_body in raw_bodies:
+        slack_event.classify(json.loads(raw_body).get("event"))
+
+
+def fast_path_classify(raw_bodies: list):
+    # lambda_handlerと同じく、Botのイベントはデコードせずに弾く
+    for raw_body in raw_bodies:
+        if slack_event.is_bot_payload(raw_body):
+            continue
+        slack_event.classify(json.loads(raw_body).get("event"))
+
+
+def convert_messages(messages: list):
+    for message in messages:
+        slack_client.to_chat_message(message)
+
+
+def events_per_second(run, items: list) -> float:
+    started_at = time.perf_counter()
+    for _ in range(ITERATIONS):
+        run(items)
+    return ITERATIONS * len(items) / (time.perf_counter() - started_at)
+
+
+def main():
+    with open(CORPUS_PATH) as f:
+        bodies = json.load(f)
+    # Slackから届くのと同じ、空白のないJSON文字列にする
+    raw_bodies = [json.dumps(body, ensure_ascii=False, separators=(",", ":")) for body in bodies]
+    messages = [body["event"].get("message") or body["event"] for body in bodies]
+
+    print(f"corpus: {len(raw_bodies)} events x {ITERATIONS} iterations")
+    print(f"json.loads + classify:          {events_per_second(decode_and_classify, raw_bodies):12,.0f} events/s")
+    print(f"bot fast path + classify:       {events_per_second(fast_path_classify, raw_bodies):12,.0f} events/s")
+    print(f"to_chat_message (thread reply): {events_per_second(convert_messages, messages):12,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# 長いスレッドを処理する1リクエストあたりのログ出力のコスト(時間とバイト数)を計測する
+#   $ make bench-logging
+import logging
+import statistics
+import time
+
+import fakes  # noqa: F401 必須の環境変数にダミー値を入れる
+
+import log
+
+THREAD_LENGTH = 200
+MESSAGE_CHARS = 400
+ITERATIONS = 200
+
+EVENT = {
+    "type": "app_mention",
+    "user": "U00000001",
+    "text": "<@U0BOT> " + "質問" * (MESSAGE_CHARS // 2),
+    "channel": "C00000001",
+    "ts": "1700000000.000100",
+    "client_msg_id": "00000000-0000-0000-0000-000000000001",
+}
+THREAD = [
+    {
+        "user": "U00000001" if i % 2 == 0 else "U0BOT",
+        "text": "本文" * (MESSAGE_CHARS // 2),
+        "ts": f"1700000000.{i:06d}",
+    }
+    for i in range(THREAD_LENGTH)
+]
+MESSAGES = [
+    {"role": "user" if i % 2 == 0 else "assistant", "content": "本文" * (MESSAGE_CHARS // 2)}
+    for i in range(THREAD_LENGTH)
+]
+
+
+class CountingStream:
+    # 出力先の代わりに、書き込まれたバイト数だけを数える
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, text: str):
+        self.bytes += len(text.encode("utf-8"))
+
+    def flush(self):
+        pass
+
+
+def legacy_request(logger: logging.Logger):
+    # 変更前と同じく、ペイロード全体をf-stringで出力する
+    logger.info(f"EVENT: {EVENT}")
+    logger.info(f'THREAD REPLIES: {THREAD}')
+    logger.info(f"Messages sent to ChatGPT(gpt-4): {MESSAGES}")
+
+
+def current_request(logger: logging.Logger):
+    logger.info("EVENT: %s", log.summarize(EVENT))
+    logger.debug("EVENT BODY: %s", EVENT)
+    logger.info("THREAD REPLIES: %s", log.summarize(THREAD))
+    logger.debug("THREAD REPLIES BODY: %s", THREAD)
+    logger.info("Messages sent to ChatGPT(%s): %s", "gpt-4", log.summarize(MESSAGES))
+    logger.debug("Messages sent to ChatGPT(%s) BODY: %s", "gpt-4", MESSAGES)
+
+
+def measure(request, formatter: logging.Formatter) -> tuple:
+    stream = CountingStream()
+    logger = log.setup_logger("bench_logging")
+    logger.handlers[0].setStream(stream)
+    logger.handlers[0].setFormatter(formatter)
+
+    durations = []
+    for _ in range(ITERATIONS):
+        started_at = time.perf_counter()
+        request(logger)
+        durations.append(time.perf_counter() - started_at)
+    return statistics.median(durations), stream.bytes / ITERATIONS
+
+
+def main():
+    text_formatter = logging.Formatter('[%(levelname)s]: %(asctime)s - %(name)s: %(message)s')
+    print(f"thread: {THREAD_LENGTH} messages x {MESSAGE_CHARS} chars, {ITERATIONS} requests")
+    for name, request, formatter in [
+        ("before (full payload f-strings)", legacy_request, text_formatter),
+        ("after  (summaries, text)", current_request, text_formatter),
+        ("after  (summaries, json)", current_request, log.JsonFormatter()),
+    ]:
+        duration, size = measure(request, formatter)
+        print(f"{name:<34} median={duration * 1000:7.3f}ms/request  {size / 1024:8.1f}KiB/request")
+
+
+if __name__ == "__main__":
+    main()
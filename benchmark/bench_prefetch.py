@@ -0,0 +1,80 @@
+# ChatGPT呼び出し前(プログレス送信・スレッド取得・ユーザ設定取得)の待ち時間を計測する
+# 同じスレッドへ続けて送るが、前の生成は終わっているため、まとめるための待ち時間は含まない
+#   $ make bench-prefetch
+import statistics
+import time
+
+import fakes
+
+import clients
+import constants
+import dynamo_db_client
+import generation
+import lambda_function
+import openai
+import thread_history
+from slack_client import SlackClient
+
+SLACK_LATENCY = 0.15
+DYNAMODB_LATENCY = 0.05
+ITERATIONS = 20
+
+BODY = {
+    "event_id": "Ev00000001",
+    "event": {
+        "type": "app_mention",
+        "user": "U00000001",
+        "text": "<@U0BOT> hello",
+        "channel": "C00000001",
+        "ts": "1700000000.000100",
+        "client_msg_id": "00000000-0000-0000-0000-000000000001",
+    },
+}
+
+
+def sequential_prefetch() -> float:
+    # 並行化する前と同じ順番で呼び出したときの待ち時間
+    dynamo_db_client._user_config_cache.clear()
+    slack_client = SlackClient(channel="C00000001", thread_ts="1700000000.000100")
+    started_at = time.perf_counter()
+    slack_client.send_text_to_thread(constants.SLACK_PROGRESS_MESSAGE)
+    slack_client.thread_replies()
+    dynamo_db_client.DynamoDBClient().get_item_from_user_config("U00000001")
+    return time.perf_counter() - started_at
+
+
+def concurrent_prefetch(chat_completion: fakes.FakeChatCompletion, previous_running: bool = False) -> float:
+    dynamo_db_client._user_config_cache.clear()
+    if previous_running:
+        # 前のメッセージへの生成が実行中の場合。続けて送られたメッセージをまとめるために待つ
+        event = BODY["event"]
+        generation.start(thread_history.thread_key(event["channel"], event["ts"]), event["user"])
+    started_at = time.perf_counter()
+    lambda_function.handle_slack_event(BODY)
+    return chat_completion.called_at[-1] - started_at
+
+
+def main():
+    clients.override("slack", fakes.FakeWebClient(
+        latency=SLACK_LATENCY,
+        thread_messages=[BODY["event"]]
+    ))
+    clients.override("dynamodb", fakes.FakeDynamoDBResource(latency=DYNAMODB_LATENCY))
+    chat_completion = fakes.FakeChatCompletion()
+    openai.ChatCompletion.create = chat_completion.create
+    # 毎回ChatGPTを呼び出すまでの時間を計るため、応答キャッシュは使わない
+    constants.RESPONSE_CACHE_ENABLED = False
+
+    sequential = [sequential_prefetch() for _ in range(ITERATIONS)]
+    concurrent = [concurrent_prefetch(chat_completion) for _ in range(ITERATIONS)]
+    coalesced = [concurrent_prefetch(chat_completion, previous_running=True) for _ in range(3)]
+
+    print(f"injected latency: slack={SLACK_LATENCY}s dynamodb={DYNAMODB_LATENCY}s")
+    print(f"sequential pre-LLM latency: median={statistics.median(sequential) * 1000:.1f}ms")
+    print(f"concurrent pre-LLM latency: median={statistics.median(concurrent) * 1000:.1f}ms")
+    print(f"  while the previous generation is running: median={statistics.median(coalesced) * 1000:.1f}ms "
+          f"(coalesce wait={constants.GENERATION_COALESCE_WAIT_SECONDS}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# 応答ごとのトークン使用量の記録と利用上限の確認で、DynamoDBへのリクエスト数と所要時間を計測する
+# 1リクエストごとに書き込む場合と、コンテナ内で集計してまとめて書き込む場合を比べる
+#   $ make bench-usage-ledger
+import os
+import random
+import time
+
+os.environ.setdefault("USAGE_TABLE", "usage")
+os.environ.setdefault("USAGE_USER_DAILY_GPT4_TOKEN_QUOTA", "1000000")
+
+import fakes  # noqa: E402
+
+import clients  # noqa: E402
+import constants  # noqa: E402
+import usage_ledger  # noqa: E402
+
+REQUESTS = 1000
+USERS = 50
+CHANNELS = 5
+MODEL = "gpt-4"
+
+
+def run(flush_interval: float, dynamodb: fakes.FakeDynamoDBResource) -> float:
+    clients.override("dynamodb", dynamodb)
+    usage_ledger.set_backend(usage_ledger.DynamoDBUsageBackend())
+    usage_ledger._usage_cache.clear()
+    constants.USAGE_FLUSH_INTERVAL_SECONDS = flush_interval
+
+    rand = random.Random(0)
+    started_at = time.perf_counter()
+    for _ in range(REQUESTS):
+        user_id = f"U{rand.randrange(USERS):08d}"
+        usage_ledger.check_quota(user_id, MODEL)
+        usage_ledger.record(user_id, f"C{rand.randrange(CHANNELS):08d}", MODEL, 1000, 200)
+        usage_ledger.flush_if_due()
+    usage_ledger.flush()
+    return time.perf_counter() - started_at
+
+
+def main():
+    print(f"requests={REQUESTS} users={USERS} channels={CHANNELS} dynamodb latency=0.005s")
+    for name, flush_interval in [("per request", 0), ("buffered", constants.USAGE_FLUSH_INTERVAL_SECONDS)]:
+        dynamodb = fakes.FakeDynamoDBResource(latency=0.005)
+        duration = run(flush_interval, dynamodb)
+        calls = dynamodb.calls()
+        items = dynamodb.Table(os.environ["USAGE_TABLE"]).items.values()
+        stored = sum(item["prompt_tokens"] + item["completion_tokens"] for item in items
+                     if item["usage_key"].startswith("user#"))
+        print(f"  {name:<12} {duration * 1000:8.1f}ms  requests={sum(calls.values()):5d} {dict(calls)}  "
+              f"stored tokens={stored:,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+# appディレクトリのモジュールを読み込めるようにし、必須の環境変数にダミー値を入れる
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+os.environ.setdefault("USER_CONFIG_TABLE", "user_config")
+os.environ.setdefault("OPEN_AI_API_KEY", "dummy")
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-dummy")
+os.environ.setdefault("SLACK_SIGNING_SECRET", "dummy")
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-northeast-1")
+
+
+class FakeSlackResponse:
+    def __init__(self, data: dict, status_code: int = 200, headers: dict = None):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+
+class FakeWebClient:
+    # thread_messagesを指定しない場合は、送信・更新・削除されたメッセージをスレッドごとに保持する
+    # rate_limit_rateの割合で、Retry-After付きの429を返す
+    def __init__(
+            self,
+            latency: float = 0.0,
+            thread_messages: list = None,
+            rate_limit_rate: float = 0.0,
+            retry_after: float = 0.1):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.thread_messages = thread_messages
+        self.threads = defaultdict(list)
+        # チャンネルまたはユーザグループのID -> メンバーのユーザID
+        self.members = {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._ts = 0
+
+    def _call(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+            self._ts += 1
+            ts = f"{int(time.time())}.{self._ts:06d}"
+        time.sleep(self.latency)
+        if random.random() < self.rate_limit_rate:
+            from slack_sdk.errors import SlackApiError
+            with self._lock:
+                self.calls[f"{method}.429"] += 1
+            response = FakeSlackResponse(
+                {"ok": False, "error": "ratelimited"}, status_code=429, headers={"Retry-After": str(self.retry_after)}
+            )
+            raise SlackApiError("ratelimited", response)
+        return ts
+
+    def add_user_message(self, channel: str, thread_ts: str, message: dict):
+        with self._lock:
+            self.threads[(channel, thread_ts)].append(dict(message))
+
+    def conversations_replies(self, **kwargs):
+        self._call("conversations.replies")
+        if self.thread_messages is not None:
+            messages = self.thread_messages
+        else:
+            oldest = float(kwargs.get("oldest") or 0)
+            with self._lock:
+                messages = [
+                    dict(m) for m in self.threads[(kwargs.get("channel"), kwargs.get("ts"))]
+                    if float(m.get("ts")) >= oldest
+                ]
+        return FakeSlackResponse({"ok": True, "messages": messages, "has_more": False})
+
+    def chat_postMessage(self, **kwargs):
+        ts = self._call("chat.postMessage")
+        if kwargs.get("thread_ts"):
+            with self._lock:
+                self.threads[(kwargs.get("channel"), kwargs.get("thread_ts"))].append({
+                    "bot_id": "B0BOT",
+                    "text": kwargs.get("text"),
+                    "ts": ts,
+                    "thread_ts": kwargs.get("thread_ts"),
+                })
+        return FakeSlackResponse({"ok": True, "ts": ts})
+
+    def chat_update(self, **kwargs):
+        ts = self._call("chat.update")
+        with self._lock:
+            for messages in self.threads.values():
+                for message in messages:
+                    if message.get("ts") == kwargs.get("ts"):
+                        message["text"] = kwargs.get("text")
+        return FakeSlackResponse({"ok": True, "ts": kwargs.get("ts", ts)})
+
+    def chat_delete(self, **kwargs):
+        self._call("chat.delete")
+        with self._lock:
+            for key, messages in self.threads.items():
+                self.threads[key] = [m for m in messages if m.get("ts") != kwargs.get("ts")]
+        return FakeSlackResponse({"ok": True})
+
+    def conversations_members(self, **kwargs):
+        self._call("conversations.members")
+        members = self.members.get(kwargs.get("channel"), [])
+        start = int(kwargs.get("cursor") or 0)
+        end = start + kwargs.get("limit", 100)
+        next_cursor = str(end) if end < len(members) else ""
+        return FakeSlackResponse({
+            "ok": True, "members": members[start:end], "response_metadata": {"next_cursor": next_cursor}
+        })
+
+    def usergroups_users_list(self, **kwargs):
+        self._call("usergroups.users.list")
+        return FakeSlackResponse({"ok": True, "users": self.members.get(kwargs.get("usergroup"), [])})
+
+
+# ソートキーを持つテーブルのキー。それ以外のテーブルは項目の最初の属性をキーとする
+KEY_NAMES = {"thread_history": ("thread_key", "ts")}
+
+
+class FakeTable:
+    def __init__(self, name: str, latency: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.items = {}
+        self.key_names = KEY_NAMES.get(name)
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+        time.sleep(self.latency)
+
+    def key_of(self, item: dict) -> tuple:
+        if self.key_names:
+            return tuple(sorted((name, item[name]) for name in self.key_names))
+        return (next(iter(item.items())),)
+
+    def get_item(self, Key: dict, **kwargs):
+        self._call("GetItem")
+        item = self.items.get(tuple(sorted(Key.items())))
+        return {"Item": dict(item)} if item else {}
+
+    def put_item(self, Item: dict, ConditionExpression: str = None, **kwargs):
+        self._call("PutItem")
+        key = self.key_of(Item)
+        with self._lock:
+            # イベントの重複排除で使う attribute_not_exists だけを再現する
+            if ConditionExpression and ConditionExpression.startswith("attribute_not_exists") \
+                    and key in self.items:
+                from botocore.exceptions import ClientError
+                raise ClientError(
+                    {"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem"
+                )
+            self.items[key] = dict(Item)
+        return {}
+
+    def query(
+            self,
+            KeyConditionExpression: str,
+            ExpressionAttributeNames: dict = None,
+            ExpressionAttributeValues: dict = None,
+            **kwargs):
+        # パーティションキーの"#a = :a"だけを再現し、ソートキーの順に返す
+        self._call("Query")
+        name, value = KeyConditionExpression.split(" = ")
+        name = (ExpressionAttributeNames or {}).get(name, name)
+        value = ExpressionAttributeValues[value]
+        with self._lock:
+            items = [dict(item) for item in self.items.values() if item.get(name) == value]
+        sort_key = self.key_names[-1] if self.key_names else name
+        return {"Items": sorted(items, key=lambda item: item.get(sort_key))}
+
+    def update_item(
+            self,
+            Key: dict,
+            UpdateExpression: str,
+            ExpressionAttributeNames: dict = None,
+            ExpressionAttributeValues: dict = None,
+            ReturnValues: str = None,
+            **kwargs):
+        # "SET #a = :a"(if_not_existsを含む)、"REMOVE #b"、"ADD #c :c"の組み合わせだけを再現する
+        self._call("UpdateItem")
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        clauses = dict(re.findall(r"(SET|REMOVE|ADD) (.*?)(?= (?:SET|REMOVE|ADD) |$)", UpdateExpression))
+
+        def actions(clause: str) -> list:
+            return re.split(r",\s*(?![^(]*\))", clauses[clause]) if clause in clauses else []
+
+        with self._lock:
+            item = self.items.setdefault(tuple(sorted(Key.items())), dict(Key))
+            old_item = dict(item)
+            for action in actions("SET"):
+                name, value = action.split(" = ")
+                name = names.get(name, name)
+                if_not_exists = re.match(r"if_not_exists\(.+, (.+)\)", value)
+                if if_not_exists:
+                    item.setdefault(name, values[if_not_exists.group(1)])
+                else:
+                    item[name] = values[value]
+            for name in actions("REMOVE"):
+                item.pop(names.get(name, name), None)
+            for action in actions("ADD"):
+                name, value = action.split(" ")
+                name = names.get(name, name)
+                item[name] = item.get(name, 0) + values[value]
+            return {"Attributes": old_item if ReturnValues in ("UPDATED_OLD", "ALL_OLD") else dict(item)}
+
+    def delete_item(self, Key: dict, **kwargs):
+        self._call("DeleteItem")
+        self.items.pop(tuple(sorted(Key.items())), None)
+        return {}
+
+
+class FakeDynamoDBResource:
+    # unprocessed_rateの割合で、BatchGetItem/BatchWriteItemの一部を未処理として返す
+    def __init__(self, latency: float = 0.0, unprocessed_rate: float = 0.0):
+        self.latency = latency
+        self.unprocessed_rate = unprocessed_rate
+        self.tables = {}
+
+    def Table(self, name: str) -> FakeTable:
+        if name not in self.tables:
+            self.tables[name] = FakeTable(name, self.latency)
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems: dict, **kwargs):
+        responses = {}
+        unprocessed = {}
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            table._call("BatchGetItem")
+            keys, rejected = self._split_unprocessed(request["Keys"])
+            items = [table.items.get(tuple(sorted(key.items()))) for key in keys]
+            responses[name] = [dict(item) for item in items if item]
+            if rejected:
+                unprocessed[name] = {**request, "Keys": rejected}
+        return {"Responses": responses, "UnprocessedKeys": unprocessed}
+
+    def batch_write_item(self, RequestItems: dict, **kwargs):
+        unprocessed = {}
+        for name, requests in RequestItems.items():
+            table = self.Table(name)
+            table._call("BatchWriteItem")
+            requests, rejected = self._split_unprocessed(requests)
+            with table._lock:
+                for request in requests:
+                    if "DeleteRequest" in request:
+                        table.items.pop(tuple(sorted(request["DeleteRequest"]["Key"].items())), None)
+                    else:
+                        item = request["PutRequest"]["Item"]
+                        table.items[table.key_of(item)] = dict(item)
+            if rejected:
+                unprocessed[name] = rejected
+        return {"UnprocessedItems": unprocessed}
+
+    def _split_unprocessed(self, requests: list) -> tuple:
+        rejected = [r for r in requests if random.random() < self.unprocessed_rate]
+        return [r for r in requests if r not in rejected], rejected
+
+    def calls(self) -> Counter:
+        counter = Counter()
+        for table in self.tables.values():
+            counter.update(table.calls)
+        return counter
+
+
+class FakeChatCompletion:
+    # latencyは最初の応答まで、chunk_latencyはストリーミングのチャンクごとの待ち時間
+    # error_rateの割合で、リトライ対象のOpenAIのエラーを発生させる
+    def __init__(
+            self,
+            latency: float = 0.0,
+            content: str = "Hello from fake ChatGPT!",
+            chunk_count: int = 1,
+            chunk_latency: float = 0.0,
+            error_rate: float = 0.0):
+        self.latency = latency
+        self.content = content
+        self.chunk_count = chunk_count
+        self.chunk_latency = chunk_latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.called_at = []
+        self._lock = threading.Lock()
+
+    def create(self, **kwargs):
+        with self._lock:
+            self.calls["ChatCompletion.create"] += 1
+            self.called_at.append(time.perf_counter())
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            from openai.error import RateLimitError
+            with self._lock:
+                self.calls["ChatCompletion.error"] += 1
+            raise RateLimitError("Injected rate limit error", headers={"Retry-After": "0"})
+
+        if kwargs.get("stream"):
+            return self._stream()
+        usage = {"prompt_tokens": 100, "completion_tokens": len(self.content), "total_tokens": 100 + len(self.content)}
+        return {"choices": [{"message": {"content": self.content}}], "usage": usage}
+
+    def _stream(self):
+        size = max(1, -(-len(self.content) // self.chunk_count))
+        for position in range(0, len(self.content), size):
+            time.sleep(self.chunk_latency)
+            yield {"choices": [{"delta": {"content": self.content[position:position + size]}}]}
+
+
+class FakeSocketModeServer:
+    # Socket Modeのapps.connections.openとWebSocketの接続を再現する
+    # send_event()したイベントをエンベロープにしてクライアントに送り、ackを受け取った時刻を記録する
+    def __init__(self):
+        self.sent_at = {}
+        self.acked_at = {}
+        self.base_url = None
+        self._queue = None
+        self._runner = None
+
+    async def start(self) -> str:
+        import asyncio
+        import socket
+
+        from aiohttp import web
+
+        self._queue = asyncio.Queue()
+        app = web.Application()
+        app.router.add_post("/api/apps.connections.open", self._open)
+        app.router.add_get("/link", self._link)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+        await web.SockSite(self._runner, sock).start()
+        self.base_url = f"http://127.0.0.1:{self.port}/api/"
+        return self.base_url
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def send_event(self, body: dict) -> str:
+        envelope_id = f"envelope-{len(self.sent_at)}"
+        self.sent_at[envelope_id] = time.perf_counter()
+        await self._queue.put({
+            "envelope_id": envelope_id,
+            "type": "events_api",
+            "accepts_response_payload": False,
+            "retry_attempt": 0,
+            "retry_reason": "",
+            "payload": body,
+        })
+        return envelope_id
+
+    async def _open(self, request):
+        from aiohttp import web
+
+        return web.json_response({"ok": True, "url": f"ws://127.0.0.1:{self.port}/link"})
+
+    async def _link(self, request):
+        import asyncio
+        import json
+
+        from aiohttp import WSMsgType, web
+
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"type": "hello", "num_connections": 1})
+
+        async def send():
+            while True:
+                await ws.send_json(await self._queue.get())
+
+        sender = asyncio.ensure_future(send())
+        try:
+            async for message in ws:
+                if message.type == WSMsgType.TEXT:
+                    envelope_id = json.loads(message.data).get("envelope_id")
+                    if envelope_id:
+                        self.acked_at[envelope_id] = time.perf_counter()
+        finally:
+            sender.cancel()
+        return ws
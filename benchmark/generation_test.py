@@ -0,0 +1,75 @@
+# 同じスレッドに続けてメンションしたときの取り消しを確かめる
+# 別のユーザのメンションでは実行中の応答を取り消さず、同じユーザが送り直したときだけ古い応答を取り消す
+#   $ make generation-test
+import os
+import threading
+import time
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("TRACING_ENABLED", "false")
+
+import fakes  # noqa: E402
+
+import clients  # noqa: E402
+import constants  # noqa: E402
+import lambda_function  # noqa: E402
+import openai  # noqa: E402
+
+CHANNEL = "C00000001"
+THREAD_TS = "1700000000.000100"
+ANSWER = "これはフェイクのChatGPTの応答です。"
+
+
+def mention(web_client: fakes.FakeWebClient, sequence: int, user_id: str) -> dict:
+    event = {
+        "type": "app_mention",
+        "user": user_id,
+        "text": f"<@U0BOT> 質問{sequence}",
+        "channel": CHANNEL,
+        "ts": f"1700000000.{100 + sequence:06d}",
+        "thread_ts": THREAD_TS,
+        "client_msg_id": f"00000000-0000-0000-0000-{sequence:012d}",
+    }
+    web_client.add_user_message(CHANNEL, THREAD_TS, event)
+    return {"event_id": f"Ev{sequence:010d}", "event": event}
+
+
+def run(user_ids: list, first_sequence: int) -> list:
+    # 0.3秒ずつずらしてメンションし、すべて処理し終えたときのスレッドのBotの応答を返す
+    web_client = fakes.FakeWebClient()
+    clients.override("slack", web_client)
+    web_client.add_user_message(CHANNEL, THREAD_TS, {"user": user_ids[0], "text": "<@U0BOT> はじめ", "ts": THREAD_TS})
+
+    handlers = []
+    for sequence, user_id in enumerate(user_ids, start=first_sequence):
+        body = mention(web_client, sequence, user_id)
+        handler = threading.Thread(target=lambda_function.handle_slack_event, args=(body,))
+        handler.start()
+        handlers.append(handler)
+        time.sleep(0.3)
+    for handler in handlers:
+        handler.join()
+    return [m["text"] for m in web_client.threads[(CHANNEL, THREAD_TS)] if m.get("bot_id")]
+
+
+def main():
+    clients.override("dynamodb", fakes.FakeDynamoDBResource())
+    clients.override("openai", object())
+    openai.ChatCompletion.create = fakes.FakeChatCompletion(latency=1.0, content=ANSWER).create
+    constants.CHAT_GPT_STREAM_ENABLED = False
+    # 同じ質問でもChatGPTを呼び出し、生成中に次のメンションが届くようにする
+    constants.RESPONSE_CACHE_ENABLED = False
+
+    answers = run(["U00000001", "U00000002"], 1)
+    print(f"two users in one thread: {answers}")
+    if sorted(answers) != sorted([f"<@U00000001>\n{ANSWER}", f"<@U00000002>\n{ANSWER}"]):
+        raise SystemExit("A mention from another user cancelled the running answer")
+
+    answers = run(["U00000001", "U00000001"], 3)
+    print(f"one user sending twice:  {answers}")
+    if answers != [f"<@U00000001>\n{ANSWER}"]:
+        raise SystemExit("Sending again did not replace the running answer")
+
+
+if __name__ == "__main__":
+    main()
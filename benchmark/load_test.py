@@ -0,0 +1,240 @@
+# 署名付きの合成Slackイベントでlambda_handlerを呼び出し、フェイクのSlack・DynamoDB・OpenAIに対する
+# エンドツーエンドのレイテンシ、リクエストあたりの呼び出し回数、ピークメモリを計測する
+#   $ make load-test
+#   $ python benchmark/load_test.py --requests 500 --concurrency 4 --openai-latency 0.5 --error-rate 0.05
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import resource
+import statistics
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+# 本番と同じく重複排除とスレッド履歴のテーブルを使う。ログとEMFの出力は計測の邪魔になるため抑える
+os.environ.setdefault("EVENT_DEDUPE_TABLE", "event_dedupe")
+os.environ.setdefault("THREAD_HISTORY_TABLE", "thread_history")
+os.environ.setdefault("INSTALLATION_TABLE", "installation")
+# 署名シークレットを登録する2つめのアプリ(SECOND_APP_ID)
+os.environ.setdefault("SLACK_APP_IDS", "A0SECOND")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("TRACING_ENABLED", "false")
+
+import fakes  # noqa: E402
+
+import clients  # noqa: E402
+import constants  # noqa: E402
+import event_queue  # noqa: E402
+import installation_store  # noqa: E402
+import lambda_function  # noqa: E402
+import openai  # noqa: E402
+import slack_api  # noqa: E402
+
+BOT_USER_ID = "U0BOT"
+# --teamsを指定したときは、奇数番目のワークスペースを別の署名シークレットを持つ2つめのアプリにする
+DEFAULT_APP_ID = "A0DEFAULT"
+SECOND_APP_ID = "A0SECOND"
+SECOND_APP_SIGNING_SECRET = "second-app-signing-secret"
+
+
+class FakeContext:
+    def __init__(self, request_id: str):
+        self.aws_request_id = request_id
+
+    def get_remaining_time_in_millis(self) -> int:
+        return 10 * 60 * 1000
+
+
+class EventFactory:
+    # 新しいスレッドへのメンション、既存スレッドへの返信、Botの投稿、Slackからの再送を混ぜて生成する
+    def __init__(self, web_client: fakes.FakeWebClient, threads: int, seed: int, teams: int = 1):
+        self.web_client = web_client
+        self.teams = teams
+        self.threads = [f"{1700000000 + i}.000000" for i in range(threads)]
+        self.random = random.Random(seed)
+        self.sequence = 0
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def next(self) -> dict:
+        with self._lock:
+            self.sequence += 1
+            sequence = self.sequence
+            kind = self.random.random()
+            thread_ts = self.random.choice(self.threads)
+            retry = self.sent and kind < 0.05
+            resend = self.random.choice(self.sent) if retry else None
+
+        # Slackの再送(同じevent_id)
+        if resend:
+            return signed_request(resend, retry=True)
+
+        # Botの投稿(ストリーミング中の更新など)
+        if kind < 0.15:
+            body = envelope(sequence, self.teams, {
+                "type": "message",
+                "bot_id": "B0BOT",
+                "user": BOT_USER_ID,
+                "text": constants.SLACK_PROGRESS_MESSAGE,
+                "channel": "C00000001",
+                "ts": f"{int(time.time())}.{sequence:06d}",
+                "thread_ts": thread_ts,
+            })
+            return signed_request(body)
+
+        ts = f"{int(time.time())}.{sequence:06d}"
+        event = {
+            "type": "app_mention",
+            "user": f"U{sequence % 20:08d}",
+            "text": f"<@{BOT_USER_ID}> 質問{sequence}: " + "詳しく教えてください。" * self.random.randint(1, 20),
+            "channel": "C00000001",
+            "ts": ts,
+            "client_msg_id": f"00000000-0000-0000-0000-{sequence:012d}",
+        }
+        # スレッドへの返信
+        if kind >= 0.4:
+            event["thread_ts"] = thread_ts
+        self.web_client.add_user_message(event["channel"], event.get("thread_ts", ts), event)
+        body = envelope(sequence, self.teams, event)
+        with self._lock:
+            self.sent.append(body)
+        return signed_request(body)
+
+
+def envelope(sequence: int, teams: int, event: dict) -> dict:
+    api_app_id, team_id = team_of(sequence % teams)
+    return {
+        "type": "event_callback",
+        "event_id": f"Ev{sequence:010d}",
+        "api_app_id": api_app_id,
+        "team_id": team_id,
+        "event": event,
+    }
+
+
+def team_of(index: int) -> tuple:
+    return SECOND_APP_ID if index % 2 else DEFAULT_APP_ID, f"T{index:08d}"
+
+
+def install_teams(teams: int, web_client) -> None:
+    # 最初のワークスペースは環境変数のトークンを使い、残りはテーブルに登録したトークンで応答する
+    installation_store.save_signing_secrets(SECOND_APP_ID, [SECOND_APP_SIGNING_SECRET])
+    for index in range(1, teams):
+        api_app_id, team_id = team_of(index)
+        token = f"xoxb-{team_id}"
+        installation_store.save(installation_store.Installation(team_id, api_app_id, token))
+        # レートリミットの予算はワークスペースごとのため、クライアントも分ける
+        clients.override(clients.slack_web_client_name(token), slack_api.RateLimitedWebClient(web_client))
+
+
+def signed_request(body: dict, retry: bool = False) -> dict:
+    raw_body = json.dumps(body, ensure_ascii=False, separators=(",", ":"))
+    timestamp = str(int(time.time()))
+    secret = SECOND_APP_SIGNING_SECRET.encode() if body.get("api_app_id") == SECOND_APP_ID \
+        else constants.SLACK_SIGNING_SECRET
+    signature = "v0=" + hmac.new(secret, f"v0:{timestamp}:{raw_body}".encode(), hashlib.sha256).hexdigest()
+    headers = {"X-Slack-Request-Timestamp": timestamp, "X-Slack-Signature": signature}
+    if retry:
+        headers["X-Slack-Retry-Num"] = "1"
+    return {"headers": headers, "body": raw_body}
+
+
+def percentile(values: list, p: int) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=20, help="number of Slack threads to spread events over")
+    parser.add_argument("--slack-latency", type=float, default=0.02)
+    parser.add_argument("--dynamodb-latency", type=float, default=0.005)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--chunks", type=int, default=20, help="number of streamed chunks per completion")
+    parser.add_argument("--chunk-latency", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--slack-429-rate", type=float, default=0.0, help="ratio of Slack calls answered with 429")
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--rate-limit", action="store_true", help="enable the OpenAI rate limiter")
+    parser.add_argument("--slack-rate-limit", action="store_true", help="enable the Slack per-method budgets")
+    parser.add_argument("--teams", type=int, default=1, help="number of workspaces to spread events over")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    constants.CHAT_GPT_STREAM_ENABLED = not args.no_stream
+    constants.RATE_LIMIT_ENABLED = args.rate_limit
+    constants.SLACK_RATE_LIMIT_ENABLED = args.slack_rate_limit
+    constants.SLACK_STREAM_UPDATE_INTERVAL_SECONDS = args.chunk_latency * 5
+
+    web_client = fakes.FakeWebClient(latency=args.slack_latency, rate_limit_rate=args.slack_429_rate)
+    dynamodb = fakes.FakeDynamoDBResource(latency=args.dynamodb_latency)
+    chat_completion = fakes.FakeChatCompletion(
+        latency=args.openai_latency,
+        content="これはフェイクのChatGPTの応答です。" * 10,
+        chunk_count=args.chunks,
+        chunk_latency=args.chunk_latency,
+        error_rate=args.error_rate
+    )
+    clients.override("slack", slack_api.RateLimitedWebClient(web_client))
+    clients.override("dynamodb", dynamodb)
+    clients.override("openai", object())
+    openai.ChatCompletion.create = chat_completion.create
+    install_teams(args.teams, web_client)
+
+    # 非同期のワーカー呼び出しを、同じプロセス内で続けて処理する
+    event_queue.set_event_queue(event_queue.InProcessEventQueue(
+        worker=lambda body: lambda_function.lambda_handler(
+            event_queue.to_worker_event(body), FakeContext("worker")
+        )
+    ))
+    events = EventFactory(web_client, args.threads, args.seed, args.teams)
+
+    def run(index: int) -> float:
+        request = events.next()
+        started_at = time.perf_counter()
+        response = lambda_function.lambda_handler(request, FakeContext(f"request-{index}"))
+        elapsed = time.perf_counter() - started_at
+        if response.get("statusCode") != 200:
+            raise RuntimeError(f"Unexpected response: {response}")
+        return elapsed
+
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(run, range(args.requests)))
+    duration = time.perf_counter() - started_at
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"requests={args.requests} concurrency={args.concurrency} stream={not args.no_stream} "
+          f"error_rate={args.error_rate} duration={duration:.2f}s throughput={args.requests / duration:.1f} req/s")
+    print("end-to-end latency: " + " ".join(
+        f"p{p}={percentile(latencies, p) * 1000:.1f}ms" for p in (50, 95, 99)
+    ) + f" max={max(latencies) * 1000:.1f}ms")
+
+    print("calls per request:")
+    backend_calls = [
+        ("slack", web_client.calls),
+        ("dynamodb", dynamodb.calls()),
+        ("openai", chat_completion.calls),
+    ]
+    for backend, calls in backend_calls:
+        for method, count in sorted(calls.items()):
+            print(f"  {backend:<9} {method:<26} {count / args.requests:6.2f}")
+
+    slack_clients = [name for name in clients.stats() if name.startswith("slack")]
+    print(f"workspaces: teams={args.teams} slack clients={len(slack_clients)} "
+          f"installation lookups={sum(dynamodb.Table(constants.INSTALLATION_TABLE).calls.values())}")
+    print(f"slack rate limiting: throttled={slack_api.slack_call_stats['throttled']} "
+          f"retried after 429={slack_api.slack_call_stats['rate_limited']}")
+    print(f"peak memory: traced={peak_traced / 1024 / 1024:.1f}MiB "
+          f"maxrss={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# フェイクのSocket Modeサーバーからイベントを送り、SocketModeWorkerのackまでの時間、処理の完了までの時間、
+# ユーザごとの同時実行数を計測する。最後に処理中のイベントを残したまま停止し、すべて処理し終えてから止まることを確かめる
+#   $ make socket-mode-test
+#   $ python benchmark/socket_mode_test.py --events 200 --users 5 --workers 8 --per-user 2
+import argparse
+import asyncio
+import os
+import statistics
+import threading
+import time
+from collections import Counter
+
+os.environ.setdefault("EVENT_DEDUPE_TABLE", "event_dedupe")
+os.environ.setdefault("THREAD_HISTORY_TABLE", "thread_history")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("TRACING_ENABLED", "false")
+
+import fakes  # noqa: E402
+
+import clients  # noqa: E402
+import constants  # noqa: E402
+import lambda_function  # noqa: E402
+import openai  # noqa: E402
+import socket_mode_worker  # noqa: E402
+from slack_sdk.socket_mode.aiohttp import SocketModeClient  # noqa: E402
+from slack_sdk.web.async_client import AsyncWebClient  # noqa: E402
+
+BOT_USER_ID = "U0BOT"
+
+
+class MeasuredHandler:
+    # lambda_function.handle_slack_eventを呼び、完了時刻とユーザごと・全体の同時実行数を記録する
+    def __init__(self):
+        self.completed_at = {}
+        self.running = Counter()
+        self.max_running = Counter()
+        self.max_total = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, body: dict) -> dict:
+        user_id = body["event"]["user"]
+        with self._lock:
+            self.running[user_id] += 1
+            self.max_running[user_id] = max(self.max_running[user_id], self.running[user_id])
+            self.max_total = max(self.max_total, sum(self.running.values()))
+        try:
+            return lambda_function.handle_slack_event(body)
+        finally:
+            with self._lock:
+                self.running[user_id] -= 1
+                self.completed_at[body["event_id"]] = time.perf_counter()
+
+
+def make_event(web_client: fakes.FakeWebClient, sequence: int, users: int) -> dict:
+    ts = f"{int(time.time())}.{sequence:06d}"
+    event = {
+        "type": "app_mention",
+        "user": f"U{sequence % users:08d}",
+        "text": f"<@{BOT_USER_ID}> 質問{sequence}: 詳しく教えてください。",
+        "channel": "C00000001",
+        "ts": ts,
+        "client_msg_id": f"00000000-0000-0000-0000-{sequence:012d}",
+    }
+    web_client.add_user_message(event["channel"], ts, event)
+    return {"type": "event_callback", "event_id": f"Ev{sequence:010d}", "event": event}
+
+
+def percentile(values: list, p: int) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1] if len(values) > 1 else values[0]
+
+
+async def main(args):
+    web_client = fakes.FakeWebClient(latency=args.slack_latency)
+    dynamodb = fakes.FakeDynamoDBResource(latency=args.dynamodb_latency)
+    chat_completion = fakes.FakeChatCompletion(
+        latency=args.openai_latency,
+        content="これはフェイクのChatGPTの応答です。" * 10,
+        chunk_count=args.chunks,
+        chunk_latency=args.chunk_latency,
+    )
+    clients.override("slack", web_client)
+    clients.override("dynamodb", dynamodb)
+    clients.override("openai", object())
+    openai.ChatCompletion.create = chat_completion.create
+    constants.SLACK_STREAM_UPDATE_INTERVAL_SECONDS = args.chunk_latency * 5
+    lambda_function.configure_concurrency(args.workers)
+
+    server = fakes.FakeSocketModeServer()
+    base_url = await server.start()
+    client = SocketModeClient(app_token="xapp-dummy", web_client=AsyncWebClient(token="xoxb-dummy", base_url=base_url))
+    handler = MeasuredHandler()
+    worker = socket_mode_worker.SocketModeWorker(
+        client, handler=handler, max_workers=args.workers, max_events_per_user=args.per_user
+    )
+    await client.connect()
+
+    started_at = time.perf_counter()
+    envelopes = {}
+    for sequence in range(args.events):
+        body = make_event(web_client, sequence, args.users)
+        envelopes[await server.send_event(body)] = body["event_id"]
+    # 最後のイベントのackを待ってから止め、処理中のイベントが残った状態で停止させる
+    while len(server.acked_at) < args.events:
+        await asyncio.sleep(0.01)
+    in_flight = len(worker.tasks)
+    await worker.drain()
+    duration = time.perf_counter() - started_at
+    await server.stop()
+
+    acks = [server.acked_at[e] - server.sent_at[e] for e in envelopes]
+    completed = [handler.completed_at[e] - server.sent_at[envelope_id]
+                 for envelope_id, e in envelopes.items() if e in handler.completed_at]
+    print(f"events={args.events} users={args.users} workers={args.workers} per_user={args.per_user} "
+          f"duration={duration:.2f}s throughput={len(completed) / duration:.1f} events/s")
+    print("ack latency:        " + " ".join(f"p{p}={percentile(acks, p) * 1000:.1f}ms" for p in (50, 95, 99))
+          + f" max={max(acks) * 1000:.1f}ms")
+    print("completion latency: " + " ".join(f"p{p}={percentile(completed, p) * 1000:.1f}ms" for p in (50, 95, 99))
+          + f" max={max(completed) * 1000:.1f}ms")
+    print(f"max concurrency: total={handler.max_total} per user={max(handler.max_running.values())}")
+    print(f"drain: in flight at stop={in_flight} completed={len(completed)}/{args.events} "
+          f"posted={web_client.calls['chat.postMessage']}")
+    if len(completed) != args.events:
+        raise SystemExit("Some events were not processed before the worker stopped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=constants.SOCKET_MODE_MAX_WORKERS)
+    parser.add_argument("--per-user", type=int, default=constants.SOCKET_MODE_MAX_EVENTS_PER_USER)
+    parser.add_argument("--slack-latency", type=float, default=0.02)
+    parser.add_argument("--dynamodb-latency", type=float, default=0.005)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--chunk-latency", type=float, default=0.01)
+    asyncio.run(main(parser.parse_args()))
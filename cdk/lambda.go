@@ -1,9 +1,12 @@
 package main
 
 import (
+	"os"
+
 	"github.com/aws/aws-cdk-go/awscdk/v2"
 	"github.com/aws/aws-cdk-go/awscdk/v2/awsapigateway"
 	"github.com/aws/aws-cdk-go/awscdk/v2/awsdynamodb"
+	"github.com/aws/aws-cdk-go/awscdk/v2/awsiam"
 	"github.com/aws/aws-cdk-go/awscdk/v2/awslambda"
 	"github.com/aws/aws-cdk-go/awscdk/v2/awsssm"
 	"github.com/aws/constructs-go/constructs/v10"
@@ -31,7 +34,90 @@ func NewLambdaStack(scope constructs.Construct, id string, props *LambdaStackPro
 		RemovalPolicy: awscdk.RemovalPolicy_DESTROY,
 	})
 
+	event_dedupe_table := awsdynamodb.NewTable(stack, jsii.String("ChatGPT_DynamoDB_EventDedupe"), &awsdynamodb.TableProps{
+		TableName: jsii.String("event_dedupe"),
+		PartitionKey: &awsdynamodb.Attribute{
+			Name: jsii.String("event_key"),
+			Type: awsdynamodb.AttributeType_STRING,
+		},
+		TimeToLiveAttribute: jsii.String("expires_at"),
+		BillingMode:         awsdynamodb.BillingMode_PAY_PER_REQUEST,
+		RemovalPolicy:       awscdk.RemovalPolicy_DESTROY,
+	})
+
+	thread_history_table := awsdynamodb.NewTable(stack, jsii.String("ChatGPT_DynamoDB_ThreadHistory"), &awsdynamodb.TableProps{
+		TableName: jsii.String("thread_history"),
+		PartitionKey: &awsdynamodb.Attribute{
+			Name: jsii.String("thread_key"),
+			Type: awsdynamodb.AttributeType_STRING,
+		},
+		// メッセージごとの項目。"summary"は要約の項目
+		SortKey: &awsdynamodb.Attribute{
+			Name: jsii.String("ts"),
+			Type: awsdynamodb.AttributeType_STRING,
+		},
+		TimeToLiveAttribute: jsii.String("expires_at"),
+		BillingMode:         awsdynamodb.BillingMode_PAY_PER_REQUEST,
+		RemovalPolicy:       awscdk.RemovalPolicy_DESTROY,
+	})
+
+	rate_limit_table := awsdynamodb.NewTable(stack, jsii.String("ChatGPT_DynamoDB_RateLimit"), &awsdynamodb.TableProps{
+		TableName: jsii.String("rate_limit"),
+		PartitionKey: &awsdynamodb.Attribute{
+			Name: jsii.String("bucket_key"),
+			Type: awsdynamodb.AttributeType_STRING,
+		},
+		TimeToLiveAttribute: jsii.String("expires_at"),
+		BillingMode:         awsdynamodb.BillingMode_PAY_PER_REQUEST,
+		RemovalPolicy:       awscdk.RemovalPolicy_DESTROY,
+	})
+
+	response_cache_table := awsdynamodb.NewTable(stack, jsii.String("ChatGPT_DynamoDB_ResponseCache"), &awsdynamodb.TableProps{
+		TableName: jsii.String("response_cache"),
+		PartitionKey: &awsdynamodb.Attribute{
+			Name: jsii.String("cache_key"),
+			Type: awsdynamodb.AttributeType_STRING,
+		},
+		TimeToLiveAttribute: jsii.String("expires_at"),
+		BillingMode:         awsdynamodb.BillingMode_PAY_PER_REQUEST,
+		RemovalPolicy:       awscdk.RemovalPolicy_DESTROY,
+	})
+
+	generation_table := awsdynamodb.NewTable(stack, jsii.String("ChatGPT_DynamoDB_Generation"), &awsdynamodb.TableProps{
+		TableName: jsii.String("generation"),
+		PartitionKey: &awsdynamodb.Attribute{
+			Name: jsii.String("thread_key"),
+			Type: awsdynamodb.AttributeType_STRING,
+		},
+		TimeToLiveAttribute: jsii.String("expires_at"),
+		BillingMode:         awsdynamodb.BillingMode_PAY_PER_REQUEST,
+		RemovalPolicy:       awscdk.RemovalPolicy_DESTROY,
+	})
+
+	usage_table := awsdynamodb.NewTable(stack, jsii.String("ChatGPT_DynamoDB_Usage"), &awsdynamodb.TableProps{
+		TableName: jsii.String("usage"),
+		PartitionKey: &awsdynamodb.Attribute{
+			Name: jsii.String("usage_key"),
+			Type: awsdynamodb.AttributeType_STRING,
+		},
+		TimeToLiveAttribute: jsii.String("expires_at"),
+		BillingMode:         awsdynamodb.BillingMode_PAY_PER_REQUEST,
+		RemovalPolicy:       awscdk.RemovalPolicy_DESTROY,
+	})
+
+	installation_table := awsdynamodb.NewTable(stack, jsii.String("ChatGPT_DynamoDB_Installation"), &awsdynamodb.TableProps{
+		TableName: jsii.String("installation"),
+		PartitionKey: &awsdynamodb.Attribute{
+			Name: jsii.String("installation_key"),
+			Type: awsdynamodb.AttributeType_STRING,
+		},
+		BillingMode:   awsdynamodb.BillingMode_PAY_PER_REQUEST,
+		RemovalPolicy: awscdk.RemovalPolicy_RETAIN,
+	})
+
+	functionName := "chat-gpt-slack"
 	lambdaFunction := awslambda.NewFunction(stack, jsii.String("ChatGPT_LambdaFunction"), &awslambda.FunctionProps{
+		FunctionName: jsii.String(functionName),
 		Architecture: awslambda.Architecture_ARM_64(),
 		Runtime:      awslambda.Runtime_PYTHON_3_9(),
 		Code:         awslambda.AssetCode_FromAsset(jsii.String("../app/dist/lambda.zip"), nil),
@@ -41,11 +127,45 @@ func NewLambdaStack(scope constructs.Construct, id string, props *LambdaStackPro
 			"SLACK_BOT_TOKEN":      awsssm.StringParameter_ValueForStringParameter(stack, jsii.String("/chat-gpt-slack/SLACK_BOT_TOKEN"), nil),
 			"SLACK_SIGNING_SECRET": awsssm.StringParameter_ValueForStringParameter(stack, jsii.String("/chat-gpt-slack/SLACK_SIGNING_SECRET"), nil),
 			"USER_CONFIG_TABLE":    user_config_table.TableName(),
+			"EVENT_DEDUPE_TABLE":   event_dedupe_table.TableName(),
+			"THREAD_HISTORY_TABLE": thread_history_table.TableName(),
+			"RATE_LIMIT_TABLE":     rate_limit_table.TableName(),
+			"RESPONSE_CACHE_TABLE": response_cache_table.TableName(),
+			"GENERATION_TABLE":     generation_table.TableName(),
+			"USAGE_TABLE":          usage_table.TableName(),
+			"INSTALLATION_TABLE":   installation_table.TableName(),
+			// 署名シークレットをinstallationテーブルに登録したアプリのID(カンマ区切り)
+			"SLACK_APP_IDS": jsii.String(os.Getenv("SLACK_APP_IDS")),
+			// 1人のユーザが1日に使えるGPT-4とGPT-4-32kのトークン数(0は無制限)
+			"USAGE_USER_DAILY_GPT4_TOKEN_QUOTA":     jsii.String(os.Getenv("USAGE_USER_DAILY_GPT4_TOKEN_QUOTA")),
+			"USAGE_USER_DAILY_GPT4_32K_TOKEN_QUOTA": jsii.String(os.Getenv("USAGE_USER_DAILY_GPT4_32K_TOKEN_QUOTA")),
+			// チャンネルやユーザグループへ一括で設定できる管理者(カンマ区切りのSlackユーザID)
+			"ADMIN_USER_IDS": jsii.String(os.Getenv("ADMIN_USER_IDS")),
 		},
 		MemorySize: jsii.Number(256),
 		Timeout:    awscdk.Duration_Minutes(jsii.Number(10)),
+		// ワーカーの失敗はSlackに通知済みのため、非同期呼び出しの自動リトライはしない
+		RetryAttempts: jsii.Number(0),
 	})
 	user_config_table.GrantReadWriteData(lambdaFunction)
+	event_dedupe_table.GrantReadWriteData(lambdaFunction)
+	thread_history_table.GrantReadWriteData(lambdaFunction)
+	rate_limit_table.GrantReadWriteData(lambdaFunction)
+	response_cache_table.GrantReadWriteData(lambdaFunction)
+	generation_table.GrantReadWriteData(lambdaFunction)
+	usage_table.GrantReadWriteData(lambdaFunction)
+	installation_table.GrantReadData(lambdaFunction)
+
+	// Slackへの応答後にワーカーとして自分自身を非同期で呼び出す
+	lambdaFunction.AddToRolePolicy(awsiam.NewPolicyStatement(&awsiam.PolicyStatementProps{
+		Actions: jsii.Strings("lambda:InvokeFunction"),
+		Resources: jsii.Strings(*stack.FormatArn(&awscdk.ArnComponents{
+			Service:      jsii.String("lambda"),
+			Resource:     jsii.String("function"),
+			ResourceName: jsii.String(functionName),
+			ArnFormat:    awscdk.ArnFormat_COLON_RESOURCE_NAME,
+		})),
+	}))
 
 	apiGateWay := awsapigateway.NewRestApi(stack, jsii.String("ChatGPT_API_Gateway"), &awsapigateway.RestApiProps{
 		RestApiName: jsii.String("ChatGPT API Gateway"),